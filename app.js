@@ -1,26 +1,78 @@
 require("dotenv").config();
+const cluster = require("cluster");
+
+/**
+ * With CLUSTER_WORKERS set this process is the primary of a cluster (see primary.js),
+ * which forks the workers that run the rest of this file.
+ */
+if (process.env.CLUSTER_WORKERS && cluster.isPrimary) {
+  return require("./primary").start();
+}
+
 const express = require("express");
 const mongoose = require("mongoose");
+const metrics = require("./metrics");
+mongoose.plugin(metrics.plugin); // before any model is compiled
 const app = express();
 const swaggerUI = require("swagger-ui-express");
 const swaggerDoc = require("swagger-jsdoc");
 const {swagger_options} = require("./swagger.js");
+const clock = require("./clock");
+const bus = require("./bus");
+const events = require("./events");
+const health = require("./health");
+const settlement = require("./settlement");
+const trace = require("./trace");
+
+const DRAIN_TIMEOUT = parseFloat(process.env.DRAIN_TIMEOUT || 10); // seconds to finish the requests on shutdown
+let closing = false;
 
 mongoose.connect(process.env.DB, (error, connect) => {
   if (error) {
     return console.log(error);
   }
   console.log("Connected to Database");
+  require("./modules")
+    .supports_transactions()
+    .then(supported => supported || console.log("MongoDB is not a replica set, the bids are stored without transactions"))
+    .catch(console.log);
+  // In a cluster only the leader worker migrates and settles
+  if (!bus.leader) {
+    return;
+  }
+  require("./migrations")
+    .run()
+    .then(() => !closing && settlement.start())
+    .catch(console.log);
 });
 
 const apidoc = swaggerDoc(swagger_options);
 
-app.use(require("body-parser").json());
+app.use(health.track);
+app.use(metrics.track);
+app.use((req, res, next) => {
+  if (closing) {
+    res.set("Connection", "close");
+  }
+  next();
+});
+// The bulk routes parse their own, bigger, bodies (see bulk.js)
+app.use(require("body-parser").json({ type: req => Boolean(req.is("json")) && !req.path.endsWith("/bulk") }));
+if (trace.enabled) {
+  app.use(trace.capture); // the request traces of tests/traces.py, see trace.js
+}
 app.use("/api/auction", require("./routes/auction"));
 app.use("/api/user", require("./routes/user"));
 app.use("/api/auth", require("./routes/auth"));
+app.use("/api/events", require("./routes/events"));
+app.use("/api/health", require("./routes/health"));
+app.use("/api/metrics", require("./routes/metrics"));
 app.use("/api/docs", swaggerUI.serve, swaggerUI.setup(apidoc));
 
+if (clock.enabled) {
+  app.use("/api/test/clock", require("./routes/clock"));
+}
+
 /**
  * Redirect all url queries to API docs page. The endpoints are not not affected.
  */
@@ -29,7 +81,35 @@ app.all('*', function(req, res) {
 });
 
 
-app.listen(
+const server = app.listen(
   process.env.SERVER_PORT,
   console.log("Auction server is running...")
 );
+
+/**
+ * Graceful shutdown: stop accepting connections, end the event streams and the idle
+ * keep-alive connections, let the requests in flight finish, then disconnect.
+ */
+function shutdown() {
+  if (closing) {
+    return;
+  }
+  closing = true;
+  settlement.stop();
+  events.close();
+  setTimeout(() => process.exit(1), DRAIN_TIMEOUT * 1000).unref();
+  server.close(() => {
+    Promise.all([mongoose.disconnect(), trace.close()]).finally(() => process.exit(0));
+  });
+  if (server.closeIdleConnections) {
+    server.closeIdleConnections();
+  }
+}
+
+process.on("SIGTERM", shutdown);
+process.on("SIGINT", shutdown);
+process.on("message", message => {
+  if (message === "shutdown") {
+    shutdown();
+  }
+});
@@ -0,0 +1,94 @@
+const readline = require('readline')
+const bodyParser = require('body-parser')
+const metrics = require('./metrics')
+
+/*
+Input and writes of the bulk endpoints (auction/add/bulk, auction/bid/bulk).
+The records come either as a JSON array, parsed up to BULK_JSON_LIMIT, or as
+an NDJSON stream (Content-Type: application/x-ndjson) of any length, read
+line by line as it arrives. Either way they are handled BULK_BATCH at a time,
+so a big import never sits in memory as a whole, and every record keeps its
+index in the input for the per-record errors. A line that is not valid JSON is
+an error of that record only.
+*/
+
+const BATCH = parseInt(process.env.BULK_BATCH || 1000)
+const JSON_LIMIT = process.env.BULK_JSON_LIMIT || "50mb"
+
+const NDJSON = "application/x-ndjson"
+
+// The JSON array parser of the bulk routes, the application wide one stops at its default limit
+const json = bodyParser.json({ limit: JSON_LIMIT })
+
+// Why the request can not be read as records, or null
+function invalid(req) {
+    if (req.is(NDJSON) || Array.isArray(req.body)) {
+        return null
+    }
+    return "Expected a JSON array of records or an " + NDJSON + " stream"
+}
+
+async function* lines(req) {
+    const input = readline.createInterface({ input: req, crlfDelay: Infinity })
+    for await (const line of input) {
+        if (line.trim() !== "") {
+            yield line
+        }
+    }
+}
+
+// The records of the request in batches of { index, record } or { index, error }
+async function* batches(req) {
+    let batch = [], index = 0
+    if (req.is(NDJSON)) {
+        for await (const line of lines(req)) {
+            try {
+                batch.push({ index: index++, record: JSON.parse(line) })
+            } catch {
+                batch.push({ index: index++, error: "Invalid JSON" })
+            }
+            if (batch.length === BATCH) {
+                yield batch
+                batch = []
+            }
+        }
+    } else {
+        for (const record of req.body) {
+            batch.push({ index: index++, record: record })
+            if (batch.length === BATCH) {
+                yield batch
+                batch = []
+            }
+        }
+    }
+    if (batch.length > 0) {
+        yield batch
+    }
+}
+
+// Insert the documents with one unordered bulk insert, returns the position => write error of the ones that failed.
+// In a transaction (session) any failure aborts it, so the insert is all or nothing there.
+async function insert(model, documents, session = undefined) {
+    const failed = new Map()
+    if (documents.length === 0) {
+        return failed
+    }
+    try {
+        await metrics.query(model, "insertMany", () => model.collection.insertMany(documents, { ordered: false, session }))
+    } catch (error) {
+        const errors = [].concat(error.writeErrors || [])
+        if (errors.length === 0) {
+            throw error
+        }
+        for (const each of errors) {
+            failed.set(each.index, each)
+        }
+    }
+    return failed
+}
+
+module.exports.json = json
+module.exports.invalid = invalid
+module.exports.batches = batches
+module.exports.insert = insert
+module.exports.NDJSON = NDJSON
@@ -0,0 +1,41 @@
+const cluster = require('cluster')
+const EventEmitter = require('events')
+
+/*
+Messages between the workers of a cluster (see primary.js). A worker sends a
+topic and its data to the primary, which relays it to every worker, the sender
+included, stamped with a cluster-wide sequence number. The primary also owns
+the state that must be the same everywhere (the cache version, the test clock
+offset), for those topics it answers with the new value instead.
+
+Without a cluster there is only this process, send() delivers the message to
+it right away, so the callers do not have to care whether they run clustered.
+*/
+
+const bus = new EventEmitter()
+bus.setMaxListeners(0)
+
+bus.clustered = cluster.isWorker
+bus.id = cluster.isWorker ? cluster.worker.id : 0
+// The worker that runs the migrations and the settlement, the only process without a cluster
+bus.leader = !cluster.isWorker || process.env.CLUSTER_LEADER === 'true'
+
+let sequence = 0
+
+bus.send = (topic, data = {}) => {
+    if (bus.clustered) {
+        process.send({ bus: topic, data: data })
+    } else {
+        bus.emit(topic, data, ++sequence)
+    }
+}
+
+if (bus.clustered) {
+    process.on('message', message => {
+        if (message && message.bus) {
+            bus.emit(message.bus, message.data, message.seq)
+        }
+    })
+}
+
+module.exports = bus
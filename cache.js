@@ -0,0 +1,179 @@
+const crypto = require('crypto')
+const clock = require('./clock')
+const bus = require('./bus')
+
+/*
+In-process cache of the listing responses (auction listings, user history and
+bid history), keyed by the route with its pagination parameters. Every change
+to the auctions (a new auction, an accepted bid, a settlement) bumps the
+version of the collection, which drops the whole cache at once, so a cached
+response is never older than the last change. The ETag of a listing is the
+version with a digest of its key (the route, the parameters and the user of a
+per user listing), and only a successful listing carries one: a client polling
+with If-None-Match gets a 304 without any query as long as nothing has
+changed. The entries are evicted least recently used
+first when the cache goes over CACHE_MAX_BYTES, and after CACHE_TTL seconds in
+any case, which also bounds how long a listing filtered by time (noexpired,
+expired) can lag behind the clock.
+
+In a cluster every worker has its own cache and the primary owns the version:
+a worker that bumps it drops its own cache right away and does not cache
+anything until the primary has broadcast the new version, which every worker
+applies by dropping its cache too. The ETags are the same on every worker.
+*/
+
+const TTL = parseFloat(process.env.CACHE_TTL || 5) // seconds
+const MAX_BYTES = parseInt(process.env.CACHE_MAX_BYTES || 64 * 1024 * 1024)
+
+// The versions restart from 0 with the process (with the primary in a cluster)
+const boot = process.env.CLUSTER_BOOT || crypto.randomBytes(4).toString('hex')
+let version = parseInt(process.env.CACHE_VERSION || 0)
+let pending = 0 // bumps of this worker that the primary has not broadcast yet
+
+// Least recently used first: a Map iterates in insertion order and a hit is moved to the end
+class LRUCache {
+    constructor(max_bytes, ttl) {
+        this.max_bytes = max_bytes
+        this.ttl = ttl
+        this.entries = new Map()
+        this.bytes = 0
+    }
+
+    get(key) {
+        const entry = this.entries.get(key)
+        if (entry === undefined) {
+            return undefined
+        }
+        this.entries.delete(key)
+        if (entry.expires < clock.now()) {
+            this.bytes -= entry.body.length
+            return undefined
+        }
+        this.entries.set(key, entry)
+        return entry
+    }
+
+    set(key, entry) {
+        // One response may not push out most of the others
+        if (entry.body.length > this.max_bytes / 8) {
+            return
+        }
+        this.delete(key)
+        entry.expires = clock.now() + this.ttl
+        this.entries.set(key, entry)
+        this.bytes += entry.body.length
+        while (this.bytes > this.max_bytes) {
+            this.delete(this.entries.keys().next().value)
+        }
+    }
+
+    delete(key) {
+        const entry = this.entries.get(key)
+        if (entry !== undefined) {
+            this.entries.delete(key)
+            this.bytes -= entry.body.length
+        }
+    }
+
+    clear() {
+        this.entries.clear()
+        this.bytes = 0
+    }
+}
+
+const responses = new LRUCache(MAX_BYTES, TTL)
+const stats = { hits: 0, misses: 0, not_modified: 0 }
+
+// The auctions have changed, every cached listing is out of date
+function bump() {
+    responses.clear()
+    if (bus.clustered) {
+        pending++
+        bus.send('cache-bump')
+    } else {
+        version++
+    }
+}
+
+bus.on('cache-version', data => {
+    responses.clear()
+    version = Math.max(version, data.version)
+    if (data.origin === bus.id) {
+        pending--
+    }
+})
+
+const etag = key => 'W/"' + boot + '-' + version + '-' +
+    crypto.createHash('sha256').update(key).digest('hex').slice(0, 16) + '"'
+
+/*
+Express middleware that answers a listing from the cache, or records the
+response of the route (streamed or not) for the next request. Listings that
+depend on the logged user are cached per user. NDJSON exports are not cached,
+and a request with Cache-Control: no-cache always reaches the database.
+*/
+function cached(options = {}) {
+    return (req, res, next) => {
+        const query = { ...req.query, ...req.body }
+        if (query.format === "ndjson" || pending > 0 || /no-cache/.test(req.get('Cache-Control') || "")) {
+            return next()
+        }
+        const started = version
+        const key = (options.per_user ? req.user._id : "") + " " + req.originalUrl + " " + JSON.stringify(req.body || {})
+        const tag = etag(key)
+        if (options.per_user) {
+            res.vary('auth-token')
+        }
+
+        if (req.get('If-None-Match') === tag) {
+            stats.not_modified++
+            res.set('ETag', tag)
+            res.set('X-Cache', 'HIT')
+            return res.status(304).end()
+        }
+        const entry = responses.get(key)
+        if (entry !== undefined) {
+            stats.hits++
+            res.set('ETag', tag)
+            res.set('X-Cache', 'HIT')
+            return res.type(entry.type).send(entry.body)
+        }
+
+        stats.misses++
+        res.set('X-Cache', 'MISS')
+        const chunks = []
+        const write = res.write, end = res.end
+        // The ETag goes out with the headers, and only on a listing (not on a validation error)
+        const tagged = () => {
+            if (!res.headersSent && res.statusCode === 200) {
+                res.set('ETag', tag)
+            }
+        }
+        res.write = function (chunk, ...args) {
+            tagged()
+            chunks.push(Buffer.from(chunk))
+            return write.call(this, chunk, ...args)
+        }
+        res.end = function (chunk, ...args) {
+            tagged()
+            if (chunk !== undefined && typeof chunk !== 'function') {
+                chunks.push(Buffer.from(chunk))
+            }
+            // Only a complete answer to the version it was read from
+            if (res.statusCode === 200 && version === started && pending === 0) {
+                responses.set(key, { type: res.get('Content-Type'), body: Buffer.concat(chunks) })
+            }
+            return end.call(this, chunk, ...args)
+        }
+        next()
+    }
+}
+
+// When the test clock jumps forward the listings filtered by time change, in a
+// cluster every worker moves its clock and the leader bumps the version once
+clock.on('advance', () => bus.leader ? bump() : responses.clear())
+
+module.exports.cached = cached
+module.exports.bump = bump
+module.exports.stats = stats
+module.exports.LRUCache = LRUCache
@@ -0,0 +1,53 @@
+const EventEmitter = require('events')
+const moment = require('moment')
+const bus = require('./bus')
+
+/*
+The one clock of the server, everything that reads the time goes through it.
+It is the wall clock plus an offset that is always zero, unless the server is
+started with TEST_CLOCK=true. Then the tests can move it forward through
+/api/test/clock, so auctions expire without waiting for them in real time.
+In a cluster the primary keeps the offset: a worker asks it to move the clock
+and every worker, the one that asked included, follows the new offset.
+*/
+const clock = new EventEmitter()
+clock.enabled = process.env.TEST_CLOCK === 'true'
+
+let offset = clock.enabled ? parseFloat(process.env.CLOCK_OFFSET || 0) : 0 // seconds added to the wall clock
+
+// Current time in seconds, with the milliseconds as decimals
+clock.now = () => Date.now() / 1000 + offset
+
+// Current unix timestamp, as stored in the models
+clock.unix = () => Math.floor(clock.now())
+
+// Current time as a moment, for the date arithmetic
+clock.moment = () => moment(clock.now() * 1000)
+
+// Move the clock forward and let the listeners (e.g. the settlement) catch up,
+// in a cluster it resolves once the primary has moved the clock of the workers
+clock.advance = seconds => {
+    if (!clock.enabled) {
+        throw new Error("The clock can only be moved with TEST_CLOCK=true")
+    }
+    if (bus.clustered) {
+        const moved = new Promise(resolve => bus.once('clock-offset', () => resolve(clock.now())))
+        bus.send('clock-advance', { seconds: seconds })
+        return moved
+    }
+    offset += seconds
+    clock.emit('advance', offset)
+    return clock.now()
+}
+
+// The offset of the cluster has moved, by this worker or by another one
+bus.on('clock-offset', data => {
+    if (data.offset > offset) {
+        offset = data.offset
+        clock.emit('advance', offset)
+    }
+})
+
+clock.offset = () => offset
+
+module.exports = clock
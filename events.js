@@ -0,0 +1,144 @@
+const clock = require('./clock')
+const bus = require('./bus')
+
+/*
+Server-sent events of the auctions, so that nobody has to poll the listings
+to follow them. A subscriber listens to one auction, or to the global channel
+that gets the events of every auction:
+
+    bid-accepted    a bid was placed (auction_id, user, bid, seq, date)
+    outbid          the highest bidder was outbid (auction_id, user who was
+                    outbid, bid that beat them)
+    auction-closed  the settlement closed the auction (auction_id, winner_id,
+                    final_price, closed_at)
+
+A new stream starts with a subscribed event (auction_id, null on the global
+channel), after it the subscriber gets every event of its channel.
+
+An event is serialized once and the same buffer is written to every
+subscriber, so the fan-out cost is one socket write per subscriber. A
+subscriber that does not read fast enough to keep its backlog under
+EVENTS_MAX_BUFFER bytes is disconnected, rather than buffering for it without
+bound, and it can reconnect. A comment is sent every EVENTS_HEARTBEAT seconds
+to keep idle connections open through proxies.
+
+The events go through the bus, so in a cluster a subscriber gets the events
+published by every worker, and the event ids are the cluster-wide sequence.
+*/
+
+const MAX_BUFFER = parseInt(process.env.EVENTS_MAX_BUFFER || 1024 * 1024) // bytes
+const HEARTBEAT = parseFloat(process.env.EVENTS_HEARTBEAT || 15) // seconds
+const GLOBAL = "*"
+
+const channels = new Map() // channel (auction id or GLOBAL) => Set of responses
+let heartbeat = null
+
+function write(subscribers, buffer) {
+    for (const res of subscribers) {
+        // Ending the stream would queue behind the backlog, destroying it frees the backlog and unsubscribes
+        if (res.writableLength > MAX_BUFFER) {
+            res.destroy()
+            continue
+        }
+        res.write(buffer)
+    }
+}
+
+function unsubscribe(channel, res) {
+    const subscribers = channels.get(channel)
+    if (subscribers === undefined) {
+        return
+    }
+    subscribers.delete(res)
+    if (subscribers.size === 0) {
+        channels.delete(channel)
+    }
+    if (channels.size === 0) {
+        clearInterval(heartbeat)
+        heartbeat = null
+    }
+}
+
+// Turn the response into an event stream of the channel until the client goes away
+function subscribe(req, res, channel = GLOBAL) {
+    req.socket.setTimeout(0)
+    req.socket.setNoDelay(true)
+    res.set({
+        'Content-Type': 'text/event-stream',
+        'Cache-Control': 'no-cache',
+        'Connection': 'keep-alive',
+        'X-Accel-Buffering': 'no'
+    })
+    res.flushHeaders()
+    res.write("event: subscribed\ndata: " + JSON.stringify({ auction_id: channel === GLOBAL ? null : channel }) + "\n\n")
+
+    if (!channels.has(channel)) {
+        channels.set(channel, new Set())
+    }
+    channels.get(channel).add(res)
+    if (heartbeat === null) {
+        heartbeat = setInterval(() => {
+            const ping = Buffer.from(": " + clock.now() + "\n\n")
+            for (const subscribers of channels.values()) {
+                write(subscribers, ping)
+            }
+        }, HEARTBEAT * 1000)
+        heartbeat.unref()
+    }
+    res.on('close', () => unsubscribe(channel, res))
+}
+
+// Send an event of an auction to its subscribers and to the global ones, on every worker
+function publish(auction_id, event, data) {
+    bus.send('event', { auction_id: String(auction_id), event: event, data: data })
+}
+
+function deliver(message, sequence) {
+    const auction_id = message.auction_id
+    const auction = channels.get(auction_id), everyone = channels.get(GLOBAL)
+    if (auction === undefined && everyone === undefined) {
+        return
+    }
+    const buffer = Buffer.from(
+        "id: " + sequence + "\nevent: " + message.event + "\ndata: " + JSON.stringify({ auction_id, ...message.data }) + "\n\n"
+    )
+    if (auction !== undefined) {
+        write(auction, buffer)
+    }
+    if (everyone !== undefined) {
+        write(everyone, buffer)
+    }
+}
+
+bus.on('event', deliver)
+
+// Whether anybody listens to the auction (or to any auction, without an id), in
+// a cluster the subscribers may be on another worker
+function listening(auction_id) {
+    return bus.clustered || channels.has(GLOBAL) || (auction_id === undefined ? channels.size > 0 : channels.has(String(auction_id)))
+}
+
+// How many subscribers there are on every channel
+function subscribers() {
+    let count = 0
+    for (const each of channels.values()) {
+        count += each.size
+    }
+    return count
+}
+
+// End every stream, the clients reconnect to another worker
+function close() {
+    for (const subscribers of [...channels.values()]) {
+        for (const res of [...subscribers]) {
+            res.end()
+        }
+    }
+}
+
+module.exports.subscribe = subscribe
+module.exports.publish = publish
+module.exports.listening = listening
+module.exports.subscribers = subscribers
+module.exports.close = close
+module.exports.GLOBAL = GLOBAL
@@ -0,0 +1,77 @@
+const { monitorEventLoopDelay } = require('perf_hooks')
+const bus = require('./bus')
+const events = require('./events')
+const passwords = require('./passwords')
+
+/*
+Health of this process: the requests in flight and served, the memory and the
+event loop delay of the last HEALTH_INTERVAL seconds at most. A worker of a cluster reports it to the primary every
+HEALTH_INTERVAL seconds, and the primary shares the reports of all the workers
+with every worker, so /api/health answers for the whole cluster from any of
+them.
+*/
+
+const INTERVAL = parseFloat(process.env.HEALTH_INTERVAL || 2) // seconds
+
+const started = Date.now()
+const requests = { in_flight: 0, served: 0 }
+const lag = monitorEventLoopDelay({ resolution: 10 })
+lag.enable()
+let workers = [] // the last reports of the cluster, from the primary
+
+// Express middleware counting the requests
+function track(req, res, next) {
+    requests.in_flight++
+    res.once('close', () => {
+        requests.in_flight--
+        requests.served++
+    })
+    next()
+}
+
+function report() {
+    const memory = process.memoryUsage()
+    return {
+        pid: process.pid,
+        worker: bus.id,
+        leader: bus.leader,
+        uptime: (Date.now() - started) / 1000,
+        in_flight: requests.in_flight,
+        served: requests.served,
+        subscribers: events.subscribers(),
+        passwords: passwords.stats(),
+        rss: memory.rss,
+        heap_used: memory.heapUsed,
+        event_loop_lag: {
+            mean: lag.mean / 1e6,
+            p50: lag.percentile(50) / 1e6,
+            p99: lag.percentile(99) / 1e6,
+            max: lag.max / 1e6
+        }
+    }
+}
+
+// The reports of every worker, or of this process alone without a cluster
+function cluster() {
+    return bus.clustered ? workers : [report()]
+}
+
+// Every HEALTH_INTERVAL the event loop delay starts over, with or without a cluster, so a spike passes
+function send() {
+    if (bus.clustered && process.connected) {
+        process.send({ health: report() })
+    }
+    lag.reset()
+}
+
+if (bus.clustered) {
+    bus.on('health', reports => {
+        workers = reports
+    })
+    send()
+}
+setInterval(send, INTERVAL * 1000).unref()
+
+module.exports.track = track
+module.exports.report = report
+module.exports.cluster = cluster
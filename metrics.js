@@ -0,0 +1,345 @@
+const { AsyncLocalStorage } = require('async_hooks')
+const express = require('express')
+const bus = require('./bus')
+const cache = require('./cache')
+const health = require('./health')
+
+/*
+Instrumentation of the request path, served in the Prometheus text format at
+/api/metrics:
+
+    http_request_duration_seconds   latency per method, route and status
+    http_request_stage_seconds      time per route spent in each stage of the
+                                    requests: validate (joi), auth (the token),
+                                    db (mongoose queries) and serialize (JSON)
+    mongo_query_duration_seconds    every mongoose query, save and aggregate,
+                                    the listing cursors and the bulk inserts
+                                    per model and operation, the _count of the
+                                    histogram is the number of queries
+    nodejs_eventloop_lag_seconds    the quantiles of the event loop delay since
+                                    it last started over (every HEALTH_INTERVAL
+                                    seconds, health.js), as a summary, and
+                                    its mean in nodejs_eventloop_lag_mean_seconds
+    http_requests_in_flight, the memory, the listing cache, the event
+    subscribers and the password threads, as gauges and counters.
+
+Every request runs in an AsyncLocalStorage context, so a stage timed anywhere
+down the call chain (a validator, a query hook) is added to the request that
+caused it, without passing the request around. Concurrent queries of one
+request all count, the db stage can be longer than the request.
+
+In a cluster every worker has its own metrics and answers the scrapes that it
+takes, the cluster_worker gauge tells which one. METRICS=false turns the
+instrumentation off.
+*/
+
+const ENABLED = process.env.METRICS !== 'false'
+const BUCKETS = [0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10] // seconds
+
+const storage = new AsyncLocalStorage()
+
+const escape = value => String(value).replace(/\\/g, '\\\\').replace(/"/g, '\\"').replace(/\n/g, '\\n')
+
+const labelled = (names, values) => names.length === 0
+    ? ""
+    : "{" + names.map((name, i) => name + '="' + escape(values[i]) + '"').join(",") + "}"
+
+// A histogram with one series per combination of label values
+class Histogram {
+    constructor(name, help, labels, buckets = BUCKETS) {
+        this.name = name
+        this.help = help
+        this.labels = labels
+        this.buckets = buckets
+        this.series = new Map()
+    }
+
+    observe(values, seconds) {
+        const key = values.join("\u0000")
+        let series = this.series.get(key)
+        if (series === undefined) {
+            series = { values: values, counts: new Array(this.buckets.length).fill(0), sum: 0, count: 0 }
+            this.series.set(key, series)
+        }
+        let i = 0
+        while (i < this.buckets.length && seconds > this.buckets[i]) {
+            i++
+        }
+        if (i < this.buckets.length) {
+            series.counts[i]++
+        }
+        series.sum += seconds
+        series.count++
+    }
+
+    render(lines) {
+        lines.push("# HELP " + this.name + " " + this.help, "# TYPE " + this.name + " histogram")
+        const names = [...this.labels, "le"]
+        for (const series of this.series.values()) {
+            let cumulative = 0
+            this.buckets.forEach((bucket, i) => {
+                cumulative += series.counts[i]
+                lines.push(this.name + "_bucket" + labelled(names, [...series.values, bucket]) + " " + cumulative)
+            })
+            lines.push(this.name + "_bucket" + labelled(names, [...series.values, "+Inf"]) + " " + series.count)
+            lines.push(this.name + "_sum" + labelled(this.labels, series.values) + " " + series.sum)
+            lines.push(this.name + "_count" + labelled(this.labels, series.values) + " " + series.count)
+        }
+    }
+}
+
+// A counter or a gauge, with one value per combination of label values
+class Metric {
+    constructor(name, help, type, labels = []) {
+        this.name = name
+        this.help = help
+        this.type = type
+        this.labels = labels
+        this.values = new Map()
+    }
+
+    inc(values = [], by = 1) {
+        const key = values.join("\u0000")
+        const current = this.values.get(key)
+        this.values.set(key, { values: values, value: (current === undefined ? 0 : current.value) + by })
+    }
+
+    set(values, value) {
+        this.values.set(values.join("\u0000"), { values: values, value: value })
+    }
+
+    render(lines) {
+        lines.push("# HELP " + this.name + " " + this.help, "# TYPE " + this.name + " " + this.type)
+        for (const each of this.values.values()) {
+            lines.push(this.name + labelled(this.labels, each.values) + " " + each.value)
+        }
+    }
+}
+
+const requests = new Histogram(
+    "http_request_duration_seconds", "Latency of the requests", ["method", "route", "status"]
+)
+const stages = new Histogram(
+    "http_request_stage_seconds", "Time of the requests in each stage", ["route", "stage"]
+)
+const queries = new Histogram(
+    "mongo_query_duration_seconds", "Latency of the database operations", ["model", "op"]
+)
+const query_errors = new Metric(
+    "mongo_query_errors_total", "Database operations that failed", "counter", ["model", "op"]
+)
+
+const seconds_since = started => Number(process.hrtime.bigint() - started) / 1e9
+
+// Add time to a stage of the current request, if there is one
+function add(stage, seconds) {
+    const context = storage.getStore()
+    if (context !== undefined) {
+        context.stages[stage] = (context.stages[stage] || 0) + seconds
+    }
+}
+
+// Run fn as a stage of the current request and return what it returns
+function stage(name, fn) {
+    if (!ENABLED) {
+        return fn()
+    }
+    const started = process.hrtime.bigint()
+    try {
+        return fn()
+    } finally {
+        add(name, seconds_since(started))
+    }
+}
+
+// The same function, timed as a stage
+const timed = (name, fn) => (...args) => stage(name, () => fn(...args))
+
+// Express middleware that times the request and gives it the context of its stages
+function track(req, res, next) {
+    if (!ENABLED) {
+        return next()
+    }
+    const started = process.hrtime.bigint()
+    const context = { stages: {} }
+    res.once('finish', () => {
+        const route = req.route ? req.baseUrl + req.route.path : "unmatched"
+        requests.observe([req.method, route, res.statusCode], seconds_since(started))
+        for (const name in context.stages) {
+            stages.observe([route, name], context.stages[name])
+        }
+    })
+    storage.run(context, next)
+}
+
+function query_done(model, op, started) {
+    const seconds = seconds_since(started)
+    queries.observe([model, op], seconds)
+    add("db", seconds)
+}
+
+function query_failed(model, op, started) {
+    query_errors.inc([model, op])
+    query_done(model, op, started)
+}
+
+// Run a database operation that the plugin does not see (e.g. on the raw collection) as a query of the model
+async function query(model, op, fn) {
+    if (!ENABLED) {
+        return fn()
+    }
+    const started = process.hrtime.bigint()
+    try {
+        const result = await fn()
+        query_done(model.modelName, op, started)
+        return result
+    } catch (error) {
+        query_failed(model.modelName, op, started)
+        throw error
+    }
+}
+
+/*
+The documents of a query cursor of the model, the time spent waiting on the
+database for them is timed as one query. A cursor runs the pre hooks of find
+but never the post ones, so the plugin does not see it, and the time between
+the documents is the caller's (serializing and writing them).
+*/
+async function* cursor(records, model, op = "find") {
+    if (!ENABLED) {
+        return yield* records
+    }
+    let seconds = 0, failed = false
+    try {
+        while (true) {
+            const started = process.hrtime.bigint()
+            let record
+            try {
+                record = await records.next()
+            } catch (error) {
+                failed = true
+                throw error
+            } finally {
+                seconds += seconds_since(started)
+            }
+            if (record === null) {
+                return
+            }
+            yield record
+        }
+    } finally {
+        if (failed) {
+            query_errors.inc([model.modelName, op])
+        }
+        queries.observe([model.modelName, op], seconds)
+        add("db", seconds)
+    }
+}
+
+const QUERY_OPS = [
+    "count", "countDocuments", "estimatedDocumentCount", "distinct", "find", "findOne", "findOneAndDelete",
+    "findOneAndRemove", "findOneAndReplace", "findOneAndUpdate", "deleteMany", "deleteOne", "replaceOne",
+    "updateMany", "updateOne"
+]
+
+// Mongoose plugin timing the queries, saves and aggregations of every model
+function plugin(schema) {
+    if (!ENABLED) {
+        return
+    }
+    schema.pre(QUERY_OPS, function () {
+        this._metrics_started = process.hrtime.bigint()
+    })
+    schema.post(QUERY_OPS, function () {
+        if (this._metrics_started !== undefined) {
+            query_done(this.model.modelName, this.op, this._metrics_started)
+        }
+    })
+    schema.post(QUERY_OPS, function (error, result, next) {
+        if (this._metrics_started !== undefined) {
+            query_failed(this.model.modelName, this.op, this._metrics_started)
+        }
+        next(error)
+    })
+
+    schema.pre("aggregate", function () {
+        this._metrics_started = process.hrtime.bigint()
+    })
+    schema.post("aggregate", function () {
+        query_done(this._model.modelName, "aggregate", this._metrics_started)
+    })
+    schema.post("aggregate", function (error, result, next) {
+        query_failed(this._model.modelName, "aggregate", this._metrics_started)
+        next(error)
+    })
+
+    schema.pre("save", function () {
+        this.$locals.metrics_started = process.hrtime.bigint()
+    })
+    schema.post("save", function () {
+        query_done(this.constructor.modelName, "save", this.$locals.metrics_started)
+    })
+    schema.post("save", function (error, document, next) {
+        query_failed(this.constructor.modelName, "save", this.$locals.metrics_started)
+        next(error)
+    })
+}
+
+// The JSON responses, JSON.stringify is most of their cost
+if (ENABLED) {
+    const json = express.response.json
+    express.response.json = function (body) {
+        return stage("serialize", () => json.call(this, body))
+    }
+}
+
+// Every metric of the process in the Prometheus text format
+function render() {
+    const report = health.report()
+    const gauge = (name, help, labels, entries, type = "gauge") => {
+        const metric = new Metric(name, help, type, labels)
+        for (const [values, value] of entries) {
+            metric.set(values, value)
+        }
+        metric.render(lines)
+    }
+    const lines = []
+    requests.render(lines)
+    stages.render(lines)
+    queries.render(lines)
+    query_errors.render(lines)
+    gauge("http_requests_in_flight", "Requests being served", [], [[[], report.in_flight]])
+    // The quantiles of the delay of the last HEALTH_INTERVAL at most, without _sum and _count, which restart with it
+    gauge("nodejs_eventloop_lag_seconds", "Event loop delay of the last health interval", ["quantile"], [
+        [["0.5"], report.event_loop_lag.p50 / 1000],
+        [["0.99"], report.event_loop_lag.p99 / 1000],
+        [["1"], report.event_loop_lag.max / 1000]
+    ], "summary")
+    gauge("nodejs_eventloop_lag_mean_seconds", "Mean event loop delay of the last health interval", [], [[[], report.event_loop_lag.mean / 1000]])
+    gauge("process_resident_memory_bytes", "Resident memory", [], [[[], report.rss]])
+    gauge("nodejs_heap_used_bytes", "Used V8 heap", [], [[[], report.heap_used]])
+    gauge("events_subscribers", "Open event streams", [], [[[], report.subscribers]])
+    gauge("password_threads", "Password threads by state, and the jobs waiting for one", ["state"], [
+        [["busy"], report.passwords.busy],
+        [["idle"], report.passwords.threads - report.passwords.busy],
+        [["queued"], report.passwords.queued]
+    ])
+    const cached = new Metric("listing_cache_requests_total", "Listing requests by cache result", "counter", ["result"])
+    for (const result in cache.stats) {
+        cached.set([result], cache.stats[result])
+    }
+    cached.render(lines)
+    gauge("cluster_worker", "The worker that answered the scrape", ["worker", "leader"], [
+        [[bus.id, bus.leader], 1]
+    ])
+    return lines.join("\n") + "\n"
+}
+
+module.exports.track = track
+module.exports.stage = stage
+module.exports.timed = timed
+module.exports.plugin = plugin
+module.exports.query = query
+module.exports.cursor = cursor
+module.exports.render = render
+module.exports.Histogram = Histogram
@@ -0,0 +1,145 @@
+const Auction = require('./models/Auction')
+const Bid = require('./models/Bid')
+
+/*
+Bring the documents written by older versions of the app up to date. Each
+migration only touches the documents that still miss its fields, so running
+all of them on every start is cheap and idempotent.
+*/
+
+// Denormalize the highest bid, its bidder and the number of bids out of the bids array
+async function backfill_highest_bid() {
+    const bids = { $ifNull: ["$bids", []] }
+    const highest = { $max: "$bids.bid" }
+    return Auction.updateMany(
+        { highest_bid: { $exists: false } },
+        [{
+            $set: {
+                highest_bid: { $ifNull: [highest, 0] },
+                highest_bidder: {
+                    $ifNull: [{ $arrayElemAt: ["$bids.user", { $indexOfArray: ["$bids.bid", highest] }] }, null]
+                },
+                bid_count: { $size: bids }
+            }
+        }]
+    )
+}
+
+// Mark the auctions as open, the settlement closes the expired ones on start
+async function backfill_closed() {
+    return Auction.updateMany(
+        { closed: { $exists: false } },
+        { $set: { closed: false, closed_at: null, winner_id: null, final_price: null } }
+    )
+}
+
+// Move the embedded bids arrays to the bids collection, the auctions keep only the latest ones
+async function move_bids() {
+    const embedded = { bids: { $exists: true } }
+    await Bid.init() // the unique (auction_id, seq) index makes the copy idempotent
+    await Auction.aggregate([
+        { $match: embedded },
+        { $unwind: { path: "$bids", includeArrayIndex: "index" } },
+        {
+            $project: {
+                _id: 0,
+                auction_id: "$_id",
+                user: "$bids.user",
+                bid: "$bids.bid",
+                date: { $ifNull: ["$bids.date", null] },
+                seq: { $add: ["$index", 1] }
+            }
+        },
+        { $merge: { into: Bid.collection.name, on: ["auction_id", "seq"], whenMatched: "keepExisting" } }
+    ])
+    return Auction.updateMany(
+        embedded,
+        [
+            { $set: { last_bids: { $slice: [{ $ifNull: ["$bids", []] }, -Auction.LAST_BIDS] } } },
+            { $unset: "bids" }
+        ]
+    )
+}
+
+/*
+Fingerprint the items listed before the unique (seller_id, fingerprint) index,
+in the order they were listed. When a seller had listed the same item more than
+once, the first listing gets the fingerprint and the later ones null, which the
+index leaves out, so the data that was there is kept as it is.
+*/
+async function backfill_fingerprint() {
+    await Auction.init() // the unique index, the later duplicates collide with the first listing
+    const BATCH = 1000
+    let modified = 0, batch = []
+
+    const flush = async () => {
+        const seen = new Set(), writes = [], duplicates = []
+        for (const auction of batch) {
+            const fingerprint = Auction.fingerprint(auction.item || {})
+            const key = auction.seller_id + " " + fingerprint
+            if (seen.has(key)) {
+                duplicates.push(auction._id)
+                continue
+            }
+            seen.add(key)
+            writes.push({ _id: auction._id, fingerprint: fingerprint })
+        }
+        let failed = []
+        try {
+            await Auction.bulkWrite(writes.map(each => ({
+                updateOne: {
+                    filter: { _id: each._id, fingerprint: { $exists: false } },
+                    update: { $set: { fingerprint: each.fingerprint } }
+                }
+            })), { ordered: false })
+        } catch (error) {
+            failed = [].concat(error.writeErrors || [])
+            if (failed.length === 0 || failed.some(each => each.code !== 11000)) {
+                throw error
+            }
+        }
+        duplicates.push(...failed.map(each => writes[each.index]._id))
+        if (duplicates.length > 0) {
+            await Auction.updateMany({ _id: { $in: duplicates } }, { $set: { fingerprint: null } })
+        }
+        modified += batch.length
+        batch = []
+    }
+
+    const legacy = Auction.find({ fingerprint: { $exists: false } })
+        .select('seller_id item')
+        .sort({ _id: 1 })
+        .lean()
+        .cursor({ batchSize: BATCH })
+    for await (const auction of legacy) {
+        batch.push(auction)
+        if (batch.length === BATCH) {
+            await flush()
+        }
+    }
+    if (batch.length > 0) {
+        await flush()
+    }
+    return { modifiedCount: modified }
+}
+
+// The price to beat of the search, the starting price or the highest bid if there is one
+async function backfill_current_price() {
+    return Auction.updateMany(
+        { current_price: { $exists: false } },
+        [{ $set: { current_price: { $max: ["$starting_price", "$highest_bid"] } } }]
+    )
+}
+
+const migrations = [
+    backfill_highest_bid, backfill_closed, move_bids, backfill_fingerprint, backfill_current_price
+]
+
+async function run() {
+    for (const migration of migrations) {
+        const result = await migration()
+        console.log("Migration " + migration.name + ": " + result.modifiedCount + " documents updated")
+    }
+}
+
+module.exports.run = run
@@ -1,6 +1,16 @@
+const crypto = require('crypto')
 const mongoose = require('mongoose')
 const Item = require('../models/Item')
-const moment = require('moment')
+const clock = require('../clock')
+
+// The content of an item as one short string, the same item of a seller is listed once
+const fingerprint = item => crypto.createHash('sha256')
+    .update(JSON.stringify([item.title, item.condition, item.description]))
+    .digest('hex')
+
+// How many of the latest bids an auction keeps, the full history is in the bids collection (models/Bid.js)
+const LAST_BIDS = 10
+
 const AuctionModel = mongoose.Schema({
     starting_price:{
         type: Number,
@@ -8,16 +18,56 @@ const AuctionModel = mongoose.Schema({
     },
     reg_date:{
         type: Number,
-        default: moment().unix()
+        default: () => clock.unix()
     },
     exp_date:{
          type: Number,
          required:true, 
     },
-    bids:{
-        type: Array,
+    // Denormalized from the bids so that placing a bid is a single conditional update
+    highest_bid:{
+        type: Number,
+        default: 0
+    },
+    // The price to beat, the starting price until the first bid and then the highest bid, for the search
+    current_price:{
+        type: Number
+    },
+    highest_bidder:{
+        type: String,
+        default: null
+    },
+    bid_count:{
+        type: Number,
+        default: 0
+    },
+    // The LAST_BIDS latest bids, oldest first, so listings never carry the whole history
+    last_bids:{
+        type: [{
+            _id: false,
+            user: String,
+            bid: Number,
+            date: Number
+        }],
         default: []
     },
+    // Written once by the settlement when the auction expires
+    closed:{
+        type: Boolean,
+        default: false
+    },
+    closed_at:{
+        type: Number,
+        default: null
+    },
+    winner_id:{
+        type: String,
+        default: null
+    },
+    final_price:{
+        type: Number,
+        default: null
+    },
     seller_id:{
         type: String
     },
@@ -25,7 +75,68 @@ const AuctionModel = mongoose.Schema({
         type: String
     },
     item: Item.schema.obj,
+    // sha256 of the item, null on the duplicates listed before it was enforced
+    fingerprint:{
+        type: String
+    },
+
+})
 
+AuctionModel.pre('validate', function () {
+    if (this.isNew || this.isModified('item')) {
+        this.fingerprint = fingerprint(this.item)
+    }
+    if (this.isNew) {
+        this.current_price = Math.max(this.starting_price, this.highest_bid)
+    }
 })
 
-module.exports = mongoose.model('Auction', AuctionModel)
\ No newline at end of file
+// Pagination order and keyset cursor
+AuctionModel.index({exp_date: 1, _id: 1})
+
+// Upcoming expirations for the settlement
+AuctionModel.index({closed: 1, exp_date: 1})
+
+// A seller's auctions in the pagination order, for the search
+AuctionModel.index({seller_id: 1, exp_date: 1, _id: 1})
+
+/*
+User history (sold and won) of the settled auctions, in the pagination order.
+The indexes only hold the closed auctions (sold only the ones with a winner),
+so each history costs O(user's own settled auctions) and the open auctions do
+not grow them. The lost history starts from the user's bids (models/Bid.js).
+*/
+const settled = {partialFilterExpression: {closed: true}}
+AuctionModel.index(
+    {seller_id: 1, closed: 1, exp_date: 1, _id: 1},
+    {partialFilterExpression: {closed: true, winner_id: {$type: "string"}}}
+)
+AuctionModel.index({winner_id: 1, closed: 1, exp_date: 1, _id: 1}, settled)
+
+/*
+Search over the open auctions (auction/search), the closed ones are left out of
+these indexes so that they only grow with the live auctions. The text index
+finds the words of the items, the others follow the sort orders of the search,
+led by the condition of the item for the searches filtered by it. The price
+range is read off the current_price order, a seller's auctions off the seller
+index above.
+*/
+const open = {partialFilterExpression: {closed: false}}
+AuctionModel.index(
+    {"item.title": "text", "item.description": "text"},
+    {...open, weights: {"item.title": 3, "item.description": 1}, name: "item_text"}
+)
+AuctionModel.index({"item.condition": 1, exp_date: 1, _id: 1}, open)
+AuctionModel.index({current_price: -1, _id: -1}, open)
+AuctionModel.index({"item.condition": 1, current_price: -1, _id: -1}, open)
+AuctionModel.index({"item.condition": 1, _id: -1}, open)
+
+// Duplicate listings, a seller can not list the same item twice: the insert itself is the check
+AuctionModel.index(
+    {seller_id: 1, fingerprint: 1},
+    {unique: true, partialFilterExpression: {fingerprint: {$type: "string"}}}
+)
+
+module.exports = mongoose.model('Auction', AuctionModel)
+module.exports.LAST_BIDS = LAST_BIDS
+module.exports.fingerprint = fingerprint
\ No newline at end of file
@@ -0,0 +1,33 @@
+const mongoose = require('mongoose')
+const BidModel = mongoose.Schema({
+    auction_id:{
+        type: mongoose.Schema.Types.ObjectId,
+        required: true
+    },
+    user:{
+        type: String,
+        required: true
+    },
+    bid:{
+        type: Number,
+        required: true
+    },
+    // Server time when the bid was placed, with the milliseconds as decimals
+    date:{
+        type: Number,
+        default: null
+    },
+    // Position of the bid in its auction (1 is the first bid), the bid_count right after it was accepted
+    seq:{
+        type: Number,
+        required: true
+    },
+}, { versionKey: false })
+
+// Bid history of an auction, newest first, and no two bids can take the same position
+BidModel.index({auction_id: 1, seq: 1}, {unique: true})
+
+// The auctions a user has bid on, for the lost history
+BidModel.index({user: 1, auction_id: 1})
+
+module.exports = mongoose.model('Bid', BidModel)
@@ -1,5 +1,5 @@
 const mongoose = require('mongoose')
-const moment = require('moment')
+const clock = require('../clock')
 
 const UserModel = mongoose.Schema({
     name:{
@@ -29,7 +29,7 @@ const UserModel = mongoose.Schema({
     },
     registered_on:{
         type: Number,
-         default: moment().unix()
+        default: () => clock.unix()
     }
 })
 
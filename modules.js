@@ -1,5 +1,8 @@
 const jsonwebtoken = require('jsonwebtoken')
+const mongoose = require('mongoose')
 const {pagiValidation} = require('./validators')
+const Auction = require('./models/Auction')
+const metrics = require('./metrics')
 
 //Get all bids made to the item. Expects item 
 const get_bids = bids => {  
@@ -7,35 +10,181 @@ const get_bids = bids => {
     for (let i = 0; i < bids.length; i++) {
         bidding.push(parseFloat(bids[i].bid))
     }
-    return bidding.sort()
+    return bidding.sort((a, b) => a - b)
 }
 
-//Wrap the results in a pagination
-async function pagination (req, res, array){
-    const {error} = pagiValidation(req.body)
+//Keyset order of the paginated collections: the auctions by expiration and the bids of an auction newest first.
+//The bid seq is unique within an auction, so it needs no _id to break the ties.
+const orders = {
+    Auction: {key: "exp_date", direction: 1, unique: false},
+    Bid: {key: "seq", direction: -1, unique: true}
+}
+
+//The orders of the auction search (?sort=), each one has an index (models/Auction.js)
+const search_orders = {
+    ending: orders.Auction,
+    highest_bid: {key: "current_price", direction: -1, unique: false},
+    newest: {key: "_id", direction: -1, unique: true}
+}
+
+//The keyset cursor is the sort key (e.g. exp_date, _id) of the last record on the page
+const encode_cursor = (record, order) => {
+    return Buffer.from(JSON.stringify([record[order.key], String(record._id)])).toString('base64url')
+}
+
+//Returns a filter that selects the records after the cursor, or null if the cursor is not valid
+const after_cursor = (cursor, order) => {
+    try {
+        const [value, id] = JSON.parse(Buffer.from(cursor, 'base64url').toString())
+        if (!mongoose.Types.ObjectId.isValid(id)) {
+            return null
+        }
+        const after = order.direction > 0 ? "$gt" : "$lt"
+        const _id = new mongoose.Types.ObjectId(id)
+        if (order.key === "_id") {
+            return {_id: {[after]: _id}}
+        }
+        if (typeof value !== 'number') {
+            return null
+        }
+        if (order.unique) {
+            return {[order.key]: {[after]: value}}
+        }
+        return {$or: [{[order.key]: {[after]: value}}, {[order.key]: value, _id: {[after]: _id}}]}
+    } catch {
+        return null
+    }
+}
+
+//Count the records without reading them, the whole collection count comes from the metadata
+const count_records = (model, filter) => {
+    return Object.keys(filter).length === 0 ? model.estimatedDocumentCount() : model.countDocuments(filter)
+}
+
+//Named sets of fields for ?fields=, e.g. the summary of an auction for the listings
+const field_sets = {
+    Auction: {
+        summary: ["starting_price", "exp_date", "highest_bid", "bid_count", "closed", "seller_name", "item.title"]
+    },
+    Bid: {}
+}
+
+//The projection of ?fields= (a named set or a comma separated list), null for every field.
+//The sort key is always included, the next cursor is made of it.
+const projection = (fields, model, order) => {
+    if (fields === undefined) {
+        return null
+    }
+    const sets = field_sets[model.modelName]
+    const selected = Object.hasOwn(sets, fields) ? sets[fields] : fields.split(",")
+    return [...new Set([...selected, order.key])].join(" ")
+}
+
+//Write a chunk and wait for the client to take it when the socket buffer is full
+const write = (res, chunk) => {
+    return res.write(chunk) ? Promise.resolve() : new Promise(resolve => res.once('drain', resolve))
+}
+
+/*
+Query one page of the records (auctions by default) that match the filter and
+wrap it in a pagination. The page is cut by the database, in the keyset order
+of the model, so the cost depends on the page size and not on the number of
+records. Pages are selected either with page/limit (skip) or, for deep pages,
+with the cursor from the previous page metadata (keyset). A null filter is an
+empty result.
+
+The records are read as plain objects (lean), only with the ?fields= asked for,
+and streamed to the client one by one as they come from the database cursor,
+so the server never holds the whole result. With ?format=ndjson every record
+after the cursor (or up to the limit, if there is one) is exported as one JSON
+line, without the pagination metadata.
+
+The options are the order of the records (the keyset order of the model by
+default), the validation of the parameters when the route takes more of them,
+and count: false to leave out the totals, which would cost a scan of all the
+records that match instead of one page of them. When the total is kept
+elsewhere (the bid count of an auction), count is a function that reads it.
+*/
+async function pagination (req, res, filter, model = Auction, options = {}){
+    const query = {...req.query, ...req.body} // Accept the parameters from the query string or the body
+    const {error} = (options.validation || pagiValidation)(query)
     if(error){
         return res.status(400).send({message:error['details'][0]['message']})
     }
-    const check_page = isNaN(req.body.page) || parseInt(req.body.page) < 0 // We expect a positive integer value for page 
-    const page = req.body.page === undefined || check_page ? 1 : parseInt(req.body.page) // Return 1 if false otherways the requested page
-    const limit = req.body.limit === undefined || check_page ? 10 : parseInt(req.body.limit) // Return 10 if false otherways the requested limit
+    const order = options.order || orders[model.modelName]
+    const counted = options.count !== false
+    const ndjson = query.format === "ndjson"
+    const page = query.page === undefined ? 1 : parseInt(query.page)
+    const limit = query.limit === undefined ? (ndjson ? 0 : 10) : parseInt(query.limit)
+    if (filter === null) {
+        filter = {_id: null}
+    }
+    let find = filter
+    if (query.cursor !== undefined) {
+        const after = after_cursor(query.cursor, order)
+        if (after === null) {
+            return res.status(400).send({message: "Invalid cursor"})
+        }
+        find = {$and: [filter, after]}
+    }
+    const sort = order.unique
+        ? {[order.key]: order.direction}
+        : {[order.key]: order.direction, _id: order.direction}
+    // Read one record over the limit to know whether there is a next page (0 is no limit)
+    let query_cursor
     try {
-        start = limit * (page - 1)
-        res.send({
-            message: "Success",
-            data: array.slice(start, start + limit), // start-end 
-            metadata: {
-                current_page: page,
-                current_limit: limit,
-                total_records: array.length,
-                total_pages: Math.ceil(array.length / limit),
-                has_more: page * limit < array.length
+        query_cursor = model.find(find)
+            .select(projection(query.fields, model, order))
+            .sort(sort)
+            .skip(query.cursor === undefined && limit > 0 ? limit * (page - 1) : 0)
+            .limit(limit > 0 && !ndjson ? limit + 1 : limit)
+            .lean()
+            .cursor({batchSize: 1000})
+    } catch {
+        return res.status(400).send({message: "Invalid fields"})
+    }
+    const records = metrics.cursor(query_cursor, model)
+    try {
+        if (ndjson) {
+            res.type('application/x-ndjson')
+            for await (const record of records) {
+                await write(res, metrics.stage("serialize", () => JSON.stringify(record)) + "\n")
             }
-        })
+            return res.end()
+        }
+
+        const total = !counted ? Promise.resolve(null)
+            : typeof options.count === 'function' ? options.count() : count_records(model, filter).exec()
+        total.catch(() => null) // awaited once the page is written, a failure is handled there
+        let count = 0, last = null
+        res.type('json')
+        await write(res, '{"message":"Success","data":[')
+        for await (const record of records) {
+            if (++count > limit) {
+                break
+            }
+            await write(res, (last === null ? "" : ",") + metrics.stage("serialize", () => JSON.stringify(record)))
+            last = record
+        }
+        const has_more = count > limit
+        res.end('],"metadata":' + JSON.stringify({
+            current_page: query.cursor === undefined ? page : null,
+            current_limit: limit,
+            total_records: await total,
+            total_pages: counted ? Math.ceil(await total / limit) : null,
+            has_more: has_more,
+            next_cursor: has_more ? encode_cursor(last, order) : null
+        }) + '}')
     } catch (error) {
+        // Once the listing has started the status can not change any more, cut the response short
+        if (res.headersSent) {
+            return res.destroy(error)
+        }
         res.send({
             message: error
         })
+    } finally {
+        await query_cursor.close()
     }
 }
 
@@ -47,6 +196,29 @@ const get_money = (money, locale = "en-UK", currency = "GBP") => {
     });
 }
 
+/*
+Transactions need a replica set (or a sharded cluster). Whether the database
+has them is read once from its hello answer, on a standalone MongoDB the
+function of a transaction runs without a session (undefined), so its writes
+are not atomic together and it has to keep them safe to repeat.
+*/
+let transactions = null
+const supports_transactions = async () => {
+    if (transactions === null) {
+        const hello = await mongoose.connection.db.admin().command({hello: 1})
+        transactions = hello.setName !== undefined || hello.msg === "isdbgrid"
+    }
+    return transactions
+}
+
+//Run fn(session) in a transaction when the database has them, otherwise fn(undefined)
+async function transaction(fn) {
+    if (await supports_transactions()) {
+        return mongoose.connection.transaction(fn)
+    }
+    return fn(undefined)
+}
+
 // Auth function will veryfy the token and return 
 function auth(req, res, next){
     const  token = req.header('auth-token')
@@ -54,7 +226,7 @@ function auth(req, res, next){
         return res.status(401).send({message: "Not authenticated"})
     }
     try{
-        const verified = jsonwebtoken.verify(token, process.env.TOKEN_SECRET)
+        const verified = metrics.stage("auth", () => jsonwebtoken.verify(token, process.env.TOKEN_SECRET))
         req.user = verified
         next()
     }
@@ -65,5 +237,8 @@ function auth(req, res, next){
 
 module.exports.auth = auth
 module.exports.pagination = pagination
+module.exports.search_orders = search_orders
 module.exports.get_bids = get_bids
-module.exports.get_money = get_money
\ No newline at end of file
+module.exports.get_money = get_money
+module.exports.transaction = transaction
+module.exports.supports_transactions = supports_transactions
\ No newline at end of file
@@ -0,0 +1,140 @@
+const os = require('os')
+const { Worker, isMainThread, parentPort } = require('worker_threads')
+const bcryptjs = require('bcryptjs')
+
+/*
+Password hashing and verification off the event loop. bcrypt is CPU bound by
+design and bcryptjs is plain JavaScript, so on the event loop a login storm
+(everybody logging in when a big auction starts) would stall every other
+request of the process. Instead the work runs on a pool of PASSWORD_THREADS
+worker threads, one job per thread at a time, and the rest wait in a queue of
+at most PASSWORD_QUEUE jobs. Past that the pool is busy and refuses the job
+right away, the routes answer 503 and the client retries later, rather than
+queueing logins that would time out anyway.
+
+A single process has up to 4 threads, one core less than the machine so that
+the event loop keeps one. In a cluster every worker has a pool of its own and
+the primary divides the cores less one between the workers (at least one
+thread each), so CLUSTER_WORKERS=auto does not start a pool per core on every
+core. PASSWORD_THREADS, when set, is the size of the pool of every process.
+
+New passwords are hashed with BCRYPT_ROUNDS rounds, the stored hashes keep
+the rounds they were made with.
+*/
+
+const ROUNDS = parseInt(process.env.BCRYPT_ROUNDS || 5)
+const THREADS = parseInt(process.env.PASSWORD_THREADS || Math.max(1, Math.min(4, os.cpus().length - 1)))
+const QUEUE = parseInt(process.env.PASSWORD_QUEUE || 1000) // jobs waiting for a thread
+
+// Too many passwords to check at once, the request can be retried later
+class BusyError extends Error {
+    constructor() {
+        super("The server is busy, try again later")
+        this.status = 503
+    }
+}
+
+if (!isMainThread) {
+    // A thread of the pool: one job at a time, synchronously
+    parentPort.on('message', job => {
+        try {
+            const result = job.op === 'hash'
+                ? bcryptjs.hashSync(job.password, bcryptjs.genSaltSync(job.rounds))
+                : bcryptjs.compareSync(job.password, job.hash)
+            parentPort.postMessage({ id: job.id, result: result })
+        } catch (error) {
+            parentPort.postMessage({ id: job.id, error: error.message })
+        }
+    })
+}
+
+const threads = [] // { worker, job } where job is the one running, or null
+const queue = []
+const pending = new Map() // job id => { resolve, reject }
+let next_id = 0
+
+function spawn() {
+    const thread = { worker: new Worker(__filename), job: null }
+    thread.worker.unref()
+    thread.worker.on('message', message => {
+        const job = pending.get(message.id)
+        pending.delete(message.id)
+        thread.job = null
+        if (message.error !== undefined) {
+            job.reject(new Error(message.error))
+        } else {
+            job.resolve(message.result)
+        }
+        dispatch()
+    })
+    // A thread that dies fails its job and is replaced. 'exit' follows an 'error' and
+    // it also comes alone when the thread stops without one (out of memory, process.exit)
+    let failure = null
+    thread.worker.on('error', error => {
+        failure = error
+    })
+    thread.worker.on('exit', code => {
+        if (thread.job !== null && pending.has(thread.job.id)) {
+            pending.get(thread.job.id).reject(failure || new Error("The password thread exited with code " + code))
+            pending.delete(thread.job.id)
+        }
+        threads.splice(threads.indexOf(thread), 1)
+        threads.push(spawn())
+        dispatch()
+    })
+    return thread
+}
+
+function dispatch() {
+    for (const thread of threads) {
+        if (queue.length === 0) {
+            break
+        }
+        if (thread.job === null) {
+            thread.job = queue.shift()
+            thread.worker.ref()
+            thread.worker.postMessage(thread.job)
+        }
+    }
+    // The idle threads do not keep the process alive
+    for (const thread of threads) {
+        if (thread.job === null) {
+            thread.worker.unref()
+        }
+    }
+}
+
+function run(job) {
+    if (threads.length === 0) {
+        for (let i = 0; i < THREADS; i++) {
+            threads.push(spawn())
+        }
+    }
+    if (queue.length >= QUEUE) {
+        return Promise.reject(new BusyError())
+    }
+    job.id = ++next_id
+    return new Promise((resolve, reject) => {
+        pending.set(job.id, { resolve, reject })
+        queue.push(job)
+        dispatch()
+    })
+}
+
+// The bcrypt hash of a new password
+const hash = password => run({ op: 'hash', password: password, rounds: ROUNDS })
+
+// Whether the password matches the stored hash
+const compare = (password, hashed) => run({ op: 'compare', password: password, hash: hashed })
+
+// How busy the pool is, for the health report
+const stats = () => ({
+    threads: threads.length,
+    busy: threads.filter(thread => thread.job !== null).length,
+    queued: queue.length
+})
+
+module.exports.hash = hash
+module.exports.compare = compare
+module.exports.stats = stats
+module.exports.BusyError = BusyError
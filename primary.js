@@ -0,0 +1,146 @@
+const cluster = require('cluster')
+const crypto = require('crypto')
+const os = require('os')
+
+/*
+Cluster mode, with CLUSTER_WORKERS set to a number of workers or to "auto" for
+one per core. This process only supervises: the workers run app.js and share
+the server port. The primary
+
+  - relays the bus messages (bus.js) between the workers and keeps the state
+    that has to be the same in all of them: the version of the listing cache
+    and the offset of the test clock, handed to new workers when they start,
+  - splits the password threads (passwords.js) between the workers,
+  - makes one worker the leader, which runs the migrations and the
+    settlement, so the expirations are scheduled once,
+  - collects the health reports of the workers and shares the table with all
+    of them for /api/health,
+  - replaces a worker that dies, restarts the workers one at a time on SIGHUP
+    (a new one is listening before an old one drains) and drains them all on
+    SIGTERM/SIGINT before it exits.
+*/
+
+const DRAIN_TIMEOUT = parseFloat(process.env.DRAIN_TIMEOUT || 10) // seconds a worker has to finish its requests
+
+const boot = crypto.randomBytes(4).toString('hex')
+const cores = os.availableParallelism ? os.availableParallelism() : os.cpus().length
+const state = { cache_version: 0, clock_offset: 0, seq: 0 }
+const health = new Map() // worker id => the last health report
+let leader = null // the id of the leader worker
+let password_threads = null // per worker, unless PASSWORD_THREADS is set
+let stopping = false
+let restarting = false
+
+function broadcast(topic, data) {
+    const message = { bus: topic, data: data, seq: ++state.seq }
+    for (const worker of Object.values(cluster.workers)) {
+        if (worker.isConnected()) {
+            worker.send(message)
+        }
+    }
+}
+
+// The topics of the cluster-wide state, the primary answers with the new value
+const reducers = {
+    'cache-bump': (data, worker) => ['cache-version', { version: ++state.cache_version, origin: worker.id }],
+    'clock-advance': data => ['clock-offset', { offset: state.clock_offset += data.seconds }]
+}
+
+function fork(as_leader) {
+    const worker = cluster.fork({
+        CLUSTER_LEADER: as_leader ? 'true' : 'false',
+        CLUSTER_BOOT: boot,
+        CACHE_VERSION: String(state.cache_version),
+        CLOCK_OFFSET: String(state.clock_offset),
+        PASSWORD_THREADS: process.env.PASSWORD_THREADS || String(password_threads)
+    })
+    if (as_leader) {
+        leader = worker.id
+    }
+    worker.on('message', message => {
+        if (message && message.bus) {
+            const reducer = reducers[message.bus]
+            broadcast(...(reducer ? reducer(message.data, worker) : [message.bus, message.data]))
+        } else if (message && message.health) {
+            health.set(worker.id, message.health)
+        }
+    })
+    return worker
+}
+
+function share_health() {
+    broadcast('health', [...health.values()])
+}
+
+// Ask a worker to drain, kill it if it takes longer than DRAIN_TIMEOUT
+function drain(worker) {
+    return new Promise(resolve => {
+        if (worker.isDead()) {
+            return resolve()
+        }
+        const timer = setTimeout(() => worker.process.kill('SIGKILL'), (DRAIN_TIMEOUT + 5) * 1000)
+        worker.once('exit', () => {
+            clearTimeout(timer)
+            resolve()
+        })
+        worker.send('shutdown')
+    })
+}
+
+const listening = worker => new Promise(resolve => worker.once('listening', resolve))
+
+// Replace the workers one by one, there are always workers accepting connections
+async function rolling_restart() {
+    if (restarting || stopping) {
+        return
+    }
+    restarting = true
+    console.log("Rolling restart of " + Object.keys(cluster.workers).length + " workers")
+    for (const old of Object.values(cluster.workers)) {
+        old.replaced = true
+        const replacement = fork(old.id === leader)
+        await listening(replacement)
+        await drain(old)
+    }
+    restarting = false
+}
+
+async function shutdown() {
+    if (stopping) {
+        return
+    }
+    stopping = true
+    console.log("Draining " + Object.keys(cluster.workers).length + " workers")
+    await Promise.all(Object.values(cluster.workers).map(drain))
+    process.exit(0)
+}
+
+function start() {
+    const setting = process.env.CLUSTER_WORKERS
+    const count = setting === 'auto' ? cores : Math.max(1, parseInt(setting))
+    // The workers share the cores left for the password threads instead of each taking its own share
+    password_threads = Math.max(1, Math.floor((cores - 1) / count))
+    console.log("Auction cluster: starting " + count + " workers")
+
+    for (let i = 0; i < count; i++) {
+        fork(i === 0)
+    }
+
+    cluster.on('listening', share_health)
+    cluster.on('exit', (worker, code, signal) => {
+        health.delete(worker.id)
+        share_health()
+        if (stopping || worker.replaced) {
+            return
+        }
+        console.log("Worker " + worker.process.pid + " died (" + (signal || code) + "), starting a new one")
+        setTimeout(() => fork(worker.id === leader), 1000)
+    })
+
+    setInterval(share_health, 5000).unref()
+    process.on('SIGHUP', rolling_restart)
+    process.on('SIGTERM', shutdown)
+    process.on('SIGINT', shutdown)
+}
+
+module.exports.start = start
@@ -29,6 +29,8 @@
  *               type: array
  *               items:
  *                 type: string
+ *       '503':
+ *         description: Too many passwords are being checked, retry after the Retry-After seconds
  * */
 
 //*==================| USER REGISTER |=================================*/
@@ -65,6 +67,8 @@
  *               type: array
  *               items:
  *                 type: string
+ *       '503':
+ *         description: Too many passwords are being hashed, retry after the Retry-After seconds
  * */
 
 //*==================| USER DETAILS |=================================*/
@@ -117,6 +121,75 @@
  * */
 
 
+//*==================| SEARCH AUCTIONS |=================================*/
+/**
+ * @openapi
+ * /api/auction/search:
+ *   get:
+ *     summary: Searches the open auctions ✅
+ *     description: Searches the open auctions by the words of the item, its condition, the current price and the seller. Every filter is optional and they all apply together. Paginated by the next_cursor of the previous page, the matches are not counted (total_records and total_pages are null, has_more tells whether there is a next page)
+ *     tags:
+ *      [Auctions]
+ *     parameters:
+ *      - in: query
+ *        name: q
+ *        schema:
+ *          type: string
+ *        description: Words of the item title or description
+ *      - in: query
+ *        name: condition
+ *        schema:
+ *          type: string
+ *        description: 'New or Used'
+ *      - in: query
+ *        name: min_price
+ *        schema:
+ *          type: number
+ *        description: The lowest current price, the highest bid or else the starting price
+ *      - in: query
+ *        name: max_price
+ *        schema:
+ *          type: number
+ *        description: The highest current price
+ *      - in: query
+ *        name: seller_id
+ *        schema:
+ *          type: string
+ *        description: Only the auctions of this seller
+ *      - in: query
+ *        name: sort
+ *        schema:
+ *          type: string
+ *        description: 'ending (soonest first, by default), highest_bid or newest'
+ *      - in: query
+ *        name: limit
+ *        schema:
+ *          type: integer
+ *        description: Records per page, 10 by default and at most 1000
+ *      - in: query
+ *        name: cursor
+ *        schema:
+ *          type: string
+ *        description: The next_cursor from the metadata of the previous page
+ *      - in: query
+ *        name: fields
+ *        schema:
+ *          type: string
+ *        description: 'Only these fields, comma separated, or "summary"'
+ *     responses:
+ *       '200':
+ *         description: A JSON object with a page of the auctions that match
+ *         content:
+ *           application/json:
+ *             schema:
+ *               type: array
+ *               items:
+ *                 type: string
+ *       '400':
+ *         description: A filter or the cursor is not valid
+ * 
+ * */
+
 //*==================| GET ALL AUCTIONS |=================================*/
 /**
  * @openapi
@@ -133,6 +206,31 @@
  *          type: string
  *        required: true
  *        description: 'It accepts three values: [all, noexpired, expired]'   
+ *      - in: query
+ *        name: page
+ *        schema:
+ *          type: integer
+ *        description: The page number, 1 by default
+ *      - in: query
+ *        name: limit
+ *        schema:
+ *          type: integer
+ *        description: Records per page, 10 by default and at most 1000 (an NDJSON export has no upper limit)
+ *      - in: query
+ *        name: cursor
+ *        schema:
+ *          type: string
+ *        description: The next_cursor from the metadata of the previous page, for deep pages
+ *      - in: query
+ *        name: fields
+ *        schema:
+ *          type: string
+ *        description: 'Only these fields, comma separated (e.g. exp_date,item.title), or "summary" for the starting price, expiration, highest bid, bid count, closed, seller name and item title'
+ *      - in: query
+ *        name: format
+ *        schema:
+ *          type: string
+ *        description: 'json (by default) or ndjson, to export every record after the cursor as one JSON object per line'
  *     responses:
  *       '200':
  *         description: A JSON object with the user details
@@ -145,6 +243,113 @@
  * 
  * */
 
+//*==================| AUCTION BID HISTORY |=================================*/
+/**
+ * @openapi
+ * /api/auction/{id}/bids:
+ *   get:
+ *     summary: Gets the bids placed for an auction, newest first ✅
+ *     description: Gets the bids placed for an auction, newest first. Paginated like the auctions, with page and limit or with the next_cursor of the previous page
+ *     tags:
+ *      [Auctions]
+ *     parameters:
+ *      - in: path
+ *        name: id
+ *        schema:
+ *          type: string
+ *        required: true
+ *        description: The auction id
+ *     responses:
+ *       '200':
+ *         description: A JSON object with a page of bids (user, bid, date and seq, the position of the bid in the auction)
+ *         content:
+ *           application/json:
+ *             schema:
+ *               type: array
+ *               items:
+ *                 type: string
+ * 
+ * */
+
+//*==================| AUCTION EVENTS |=================================*/
+/**
+ * @openapi
+ * /api/auction/{id}/events:
+ *   get:
+ *     summary: Follow an auction with server-sent events ✅
+ *     description: 'A text/event-stream of the auction: bid-accepted (user, bid, seq, date), outbid (the user who was outbid and the bid that beat them) and auction-closed (winner_id, final_price, closed_at)'
+ *     tags:
+ *      [Auctions]
+ *     parameters:
+ *      - in: path
+ *        name: id
+ *        schema:
+ *          type: string
+ *        required: true
+ *        description: The auction id
+ *     responses:
+ *       '200':
+ *         description: An event stream, every event has a JSON object with the auction_id as data
+ *         content:
+ *           text/event-stream:
+ *             schema:
+ *               type: string
+ * 
+ * */
+
+//*==================| ALL EVENTS |=================================*/
+/**
+ * @openapi
+ * /api/events:
+ *   get:
+ *     summary: Follow every auction with server-sent events ✅
+ *     description: The events of every auction, as in /api/auction/{id}/events
+ *     tags:
+ *      [Auctions]
+ *     responses:
+ *       '200':
+ *         description: An event stream, every event has a JSON object with the auction_id as data
+ *         content:
+ *           text/event-stream:
+ *             schema:
+ *               type: string
+ *
+ * */
+
+//*==================| HEALTH |=================================*/
+/**
+ * @openapi
+ * /api/health:
+ *   get:
+ *     summary: Health of the server and of every worker of the cluster ✅
+ *     description: The worker that answers (pid, uptime, requests in flight and served, event subscribers, memory, event loop lag) and the last reports of every worker, one without CLUSTER_WORKERS
+ *     tags:
+ *      [Health]
+ *     responses:
+ *       '200':
+ *         description: A JSON object with the worker and the workers
+ *
+ * */
+
+//*==================| METRICS |=================================*/
+/**
+ * @openapi
+ * /api/metrics:
+ *   get:
+ *     summary: Metrics of the server in the Prometheus text format ✅
+ *     description: Latency histograms per route, the time spent per stage of the requests (validate, auth, db, serialize), the database operations per model, the requests in flight, the event loop lag and the memory. In a cluster, of the worker that answers
+ *     tags:
+ *      [Health]
+ *     responses:
+ *       '200':
+ *         description: The metrics, one sample per line
+ *         content:
+ *           text/plain:
+ *             schema:
+ *               type: string
+ *
+ * */
+
 //*==================| AUCTION BID |=================================*/
 /**
  * @openapi
@@ -227,6 +432,61 @@
  *                 type: string
  * 
  * */
+//*==================| BULK ADD ITEMS |=================================*/
+/**
+ * @openapi
+ * /api/auction/add/bulk:
+ *   post:
+ *     summary: Add many items for auction at once ✅
+ *     description: 'The records are the auction/add bodies, as a JSON array or as an NDJSON stream (one record per line) of any length. Every record is validated on its own, the valid ones are added and the others are reported by their index in the input'
+ *     tags:
+ *      [Auctions]
+ *     requestBody:
+ *      required: true
+ *      content:
+ *         application/json:
+ *          schema:
+ *            type: array
+ *            items:
+ *              type: object
+ *         application/x-ndjson:
+ *          schema:
+ *            type: string
+ *     responses:
+ *       '200':
+ *         description: 'A JSON object with the number of added and failed records, auction_ids (the id of every record in the input order, null if it failed) and errors (index and message of the failed records)'
+ *       '400':
+ *         description: The body is neither a JSON array nor an NDJSON stream
+ *
+ * */
+
+//*==================| BULK BIDS |=================================*/
+/**
+ * @openapi
+ * /api/auction/bid/bulk:
+ *   post:
+ *     summary: Place many bids at once ✅
+ *     description: 'The records are the auction/bid bodies of the logged user, as a JSON array or an NDJSON stream. The bids are placed as if one by one in the input order: a bid on an auction has to beat the previous one of the input on the same auction. The rejected records are reported by their index in the input with the same message as auction/bid'
+ *     tags:
+ *      [Auctions]
+ *     requestBody:
+ *      required: true
+ *      content:
+ *         application/json:
+ *          schema:
+ *            type: array
+ *            items:
+ *              type: object
+ *         application/x-ndjson:
+ *          schema:
+ *            type: string
+ *     responses:
+ *       '200':
+ *         description: A JSON object with the number of placed and rejected bids and errors (index and message of the rejected records)
+ *       '400':
+ *         description: The body is neither a JSON array nor an NDJSON stream
+ *
+ * */
 /*============================| MODELS |===================================== */
 /**
  * @swagger
@@ -270,19 +530,49 @@
  *              type: integer
  *              description: The expiration time that user set when the item was posted
  *              example: 1644792737
- *            bids:
+ *            last_bids:
  *              type: json
- *              description: Contains all bids that have been made for this item
+ *              description: The latest (up to 10) bids for this item, with the time they were placed. All of them are at /api/auction/{id}/bids
  *              example: '[
  *                          {
  *                              "bid": 5
  *                              "user": "6207f68b55e9ac2c725f9597"
+ *                              "date": 1644792740.125
  *                          },
  *                          {
  *                              "bid": 7
  *                              "user": "1707f68b55e9ac2c725f9524"
+ *                              "date": 1644792745.5
  *                          } 
  *                      ]'
+ *            highest_bid:
+ *              type: number
+ *              description: The current highest bid, 0 when there are no bids yet
+ *              example: 7
+ *            highest_bidder:
+ *              type: string
+ *              description: The user id who placed the current highest bid
+ *              example: 1707f68b55e9ac2c725f9524
+ *            bid_count:
+ *              type: integer
+ *              description: How many bids have been placed
+ *              example: 2
+ *            closed:
+ *              type: boolean
+ *              description: Set by the settlement once the auction has expired
+ *              example: true
+ *            closed_at:
+ *              type: number
+ *              description: When the settlement closed the auction
+ *              example: 1644792737.042
+ *            winner_id:
+ *              type: string
+ *              description: The user id who won the auction, null when nobody placed a bid
+ *              example: 1707f68b55e9ac2c725f9524
+ *            final_price:
+ *              type: number
+ *              description: The winning bid, null when nobody placed a bid
+ *              example: 7
  *            seller_id:
  *              type: string
  *              description: Contains the user id whoever is selling the item 
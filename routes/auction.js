@@ -1,38 +1,123 @@
 const express = require('express')
-const moment = require('moment')
+const clock = require('../clock')
 const router = express.Router()
 const Auction = require('../models/Auction')
+const Bid = require('../models/Bid')
 const Item = require('../models/Item')
 const mongoose = require('mongoose')
-const { bidItemValidation, postAuctionValidation } = require('../validators')
-const { auth, get_bids, get_money, pagination } = require('../modules')
+const { bidItemValidation, postAuctionValidation, searchValidation } = require('../validators')
+const { auth, get_money, pagination, search_orders, transaction } = require('../modules')
 const User = require('../models/User')
+const settlement = require('../settlement')
+const cache = require('../cache')
+const events = require('../events')
+const bulk = require('../bulk')
+const metrics = require('../metrics')
+
+const STORE_ATTEMPTS = 3
 
 
 
+/************************************| GET |************************************************************
+ *  
+ * Search the open auctions by the words of the item, its condition, the price and the seller
+ * 
+ * */
+router.get("/search", auth, cache.cached(), async (req, res) => {
+    const query = { ...req.query, ...req.body }
+    const { error } = searchValidation(query)
+    if (error) {
+        return res.status(400).send({ message: error['details'][0]['message'] })
+    }
+
+    /*
+    Every filter is optional and they all apply together, on the auctions that
+    are still open. The results come in the order of ?sort= (ending soonest by
+    default, highest bid or newest), which each have an index, one page at a
+    time by cursor. The matches are not counted: a broad search reads one page
+    of the index instead of all of it, so total_records and total_pages are null
+    and has_more tells whether there is a next page.
+    */
+    const filter = { closed: false, exp_date: { $gt: clock.unix() } }
+    if (query.q !== undefined) {
+        filter.$text = { $search: query.q }
+    }
+    if (query.condition !== undefined) {
+        filter["item.condition"] = query.condition
+    }
+    if (query.seller_id !== undefined) {
+        filter.seller_id = query.seller_id
+    }
+    if (query.min_price !== undefined || query.max_price !== undefined) {
+        filter.current_price = {}
+        if (query.min_price !== undefined) {
+            filter.current_price.$gte = parseFloat(query.min_price)
+        }
+        if (query.max_price !== undefined) {
+            filter.current_price.$lte = parseFloat(query.max_price)
+        }
+    }
+    pagination(req, res, filter, Auction, {
+        order: search_orders[query.sort || "ending"],
+        validation: searchValidation,
+        count: false
+    })
+})
+
 /************************************| GET |************************************************************
  *  
  * Display all available auctions
  * 
  * */
-router.get("/:type", auth, async (req, res) => {
-    let auctions = []
+router.get("/:type", auth, cache.cached(), async (req, res) => {
+    let filter = null
     if(req.params.type !== undefined){
-        // Route api/auction/expired 
+        // Route api/auction/noexpired 
         if(req.params.type === "noexpired"){
-            const not_expired  = {exp_date: {$gt:moment().unix()}}
-            auctions = await Auction.find(not_expired)
+            filter = {exp_date: {$gt:clock.unix()}}
         }
+        // Route api/auction/expired 
         else if(req.params.type === "expired"){
-            const not_expired  = {exp_date: {$lt:moment().unix()}}
-            auctions = await Auction.find(not_expired)
+            filter = {exp_date: {$lte:clock.unix()}}
         }
         // Route api/auction/all 
         else if (req.params.type === "all"){
-            auctions = await Auction.find()
+            filter = {}
         }
     }
-    pagination(req, res, auctions)
+    pagination(req, res, filter)
+})
+
+/************************************| GET |************************************************************
+ *  
+ * Bid history of an auction, newest first
+ * 
+ * */
+router.get("/:id/bids", auth, cache.cached(), async (req, res) => {
+    if (!mongoose.Types.ObjectId.isValid(req.params.id)) {
+        return res.status(400).send({
+            message: "This auction does not exist"
+        })
+    }
+    // The auction counts its bids, counting them again would cost a scan of the whole history
+    const auction_id = new mongoose.Types.ObjectId(req.params.id)
+    const bid_count = () => Auction.findById(auction_id).select("bid_count").lean()
+        .then(auction => auction === null ? 0 : auction.bid_count)
+    pagination(req, res, {auction_id: auction_id}, Bid, {count: bid_count})
+})
+
+/************************************| GET |************************************************************
+ *  
+ * Server-sent events of an auction (bid-accepted, outbid, auction-closed)
+ * 
+ * */
+router.get("/:id/events", auth, async (req, res) => {
+    if (!mongoose.Types.ObjectId.isValid(req.params.id) || !(await Auction.exists({ _id: req.params.id }))) {
+        return res.status(400).send({
+            message: "This auction does not exist"
+        })
+    }
+    events.subscribe(req, res, String(req.params.id))
 })
 
 /************************************| POST |************************************************************
@@ -56,67 +141,130 @@ router.post("/bid", auth, async (req, res) => {
             message: "This auction does not exist"
         })
     }
-    
-
-    const found_auction = await Auction.findById({_id:req.body.item_id}) //Get the auction by id 
 
-    // Checks if the auction is active
-    if (!found_auction || parseInt(found_auction.exp_date) < moment().unix()) {
+    // Checks if the bidder is trying bid higher than the pre-set highest value (max int, makes no sense for higher than 5-10k per bid in real life anyway)
+    if (parseFloat(process.env.MAX_BID) < req.body.bid) {
         return res.send({
-            message: "This auction has expired or does not exist"
+            message: "The highest posible value to bid is " + get_money(process.env.MAX_BID)
         })
     }
 
-    // Whenever we are sure that the request data is valid structure we can proceed with the next steps
-    const bids = get_bids(found_auction.bids)
+    // Parse the string to float to put the record as a real number (we can not trust the user inut)
+    const actual_bid = parseFloat(req.body.bid)
+    const placed_at = clock.now()
+    const now = Math.floor(placed_at)
 
-    // Checks if the item belong to the currently logged user (very common mistake left by programmers by not checking this constraint)
-    if (found_auction.seller_id == req.user._id)
-        return res.send({
-            message: "You can not bid for your own item"
-    })
-
-    // Checks if the bidder is trying to bid lower than asked amount
-    else if (found_auction.starting_price >= req.body.bid) {
-        return res.send({
-            message: "Sorry, the seller has a starting price of " + get_money(found_auction.starting_price)
+    /*
+    The bid is placed with a single conditional update. All the rules (active
+    auction, not our own item, above the starting price and above the current
+    highest bid) are part of the filter, so the database accepts or rejects the
+    bid atomically and concurrent bids can not overwrite each other. The auction
+    only keeps the latest bids, the accepted bid is then appended to the bids
+    collection at the position (seq) the update gave it, so the cost does not
+    depend on how many bids the auction already has. The update returns the
+    auction as it was before the bid, with the bidder who has just been outbid.
+    Both writes are one transaction: if the bid can not be stored the auction
+    is left as it was, there is never an accepted bid missing from its history
+    nor a gap in the positions. A transaction that conflicts with a concurrent
+    bid on the same auction is retried as a whole. A standalone MongoDB has no
+    transactions, there the bid is stored after the update (see store_placed).
+    */
+    const bid = { user: req.user._id, bid: actual_bid, date: placed_at }
+    let placed
+    try {
+        await transaction(async session => {
+            placed = await Auction.findOneAndUpdate(
+                {
+                    _id: req.body.item_id,
+                    exp_date: { $gt: now },
+                    closed: false,
+                    seller_id: { $ne: req.user._id },
+                    starting_price: { $lt: actual_bid },
+                    highest_bid: { $lt: actual_bid }
+                },
+                {
+                    $set: { highest_bid: actual_bid, current_price: actual_bid, highest_bidder: req.user._id },
+                    $inc: { bid_count: 1 },
+                    $push: { last_bids: { $each: [bid], $slice: -Auction.LAST_BIDS } }
+                }
+            ).select("bid_count highest_bidder").session(session).lean()
+            if (placed) {
+                const stored = { auction_id: placed._id, seq: placed.bid_count + 1, ...bid }
+                await (session ? Bid.create([stored], { session }) : store_placed([stored]))
+            }
         })
-    }
-
-    // Checks if the bidder is trying to bid lower amount
-    else if (Math.max(...bids) >= req.body.bid) {
-        return res.send({
-            message: "You can not underbid the current highest bid of " + get_money(Math.max(...bids))
+        if (placed) {
+            const seq = placed.bid_count + 1
+            cache.bump() // after the commit, a listing read in between is cached under the old version
+            events.publish(placed._id, "bid-accepted", { ...bid, seq })
+            if (placed.highest_bidder && placed.highest_bidder !== req.user._id) {
+                events.publish(placed._id, "outbid", { user: placed.highest_bidder, bid: actual_bid })
+            }
+        }
+    } catch (error) {
+        return res.status(400).send({
+            message: "There is an error contact the administrator"
         })
     }
 
-    // Checks if the bidder is trying bid higher than the pre-set highest value (max int, makes no sense for higher than 5-10k per bid in real life anyway)
-    else if (parseFloat(process.env.MAX_BID) < req.body.bid) {
+    if (placed) {
         return res.send({
-            message: "The highest posible value to bid is " + get_money(process.env.MAX_BID)
+            message: "Your bid of " + get_money(actual_bid) + " was placed successfully"
         })
     }
 
-    else {
-        // Parse the string to float to put the record as a real number (we can not trust the user inut)
-        const actual_bid = parseFloat(req.body.bid)
-        found_auction.bids.push({
-            user: req.user._id,
-            bid: actual_bid
-        })
+    // The bid was rejected, read the auction summary to tell the bidder why
+    const found_auction = await Auction.findById(req.body.item_id).select("-last_bids").lean()
+    return res.send({
+        message: rejection(found_auction, actual_bid, req.user._id, now)
+    })
+})
 
+/*
+Store the bids that the auctions have already taken, without a transaction (a
+standalone MongoDB). Each bid is an upsert of its position, so storing it again
+is harmless and a failed attempt is retried rather than leaving a gap in the
+history of the auction.
+*/
+async function store_placed(bids) {
+    if (bids.length === 0) {
+        return
+    }
+    const writes = bids.map(each => ({
+        updateOne: { filter: { auction_id: each.auction_id, seq: each.seq }, update: { $setOnInsert: each }, upsert: true }
+    }))
+    for (let attempt = 1; ; attempt++) {
         try {
-            found_auction.save()
-            return res.send({
-                message: "Your bid of " + get_money(actual_bid) + " was placed successfully"
-            })
+            return await metrics.query(Bid, "bulkWrite", () => Bid.collection.bulkWrite(writes, { ordered: false }))
         } catch (error) {
-            return res.status(400).send({
-                message: "There is an error contact the administrator"
-            })
+            if (attempt === STORE_ATTEMPTS) {
+                throw error
+            }
         }
     }
-})
+}
+
+// Why a bid was not placed, from the summary of the auction (null if it does not exist)
+function rejection(found_auction, actual_bid, user_id, now) {
+
+    // Checks if the auction is active, it ends at exp_date: the settlement closes it from that second on
+    if (!found_auction || found_auction.closed || parseInt(found_auction.exp_date) <= now) {
+        return "This auction has expired or does not exist"
+    }
+
+    // Checks if the item belong to the currently logged user (very common mistake left by programmers by not checking this constraint)
+    if (found_auction.seller_id == user_id) {
+        return "You can not bid for your own item"
+    }
+
+    // Checks if the bidder is trying to bid lower than asked amount
+    if (found_auction.starting_price >= actual_bid) {
+        return "Sorry, the seller has a starting price of " + get_money(found_auction.starting_price)
+    }
+
+    // Otherwise somebody has already placed the same or a higher bid
+    return "You can not underbid the current highest bid of " + get_money(found_auction.highest_bid)
+}
 
 /************************************| POST |************************************************************
  *  
@@ -137,27 +285,10 @@ router.post("/add", auth, async (req, res) => {
         description: req.body.item.description,
     })
     
-    /*
-    We search for identical item title, description, condition and seller. 
-    Each seller can have multiple items. Another good approach would be to
-    hash/checksum multiple values on item submition and save it in the 
-    database so that we minimize this checking here and compare the hashes instead.
-    */
-    const exist = await Auction.findOne({
-        seller_id: req.user._id,
-        "item.title": new_item.title,
-        "item.condition": new_item.condition,
-        "item.description": new_item.description
-    })
-    
-    if (exist)
-        return res.json({
-            message: "This item is added already"
-        })
     const user = await User.findById(req.user._id)
     const new_auction = new Auction({
         // From the request exp_time and exp_type will be converted to timestamp
-        exp_date: moment().add(req.body.exp_time, req.body.exp_type).unix(), 
+        exp_date: clock.moment().add(req.body.exp_time, req.body.exp_type).unix(), 
         starting_price: req.body.starting_price,
         price: req.body.price,
         seller_id: req.user._id,
@@ -165,16 +296,308 @@ router.post("/add", auth, async (req, res) => {
         item: new_item,
     })
 
+    // A seller lists an item once: the unique (seller_id, fingerprint) index rejects the duplicate
+    // in the insert, also when the same item is submitted twice at the same time
     try {
         await new_auction.save()
+        cache.bump()
+        settlement.schedule(new_auction)
         return res.json({
-            message: "The new Item has been added to the auction"
+            message: "The new Item has been added to the auction",
+            auction_id: new_auction._id
         })
     } catch (err) {
+        if (err.code === 11000) {
+            return res.json({
+                message: "This item is added already"
+            })
+        }
         return res.json({
             message: err
         })
     }
 })
 
+// Why an auction record of a bulk can not be added, or undefined
+function invalid_auction(record) {
+    const { error } = postAuctionValidation(record)
+    if (error) {
+        return error['details'][0]['message']
+    }
+}
+
+/************************************| POST |************************************************************
+ *  
+ * Add many items to the auction, a JSON array or an NDJSON stream of the auction/add bodies
+ * 
+ * */
+router.post("/add/bulk", auth, bulk.json, async (req, res) => {
+    const invalid = bulk.invalid(req)
+    if (invalid) {
+        return res.status(400).send({ message: invalid })
+    }
+
+    /*
+    The seller is read once for the whole request and every batch is written
+    with one unordered insert, the unique (seller_id, fingerprint) index
+    rejects the duplicates (also within the batch) one by one while the other
+    records are inserted. auction_ids has the id of every record in the order
+    of the input, null for the ones that are in the errors.
+    */
+    let auction_ids = [], errors = []
+    let received = 0 // the records of the batches handled to the end
+    let inserting = [] // the ids of the batch being inserted, removed again when it fails
+    try {
+        const user = await User.findById(req.user._id).select("name").lean()
+        for await (const batch of bulk.batches(req)) {
+            const started = clock.moment()
+            const documents = [], positions = []
+            for (const { index, record, error } of batch) {
+                auction_ids[index] = null
+                const message = error || invalid_auction(record)
+                if (message) {
+                    errors.push({ index, message })
+                    continue
+                }
+                const new_auction = new Auction({
+                    exp_date: started.clone().add(record.exp_time, record.exp_type).unix(),
+                    starting_price: record.starting_price,
+                    seller_id: req.user._id,
+                    seller_name: user.name,
+                    item: {
+                        title: record.item.title,
+                        condition: record.item.condition,
+                        description: record.item.description
+                    }
+                })
+                // The document is inserted as it is, without the validate hook of the model
+                new_auction.fingerprint = Auction.fingerprint(new_auction.item)
+                new_auction.current_price = new_auction.starting_price
+                documents.push(new_auction.toObject())
+                positions.push(index)
+            }
+
+            inserting = documents.map(document => document._id)
+            const failed = await bulk.insert(Auction, documents)
+            inserting = []
+            const added = []
+            documents.forEach((document, i) => {
+                const write_error = failed.get(i)
+                if (write_error === undefined) {
+                    auction_ids[positions[i]] = document._id
+                    added.push(document)
+                } else {
+                    errors.push({
+                        index: positions[i],
+                        message: write_error.code === 11000 ? "This item is added already" : write_error.errmsg
+                    })
+                }
+            })
+            if (added.length > 0) {
+                cache.bump()
+                settlement.schedule_many(added)
+            }
+            received += batch.length
+        }
+    } catch (error) {
+        // The input could not be read or added to the end, the batches before are added all the same.
+        // A failed insert may have added some of its batch, which nobody would know of.
+        if (inserting.length > 0) {
+            await Auction.deleteMany({ _id: { $in: inserting } }).catch(() => null)
+        }
+        auction_ids = auction_ids.slice(0, received)
+        errors = errors.filter(each => each.index < received)
+        if (auction_ids.every(each => each === null)) {
+            return res.status(400).send({
+                message: "There is an error contact the administrator"
+            })
+        }
+        errors.push({ index: received, message: "There is an error contact the administrator" })
+    }
+    errors.sort((a, b) => a.index - b.index)
+    return res.send({
+        message: "Success",
+        added: auction_ids.filter(each => each !== null).length,
+        failed: errors.length,
+        auction_ids: auction_ids,
+        errors: errors
+    })
+})
+
+// Why a bid record of a bulk can not be placed at all, or undefined
+function invalid_bid(record) {
+    const { error } = bidItemValidation(record)
+    if (error) {
+        return error['details'][0]['message']
+    }
+    if (!mongoose.Types.ObjectId.isValid(record.item_id)) {
+        return "This auction does not exist"
+    }
+}
+
+/*
+Place the bids of one user on one auction, strictly increasing, with a single
+conditional update like a single bid. The filter asks for the highest of them
+to win and the update pipeline keeps those that are above both the starting
+price and the current highest bid, which is the same as placing them one by
+one. The update returns the auction as it was before, from which the accepted
+bids and their positions (seq) follow.
+*/
+async function place_bids(auction_id, chain, user_id, placed_at, now, session) {
+    const highest = chain[chain.length - 1].bid
+    const bids = chain.map(each => ({ user: user_id, bid: each.bid, date: placed_at }))
+    const previous = await Auction.findOneAndUpdate(
+        {
+            _id: auction_id,
+            exp_date: { $gt: now },
+            closed: false,
+            seller_id: { $ne: user_id },
+            starting_price: { $lt: highest },
+            highest_bid: { $lt: highest }
+        },
+        [
+            {
+                $set: {
+                    placed_bids: {
+                        $filter: {
+                            input: { $literal: bids },
+                            as: "each",
+                            cond: { $and: [
+                                { $gt: ["$$each.bid", "$highest_bid"] },
+                                { $gt: ["$$each.bid", "$starting_price"] }
+                            ] }
+                        }
+                    }
+                }
+            },
+            {
+                $set: {
+                    highest_bid: highest,
+                    current_price: highest,
+                    highest_bidder: { $literal: user_id },
+                    bid_count: { $add: ["$bid_count", { $size: "$placed_bids" }] },
+                    last_bids: { $slice: [{ $concatArrays: ["$last_bids", "$placed_bids"] }, -Auction.LAST_BIDS] }
+                }
+            },
+            { $unset: "placed_bids" }
+        ]
+    ).select("bid_count highest_bid highest_bidder starting_price").session(session).lean()
+
+    if (!previous) {
+        const found_auction = await Auction.findById(auction_id).select("-last_bids").session(session).lean()
+        return { placed: [], errors: chain.map(each => ({ index: each.index, message: rejection(found_auction, each.bid, user_id, now) })) }
+    }
+    const placed = [], errors = []
+    for (const each of chain) {
+        if (each.bid > previous.highest_bid && each.bid > previous.starting_price) {
+            placed.push({ auction_id: previous._id, seq: previous.bid_count + placed.length + 1, user: user_id, bid: each.bid, date: placed_at })
+        } else {
+            errors.push({ index: each.index, message: rejection(previous, each.bid, user_id, now) })
+        }
+    }
+    return { placed, errors, outbid: previous.highest_bidder !== user_id ? previous.highest_bidder : null }
+}
+
+/************************************| POST |************************************************************
+ *  
+ * Place many bids of the logged user, a JSON array or an NDJSON stream of the auction/bid bodies
+ * 
+ * */
+router.post("/bid/bulk", auth, bulk.json, async (req, res) => {
+    const invalid = bulk.invalid(req)
+    if (invalid) {
+        return res.status(400).send({ message: invalid })
+    }
+
+    /*
+    The bids of a batch are grouped by auction, each group is placed with one
+    update and all the accepted bids of the batch are stored with one unordered
+    insert. The updates and the insert of a batch are one transaction (the
+    operations of a transaction run one after the other), so a batch is either
+    placed and stored as a whole or not at all: when it fails every bid of the
+    batch is reported as rejected, and the batches before it stay placed. On a
+    standalone MongoDB the accepted bids are stored after the updates instead
+    (see store_placed).
+    */
+    const errors = []
+    let placed = 0, received = 0
+    try {
+        for await (const batch of bulk.batches(req)) {
+            received += batch.length
+            const placed_at = clock.now()
+            const now = Math.floor(placed_at)
+            const chains = new Map() // auction id => the bids of the batch on it, in the order of the input
+            for (const { index, record, error } of batch) {
+                const message = error || invalid_bid(record)
+                if (message) {
+                    errors.push({ index, message })
+                    continue
+                }
+                const actual_bid = parseFloat(record.bid)
+                const chain = chains.get(record.item_id) || []
+                const last = chain[chain.length - 1]
+                // A bid of the batch has to beat the previous one on the same auction
+                if (last !== undefined && actual_bid <= last.bid) {
+                    errors.push({ index, message: "You can not underbid the current highest bid of " + get_money(last.bid) })
+                    continue
+                }
+                chain.push({ index, bid: actual_bid })
+                chains.set(record.item_id, chain)
+            }
+
+            if (chains.size === 0) {
+                continue
+            }
+            let results, bids
+            try {
+                await transaction(async session => {
+                    results = []
+                    for (const [auction_id, chain] of chains) {
+                        results.push(await place_bids(auction_id, chain, req.user._id, placed_at, now, session))
+                    }
+                    bids = results.flatMap(result => result.placed)
+                    if (!session) {
+                        await store_placed(bids)
+                    } else if ((await bulk.insert(Bid, bids, session)).size > 0) {
+                        throw new Error("The accepted bids could not be stored")
+                    }
+                })
+            } catch (error) {
+                for (const chain of chains.values()) {
+                    errors.push(...chain.map(each => ({ index: each.index, message: "There is an error contact the administrator" })))
+                }
+                continue
+            }
+            placed += bids.length
+            if (bids.length > 0) {
+                cache.bump()
+            }
+            for (const result of results) {
+                errors.push(...result.errors)
+                for (const bid of result.placed) {
+                    events.publish(bid.auction_id, "bid-accepted", { user: bid.user, bid: bid.bid, date: bid.date, seq: bid.seq })
+                }
+                if (result.placed.length > 0 && result.outbid) {
+                    events.publish(result.placed[0].auction_id, "outbid", { user: result.outbid, bid: result.placed[0].bid })
+                }
+            }
+        }
+    } catch (error) {
+        // The input could not be read to the end, the batches before are placed all the same
+        if (placed === 0) {
+            return res.status(400).send({
+                message: "There is an error contact the administrator"
+            })
+        }
+        errors.push({ index: received, message: "There is an error contact the administrator" })
+    }
+    errors.sort((a, b) => a.index - b.index)
+    return res.send({
+        message: "Success",
+        placed: placed,
+        rejected: received - placed,
+        errors: errors
+    })
+})
+
 module.exports = router
\ No newline at end of file
@@ -1,18 +1,23 @@
 const express = require("express");
 const jsonwebtoken = require("jsonwebtoken");
-const bcryptjs = require("bcryptjs");
+const passwords = require("../passwords");
 const { registerValidation, loginValidation } = require("../validators");
 const router = express.Router();
 const User = require("../models/User");
 const { auth } = require('../modules')
 
+// The password pool is full, the client should retry in a moment
+function busy(res) {
+  return res.status(503).header("Retry-After", "1").send({ message: new passwords.BusyError().message });
+}
+
 
 /************************************| POST |************************************************************
  * 
  * Register user / requires email and password
  * 
  * */
-router.post("/login", async (req, res) => {
+router.post("/login", async (req, res, next) => {
     const { error } = loginValidation(req.body);
 
     if (error) {
@@ -25,11 +30,16 @@ router.post("/login", async (req, res) => {
       return res.status(400).send({ message: "User does not exist" });
     }
 
-    // Validation 3 to check user password
-    const passwordValidation = await bcryptjs.compare(
-      req.body.password,
-      user.password
-    );
+    // Validation 3 to check user password, on the password threads
+    let passwordValidation;
+    try {
+      passwordValidation = await passwords.compare(req.body.password, user.password);
+    } catch (error) {
+      if (error instanceof passwords.BusyError) {
+        return busy(res);
+      }
+      return next(error); // Express 4 does not catch the rejections of an async handler
+    }
 
     if (!passwordValidation) {
       return res.status(400).send({ message: "Password is wrong" });
@@ -47,7 +57,7 @@ router.post("/login", async (req, res) => {
  * Register user / requires name, surname, email and password
  * 
  * */
-router.post("/register", async (req, res) => {
+router.post("/register", async (req, res, next) => {
   // Validation 1 to check user input
   const { error } = registerValidation(req.body);
   if (error) {
@@ -60,8 +70,15 @@ router.post("/register", async (req, res) => {
     return res.status(400).send({ message: "User already exists" });
   }
 
-  const salt = await bcryptjs.genSalt(5);
-  const hashedPassword = await bcryptjs.hash(req.body.password, salt);
+  let hashedPassword;
+  try {
+    hashedPassword = await passwords.hash(req.body.password);
+  } catch (error) {
+    if (error instanceof passwords.BusyError) {
+      return busy(res);
+    }
+    return next(error);
+  }
 
   const new_user = new User({
     name: req.body.name,
@@ -71,7 +88,7 @@ router.post("/register", async (req, res) => {
   });
 
   try {
-    new_user.save();
+    await new_user.save();
     return res
       .status(200)
       .send({ message: `User ${new_user.email} has been added` });
@@ -0,0 +1,33 @@
+const express = require('express')
+const router = express.Router()
+const clock = require('../clock')
+const { clockValidation } = require('../validators')
+
+/*
+Test only, mounted when the server runs with TEST_CLOCK=true. It lets the test
+suite read the server time and move it forward instead of sleeping.
+*/
+
+/************************************| GET |************************************************************
+ *  
+ * Current server time
+ * 
+ * */
+router.get("/", (req, res) => {
+    res.send({ now: clock.now(), offset: clock.offset() })
+})
+
+/************************************| POST |************************************************************
+ *  
+ * Move the server time forward by the given seconds
+ * 
+ * */
+router.post("/", async (req, res) => {
+    const { error } = clockValidation(req.body)
+    if (error) {
+        return res.status(400).send({ message: error['details'][0]['message'] })
+    }
+    res.send({ now: await clock.advance(req.body.seconds), offset: clock.offset() })
+})
+
+module.exports = router
@@ -0,0 +1,16 @@
+const express = require('express')
+const router = express.Router()
+const { auth } = require('../modules')
+const events = require('../events')
+
+
+/************************************| GET |************************************************************
+ *  
+ * Server-sent events of every auction (bid-accepted, outbid, auction-closed)
+ * 
+ * */
+router.get("/", auth, (req, res) => {
+    events.subscribe(req, res)
+})
+
+module.exports = router
@@ -0,0 +1,16 @@
+const express = require('express')
+const router = express.Router()
+const health = require('../health')
+
+
+/************************************| GET |************************************************************
+ *  
+ * Health of the worker that answers and of every worker of the cluster
+ * 
+ * */
+router.get("/", (req, res) => {
+    const workers = health.cluster()
+    res.send({ message: "Success", data: { worker: health.report(), workers: workers, count: workers.length } })
+})
+
+module.exports = router
@@ -0,0 +1,15 @@
+const express = require('express')
+const router = express.Router()
+const metrics = require('../metrics')
+
+
+/************************************| GET |************************************************************
+ *  
+ * Metrics of the worker that answers, in the Prometheus text format
+ * 
+ * */
+router.get("/", (req, res) => {
+    res.type('text/plain; version=0.0.4').send(metrics.render())
+})
+
+module.exports = router
@@ -1,9 +1,9 @@
 const express = require('express')
-const moment = require('moment')
 const router = express.Router()
-const Auction = require('../models/Auction')
-const { auth, pagination, get_bids } = require('../modules')
+const { auth, pagination } = require('../modules')
 const User = require('../models/User')
+const Bid = require('../models/Bid')
+const cache = require('../cache')
 
 
 /************************************| GET |************************************************************
@@ -12,64 +12,41 @@ const User = require('../models/User')
  *  parametres :type  - posible values [won, sold, lost]
  * 
  */
-router.get("/history/:type", auth, async (req, res) => {
+router.get("/history/:type", auth, cache.cached({ per_user: true }), async (req, res) => {
 
-    const filter_exipred = { $lt: moment().unix() } // Select expired auctions only
-    let auctions = []
+    // The history is what the settlement has written, an auction is in it once it has been closed
+    let filter = null
 
     if (req.params.type === "sold") {
-
-        auctions = await Auction.find(
-            {
-                seller_id: req.user._id, // when the seller is the currently logged user
-                exp_date: filter_exipred, // when the time expired - aka. auction ended
-                bids: { $ne: [] } // If there is at least one bid, then there is a winner
-            }
-        )
+        filter = {
+            seller_id: req.user._id, // when the seller is the currently logged user
+            closed: true, // when the auction has been settled
+            winner_id: { $type: "string" } // and somebody won it (null when nobody bid)
+        }
     }
 
+    // The seller can not bid for their own items, so won and lost do not need to exclude them
     else if (req.params.type === "lost") {
-
-        let tmp_auctions = await Auction.find({
-            seller_id: { $ne: req.user._id }, // when the seller is the currently logged user
-            exp_date: filter_exipred, // when the time has left
-            bids: { $ne: [] } // If there is at least one bid, then there is a winner
-            }
-        )
-        //Fill the array only with the actions that the currently logged user was not a winner
-        for (let i = 0; i < tmp_auctions.length; i++) {
-            //Get the winning bet
-            let win_bid = get_bids(tmp_auctions[i].bids).slice(-1)[0]
-
-            for (let j = 0; j < tmp_auctions[i].bids.length; j++) {
-                //We check whether the current logged user has the winning bet, if not we add it to the list. The user bet but did not win
-                if (tmp_auctions[i].bids[j].user === req.user._id && parseInt(win_bid) === parseInt(tmp_auctions[i].bids[j].bid)) {
-                    auctions.push(tmp_auctions[i])
-                }
-            }
+        // The auctions the user has bid on come from the bids, an auction does not keep its bidders
+        let bid_on
+        try {
+            bid_on = await Bid.distinct("auction_id", { user: req.user._id })
+        } catch {
+            return res.status(400).send({ message: "There is an error contact the administrator" })
+        }
+        filter = {
+            _id: { $in: bid_on }, // the user placed a bid
+            closed: true, // the auction has been settled
+            winner_id: { $ne: req.user._id } // but somebody else won it
         }
     }
     else if (req.params.type === "won") {
-
-        let tmp_auctions = await Auction.find({
-
-            seller_id: { $ne: req.user._id }, // when the seller is NOT the currently logged user
-            exp_date: filter_exipred, // when the time has left
-            bids: { $ne: [] }  // If there is at least one bid, then there is a winner    
-        },
-            {
-                bids: { $slice: -1 } //Get the last bid only (we are not interested in all bids only the winner)
-            },
-        )
-
-        //Fill the array only with the actions that the currently logged user was a winner
-        for (let i = 0; i < tmp_auctions.length; i++) {
-            if (tmp_auctions[i].bids[0].user == req.user._id) {
-                auctions.push(tmp_auctions[i])
-            }
+        filter = {
+            winner_id: req.user._id, // the user placed the winning bid
+            closed: true // the auction has been settled
         }
     }
-    pagination(req, res, auctions)
+    pagination(req, res, filter)
 })
 
 /************************************| GET |************************************************************
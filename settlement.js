@@ -0,0 +1,237 @@
+const Auction = require('./models/Auction')
+const clock = require('./clock')
+const cache = require('./cache')
+const events = require('./events')
+const bus = require('./bus')
+
+/*
+Settlement of the expired auctions. The open auctions that expire within the
+next SETTLEMENT_HORIZON seconds are kept in a min-heap ordered by exp_date, so
+the scheduler sleeps until the next expiration instead of polling. When it
+wakes up, every open auction that has expired is closed with one updateMany
+per SETTLEMENT_BATCH auctions that writes the winner and the final price, which
+handles thousands of expirations per call. Anything the heap does not know
+about (auctions added by another process, or overdue after a restart) is picked
+up the same way, at the latest on the next refresh of the horizon. The closed
+auctions are announced to the event subscribers, if there are any.
+
+In a cluster only the leader worker settles, the other workers send it the
+auctions they add. Closing is idempotent, so the short overlap of the old and
+the new leader during a rolling restart closes every auction once.
+*/
+
+const HORIZON = parseInt(process.env.SETTLEMENT_HORIZON || 300) // seconds of upcoming expirations kept in memory
+const REFRESH = parseInt(process.env.SETTLEMENT_REFRESH || 30) // the longest the scheduler sleeps, in seconds
+const BATCH = parseInt(process.env.SETTLEMENT_BATCH || 10000) // auctions closed per update
+
+// Binary min-heap of [exp_date, auction id]
+class ExpiryQueue {
+    constructor() {
+        this.heap = []
+    }
+
+    get size() {
+        return this.heap.length
+    }
+
+    peek() {
+        return this.heap[0]
+    }
+
+    push(exp_date, id) {
+        const heap = this.heap
+        heap.push([exp_date, id])
+        let i = heap.length - 1
+        while (i > 0) {
+            const parent = (i - 1) >> 1
+            if (heap[parent][0] <= heap[i][0]) break
+            [heap[parent], heap[i]] = [heap[i], heap[parent]]
+            i = parent
+        }
+    }
+
+    pop() {
+        const heap = this.heap
+        const top = heap[0]
+        const last = heap.pop()
+        if (heap.length > 0) {
+            heap[0] = last
+            let i = 0
+            while (true) {
+                const left = 2 * i + 1, right = left + 1
+                let smallest = i
+                if (left < heap.length && heap[left][0] < heap[smallest][0]) smallest = left
+                if (right < heap.length && heap[right][0] < heap[smallest][0]) smallest = right
+                if (smallest === i) break
+                [heap[smallest], heap[i]] = [heap[i], heap[smallest]]
+                i = smallest
+            }
+        }
+        return top
+    }
+}
+
+const queue = new ExpiryQueue()
+let loaded_until = 0 // every open auction expiring before this time is in the queue
+let timer = null
+let running = null
+let again = false // a tick was asked for while the previous one was still running
+let active = false
+
+// Load the open auctions expiring within the horizon from the {closed, exp_date} index
+async function load() {
+    const until = clock.unix() + HORIZON
+    const upcoming = await Auction.find({closed: false, exp_date: {$gt: loaded_until, $lte: until}})
+        .select('exp_date')
+        .lean()
+    for (const auction of upcoming) {
+        queue.push(auction.exp_date, String(auction._id))
+    }
+    loaded_until = until
+}
+
+// Close every expired auction that is still open and record its winner and final price once
+async function settle() {
+    const now = clock.unix()
+    while (queue.size > 0 && queue.peek()[0] <= now) {
+        queue.pop()
+    }
+    let settled = 0, due
+    do {
+        due = (await Auction.find({closed: false, exp_date: {$lte: now}}).select('_id').limit(BATCH).lean())
+            .map(auction => auction._id)
+        if (due.length === 0) {
+            break
+        }
+        const closed_at = clock.now()
+        const result = await Auction.updateMany(
+            {_id: {$in: due}, closed: false},
+            [{
+                $set: {
+                    closed: true,
+                    closed_at: closed_at,
+                    winner_id: {$cond: [{$gt: ["$bid_count", 0]}, "$highest_bidder", null]},
+                    final_price: {$cond: [{$gt: ["$bid_count", 0]}, "$highest_bid", null]}
+                }
+            }]
+        )
+        settled += result.modifiedCount
+        if (events.listening()) {
+            const closed = await Auction.find({_id: {$in: due}, closed_at: closed_at})
+                .select('winner_id final_price')
+                .lean()
+            for (const auction of closed) {
+                events.publish(auction._id, "auction-closed", {
+                    winner_id: auction.winner_id,
+                    final_price: auction.final_price,
+                    closed_at: closed_at
+                })
+            }
+        }
+    } while (due.length === BATCH)
+    if (settled > 0) {
+        cache.bump()
+    }
+    return settled
+}
+
+// Sleep until the next expiration, or the next refresh of the horizon, whichever comes first
+function arm() {
+    clearTimeout(timer)
+    if (!active) {
+        return
+    }
+    let sleep = REFRESH
+    if (queue.size > 0) {
+        sleep = Math.min(sleep, queue.peek()[0] - clock.now())
+    }
+    timer = setTimeout(tick, Math.max(0, sleep * 1000))
+}
+
+async function tick() {
+    if (running) {
+        again = true
+        return running
+    }
+    running = (async () => {
+        try {
+            await settle()
+            if (loaded_until - clock.unix() < HORIZON - REFRESH) {
+                await load()
+            }
+        } catch (error) {
+            console.log(error)
+        } finally {
+            running = null
+            if (again) {
+                again = false
+                tick()
+            } else {
+                arm()
+            }
+        }
+    })()
+    return running
+}
+
+// Keep an auction that has just been added in the queue if it expires within the horizon
+function schedule(auction) {
+    schedule_many([auction])
+}
+
+// The same for a batch of auctions, sent to the leader in one message
+function schedule_many(auctions) {
+    if (active) {
+        auctions.forEach(enqueue)
+    } else if (bus.clustered && !bus.leader) {
+        const soon = clock.unix() + HORIZON
+        const due = auctions
+            .filter(auction => auction.exp_date <= soon)
+            .map(auction => ({ _id: String(auction._id), exp_date: auction.exp_date }))
+        if (due.length > 0) {
+            bus.send('settlement-schedule', { auctions: due })
+        }
+    }
+}
+
+function enqueue(auction) {
+    if (auction.exp_date > loaded_until) {
+        return
+    }
+    const next = queue.peek()
+    queue.push(auction.exp_date, String(auction._id))
+    if (!running && (next === undefined || auction.exp_date < next[0])) {
+        arm()
+    }
+}
+
+bus.on('settlement-schedule', data => {
+    if (active) {
+        data.auctions.forEach(enqueue)
+    }
+})
+
+// When the test clock jumps forward the auctions that became due are settled right away
+clock.on('advance', () => {
+    if (active) {
+        tick()
+    }
+})
+
+// Catch up on everything that expired while the server was down, then follow the expirations
+async function start() {
+    active = true
+    loaded_until = 0
+    return tick()
+}
+
+function stop() {
+    active = false
+    clearTimeout(timer)
+}
+
+module.exports.start = start
+module.exports.stop = stop
+module.exports.schedule = schedule
+module.exports.schedule_many = schedule_many
+module.exports.ExpiryQueue = ExpiryQueue
@@ -0,0 +1,706 @@
+"""
+    Endpoint latency benchmarks of the Auction API.
+
+        python benchmark.py run --dataset 100k --out results.json
+        python benchmark.py compare baseline.json results.json --threshold 0.1
+        python benchmark.py fanout --subscribers 10000 --bids 100
+        python benchmark.py scaling --workers 1 2 4 8
+
+    `run` starts a throwaway MongoDB and server (see harness.py), or uses the ones given with --url and --db,
+    seeds a dataset through the bulk endpoints and drives every scenario for --duration seconds with
+    --concurrency requests in flight.
+    Throughput, error rate and latency percentiles of each scenario are written as JSON.
+    The whole auction/all listing is then read three ways (every page with all the fields, every page with the
+    summary fields and one NDJSON export), measuring the bytes on the wire and the resident memory of the server.
+    `compare` flags the scenarios whose p95 latency or throughput got worse than in the baseline by more than
+    the threshold, and the listings that got bigger or heavier on the server, and exits with 1 when there is any,
+    so that every change to the routes comes with numbers.
+    Each scenario is followed by the time per request in every stage (validate, auth, db, serialize) and the
+    database operations per request, from the server's /api/metrics before and after it.
+    The mix/login-storm scenario times the bids alone and while many users log in at once.
+    The search/* scenarios query auction/search with broad filters, that most of the open auctions match, and
+    selective ones (a title word, a price range, a seller), the indexes show their worth with --dataset 1m.
+    `fanout` opens --subscribers event streams on one auction (or the global channel) and measures the time from
+    sending each bid to its bid-accepted event reaching every subscriber.
+    `scaling` seeds the dataset once and drives the same scenarios against the server in cluster mode with each
+    number of --workers in turn, printing the throughput and the speedup over the first one. The load generator
+    is a single Python process, raise --concurrency until it is not the bottleneck.
+"""
+import argparse
+import asyncio
+import contextlib
+import itertools
+import json
+import random
+import resource
+import subprocess
+import sys
+import threading
+import time
+from typing import Awaitable, Callable, Optional
+
+import httpx
+import pymongo
+from pydantic import BaseModel
+from tabulate import tabulate
+
+from client import AsyncAuctionClient, AuctionClient, Item, Metrics, NewAuction, NewBid, User
+from harness import Mongo, Server, wait_for
+from stats import summary
+
+# Every benchmark user has the same password, the hash is copied from a user registered through the API
+_PASSWORD = "benchmark123"
+
+# How many of the users log in and send the requests
+_ACTIVE_USERS = 50
+
+# How many of the users list and bid on the seeded auctions
+_SEEDERS = 1000
+
+
+class Dataset(BaseModel):
+    auctions: int
+    users: int
+    live: float = 0.7  # the share of auctions that are still open
+    max_bids: int = 500  # bids on the most popular auction, the others follow a Zipf curve
+    skew: float = 1.1
+
+
+DATASETS = {
+    "1k": Dataset(auctions=1_000, users=100),
+    "100k": Dataset(auctions=100_000, users=2_000),
+    "1m": Dataset(auctions=1_000_000, users=20_000),
+    "5m": Dataset(auctions=5_000_000, users=50_000, max_bids=200),
+}
+
+
+def seed_users(db, client: AuctionClient, dataset: Dataset, now: int) -> list[str]:
+    """ Insert the users straight into the database and return their ids """
+    template = User(name="Bench", surname="Template", email="template@bench.test", password=_PASSWORD)
+    client.post("auth/register", template)
+    hashed = db['users'].find_one({"email": template.email})['password']
+    return [str(each_id) for each_id in db['users'].insert_many([
+        {
+            "name": "Bench%d" % i,
+            "surname": "User",
+            "email": "bench%d@bench.test" % i,
+            "password": hashed,
+            "registered_on": now
+        } for i in range(dataset.users)
+    ]).inserted_ids]
+
+
+async def seed_auctions(db, client: AsyncAuctionClient, dataset: Dataset):
+    """
+        Seed the auctions and their bids through the bulk endpoints, as a catalogue import would: every seller
+        streams its auctions to auction/add/bulk, then the bids are placed in rounds on auction/bid/bulk, round k
+        giving every auction its k-th bid, so that no two bids of a round race on an auction. The bid counts are
+        skewed (Zipf) over the auctions. The expired share is listed for at most an hour and the test clock of the
+        server is then moved an hour forward, for the auctions to expire and be settled as they would live.
+    """
+    emails = ["bench%d@bench.test" % i for i in range(min(_SEEDERS, dataset.users))]
+    await client.login_many(User(email=each, password=_PASSWORD) for each in emails)
+    popularity = [int(dataset.max_bids / rank ** dataset.skew) for rank in range(1, dataset.auctions + 1)]
+    random.shuffle(popularity)
+    sellers = [random.choice(emails) for _ in popularity]
+    listed = {}  # seller => positions of its auctions
+    for i, seller in enumerate(sellers):
+        listed.setdefault(seller, []).append(i)
+
+    def listing(i: int) -> NewAuction:
+        live = random.random() < dataset.live
+        return NewAuction(
+            exp_time=random.randint(2 * 3600, 30 * 86400) if live else random.randint(60, 3600),
+            item=Item(
+                title="Benchmark item number %d" % i,
+                condition=random.choice(["New", "Used"]),
+                description="An item of the benchmark dataset"
+            )
+        )
+
+    auction_ids = [None] * dataset.auctions
+    results = await client.gather(
+        client.add_bulk((listing(i) for i in positions), seller) for seller, positions in listed.items()
+    )
+    for positions, result in zip(listed.values(), results):
+        for i, auction_id in zip(positions, result.auction_ids):
+            auction_ids[i] = auction_id
+
+    ranked = sorted(range(dataset.auctions), key=popularity.__getitem__, reverse=True)
+    for k in range(popularity[ranked[0]] if ranked else 0):
+        rounds = {}  # bidder => the k-th bids
+        for i in itertools.takewhile(lambda i: popularity[i] > k, ranked):
+            bidder = random.choice(emails)
+            if bidder != sellers[i]:
+                rounds.setdefault(bidder, []).append(NewBid(item_id=auction_ids[i], bid=k + 1))
+        await client.gather(client.bid_bulk(bids, bidder) for bidder, bids in rounds.items())
+
+    response = await client.post("test/clock", {"seconds": 3600})
+    if response.status_code != 200:
+        print("The server has no test clock (TEST_CLOCK=true), the expired auctions expire within the hour")
+        return
+    now = response.json()['now']
+    wait_for(
+        lambda: db['auctions'].count_documents({"closed": False, "exp_date": {"$lte": now}}) == 0,
+        3600, "The settlement of the expired auctions"
+    )
+
+
+async def drive(call: Callable[[], Awaitable[httpx.Response]], duration: float, concurrency: int) -> dict:
+    """
+        Send requests with `concurrency` of them in flight for `duration` seconds.
+        The responses of the cached routes (X-Cache header) give the cache hit ratio.
+    """
+    latencies, errors, cacheable, hits = [], 0, 0, 0
+    started = time.perf_counter()
+    deadline = started + duration
+
+    async def worker():
+        nonlocal errors, cacheable, hits
+        while time.perf_counter() < deadline:
+            sent = time.perf_counter()
+            try:
+                r = await call()
+                if r.status_code >= 400:
+                    errors += 1
+                if "x-cache" in r.headers:
+                    cacheable += 1
+                    hits += r.headers["x-cache"] == "HIT"
+            except httpx.HTTPError:
+                errors += 1
+            latencies.append(time.perf_counter() - sent)
+
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "error_rate": round(errors / len(latencies), 4) if latencies else 0.0,
+        "throughput": round(len(latencies) / elapsed, 2),
+        "cache_hit_ratio": round(hits / cacheable, 4) if cacheable else None,
+        **summary(latencies)
+    }
+
+
+def scenarios(bench: AsyncAuctionClient, emails: list[str], live: dict[str, float], sellers: list[str]) -> dict:
+    """ One request factory per benchmarked endpoint, `sellers` are the user ids of the emails """
+    numbers = itertools.count()
+    auctions = list(live)
+
+    def user() -> str:
+        return random.choice(emails)
+
+    async def login() -> httpx.Response:
+        return await bench.post("auth/login", {"email": user(), "password": _PASSWORD})
+
+    async def add() -> httpx.Response:
+        return await bench.post("auction/add", NewAuction(
+            exp_time=1,
+            exp_type="days",
+            item=Item(
+                title="Benchmark new item %d-%d" % (time.time(), next(numbers)),
+                condition="New",
+                description="An item posted by the benchmark"
+            )
+        ), user())
+
+    async def add_duplicate() -> httpx.Response:
+        """ The same item of each user over and over, every submission after the first one is rejected """
+        email = user()
+        return await bench.post("auction/add", NewAuction(
+            exp_time=1,
+            exp_type="days",
+            item=Item(title="Benchmark item of " + email, condition="New", description="An item posted again and again")
+        ), email)
+
+    async def bid() -> httpx.Response:
+        auction = random.choice(auctions)
+        amount = int(live[auction]) + random.randint(1, 10)
+        r = await bench.post("auction/bid", {"item_id": auction, "bid": amount}, user())
+        if "placed successfully" in r.text:
+            live[auction] = max(live[auction], amount)
+        return r
+
+    async def history() -> httpx.Response:
+        return await bench.get("auction/%s/bids" % random.choice(auctions), user(), {"limit": 10})
+
+    def listing(endpoint: str):
+        async def get() -> httpx.Response:
+            return await bench.get(endpoint, user(), {"page": random.randint(1, 10), "limit": 10})
+        return get
+
+    def read_heavy(cache: bool):
+        """
+            Clients polling the first pages of the listings, with one bid in twenty requests.
+            With the cache they poll conditionally (If-None-Match), without it every poll reaches the database.
+        """
+        etags = {}
+
+        async def poll() -> httpx.Response:
+            if random.random() < 0.05:
+                return await bid()
+            email = user()
+            params = {"page": random.randint(1, 3), "limit": 10}
+            endpoint = random.choice(["auction/noexpired", "auction/all"])
+            url = "%s?page=%d&limit=%d" % (endpoint, params["page"], params["limit"])
+            headers = bench.headers(email)
+            if not cache:
+                headers["Cache-Control"] = "no-cache"
+            elif url in etags:
+                headers["If-None-Match"] = etags[url]
+            r = await bench.http.get(bench.url + endpoint, params=params, headers=headers)
+            if cache and "etag" in r.headers:
+                etags[url] = r.headers["etag"]
+            return r
+        return poll
+
+    def search(params: Callable[[], dict]):
+        """ auction/search past the listing cache, every request times the query and its index """
+        async def get() -> httpx.Response:
+            headers = {**bench.headers(user()), "Cache-Control": "no-cache"}
+            return await bench.http.get(bench.url + "auction/search", params={"limit": 20, **params()}, headers=headers)
+        return get
+
+    return {
+        "auth/login": login,
+        "auction/add": add,
+        "auction/add/duplicate": add_duplicate,
+        "auction/bid": bid,
+        **{"auction/" + each: listing("auction/" + each) for each in ["all", "noexpired", "expired"]},
+        **{"user/history/" + each: listing("user/history/" + each) for each in ["won", "lost", "sold"]},
+        "auction/:id/bids": history,
+        "mix/read-heavy": read_heavy(cache=True),
+        "mix/read-heavy/no-cache": read_heavy(cache=False),
+        # Broad searches, most of the open auctions match and the index gives the first page in order
+        "search/ending": search(lambda: {}),
+        "search/highest-bid": search(lambda: {"sort": "highest_bid"}),
+        "search/newest": search(lambda: {"sort": "newest"}),
+        "search/condition": search(lambda: {"condition": random.choice(["New", "Used"]), "sort": "highest_bid"}),
+        "search/text/broad": search(lambda: {"q": "benchmark"}),
+        # Selective searches, a few auctions match out of all of them
+        "search/text/selective": search(lambda: {"q": str(random.randrange(1000))}),
+        "search/price": search(lambda: {"min_price": random.randint(1, 20), "max_price": random.randint(21, 40)}),
+        "search/seller": search(lambda: {"seller_id": random.choice(sellers), "sort": "newest"}),
+    }
+
+
+async def login_storm(calls: dict, args) -> dict:
+    """
+        A few bidders alone, then the same bidders while --concurrency users keep logging in. The password
+        hashing runs off the event loop, so the bid latency should stay the same.
+    """
+    bidders = max(1, args.concurrency // 10)
+    quiet = await drive(calls["auction/bid"], args.duration, bidders)
+    storm, during = await asyncio.gather(
+        drive(calls["auth/login"], args.duration, args.concurrency),
+        drive(calls["auction/bid"], args.duration, bidders)
+    )
+    print("%-24s %8.1f logins/s, bid p50 %.2fms -> %.2fms, p99 %.2fms -> %.2fms, %d login errors" % (
+        "mix/login-storm", storm['throughput'], quiet['p50'], during['p50'], quiet['p99'], during['p99'],
+        storm['errors']
+    ))
+    return {
+        "mix/login-storm/bid-alone": quiet,
+        "mix/login-storm/bid": during,
+        "mix/login-storm/login": storm
+    }
+
+
+def breakdown(before: Metrics, after: Metrics) -> Optional[dict]:
+    """
+        Where the time of the requests between two scrapes of /api/metrics went: milliseconds per request in each
+        stage, and database operations per request. None when the scrapes were answered by different workers.
+    """
+    if before.labels("cluster_worker", "worker") != after.labels("cluster_worker", "worker"):
+        return None
+    scrapes = {"route": "/api/metrics"}
+
+    def delta(name: str, **labels: str) -> float:
+        return after.sum(name, exclude=scrapes, **labels) - before.sum(name, exclude=scrapes, **labels)
+
+    served = delta("http_request_duration_seconds_count")
+    if served == 0:
+        return None
+    stages = {
+        stage: round(delta("http_request_stage_seconds_sum", stage=stage) / served * 1000, 3)
+        for stage in sorted(after.labels("http_request_stage_seconds_sum", "stage"))
+    }
+    return {
+        "requests": int(served),
+        "latency_ms": round(delta("http_request_duration_seconds_sum") / served * 1000, 3),
+        "stages_ms": stages,
+        "queries_per_request": round(delta("mongo_query_duration_seconds_count") / served, 2),
+        "query_ms": round(delta("mongo_query_duration_seconds_sum") / served * 1000, 3)
+    }
+
+
+class RssSampler:
+    """ Samples the resident memory of the server in the background and keeps the peak """
+
+    def __init__(self, server: Optional[Server], interval: float = 0.02):
+        self.server = server
+        self.interval = interval
+        self.before = self.peak = server.rss() if server is not None else None
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+
+    def _sample(self):
+        while not self._stopped.wait(self.interval):
+            self.peak = max(self.peak, self.server.rss() or 0)
+
+    def __enter__(self) -> "RssSampler":
+        if self.server is not None:
+            self._thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self._stopped.set()
+        if self.server is not None:
+            self._thread.join()
+
+
+def measure_listing(client: AuctionClient, user: str, server: Optional[Server], name: str) -> dict:
+    """ Read the whole auction/all listing the way `name` says, with the bytes received and the server memory """
+    received = records = 0
+    started = time.perf_counter()
+    with RssSampler(server) as rss:
+        if name == "listing/ndjson":
+            params = client.export_params()
+            with client.http.stream("GET", client.url + "auction/all", params=params, headers=client.headers(user)) as r:
+                for line in r.iter_lines():
+                    records += bool(line)
+                received = r.num_bytes_downloaded
+        else:
+            cursor = None
+            while True:
+                params = client.page_params(1, 1000, cursor)
+                if name == "listing/summary":
+                    params["fields"] = "summary"
+                r = client.get("auction/all", user, params)
+                received += r.num_bytes_downloaded
+                page = r.json()
+                records += len(page['data'])
+                if not page['metadata']['has_more']:
+                    break
+                cursor = page['metadata']['next_cursor']
+    megabytes = (lambda value: round(value / 2 ** 20, 2) if value is not None else None)
+    return {
+        "records": records,
+        "bytes": received,
+        "seconds": round(time.perf_counter() - started, 3),
+        "rss_before_mb": megabytes(rss.before),
+        "rss_peak_mb": megabytes(rss.peak)
+    }
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def benchmark(url: str, db_uri: str, args, server: Optional[Server] = None) -> dict:
+    dataset = DATASETS[args.dataset]
+    db = pymongo.MongoClient(db_uri).get_default_database()
+    now = int(time.time())
+
+    if args.seed:
+        print("Seeding %d users and %d auctions..." % (dataset.users, dataset.auctions))
+        with AuctionClient(url) as client:
+            seed_users(db, client, dataset, now)
+        async with AsyncAuctionClient(url, concurrency=args.concurrency) as seeder:
+            await seed_auctions(db, seeder, dataset)
+    emails = ["bench%d@bench.test" % i for i in range(min(_ACTIVE_USERS, dataset.users))]
+    sellers = [str(each['_id']) for each in db['users'].find({"email": {"$in": emails}}, {"_id": 1})]
+    live = {
+        str(each['_id']): each['highest_bid'] for each in db['auctions'].aggregate([
+            {"$match": {"closed": False, "exp_date": {"$gt": now + 600}}},
+            {"$sample": {"size": 1000}},
+            {"$project": {"highest_bid": 1}}
+        ])
+    }
+
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    results = {}
+    async with AsyncAuctionClient(url, concurrency=args.concurrency, limits=limits, timeout=60) as bench:
+        await bench.login_many(User(email=each, password=_PASSWORD) for each in emails)
+        for name, call in scenarios(bench, emails, live, sellers).items():
+            if args.scenarios and name not in args.scenarios:
+                continue
+            before = await bench.metrics()
+            results[name] = await drive(call, args.duration, args.concurrency)
+            results[name]['breakdown'] = breakdown(before, await bench.metrics())
+            print("%-24s %8.1f req/s  p50 %8.2fms  p99 %8.2fms%s" % (
+                name, results[name]['throughput'], results[name]['p50'], results[name]['p99'],
+                "" if results[name]['cache_hit_ratio'] is None else
+                "  cache hits %.1f%%" % (results[name]['cache_hit_ratio'] * 100)
+            ))
+            if results[name]['breakdown'] is not None:
+                print("%-24s %s, %.2f queries" % ("", ", ".join(
+                    "%s %.3fms" % each for each in results[name]['breakdown']['stages_ms'].items()
+                ), results[name]['breakdown']['queries_per_request']))
+        if not args.scenarios or "mix/login-storm" in args.scenarios:
+            results.update(await login_storm(scenarios(bench, emails, live, sellers), args))
+    cached, uncached = results.get("mix/read-heavy"), results.get("mix/read-heavy/no-cache")
+    if cached and uncached:
+        print("Latency gained by the cache under the read-heavy mix: p50 %.2fms, p95 %.2fms" % (
+            uncached['p50'] - cached['p50'], uncached['p95'] - cached['p95']
+        ))
+
+    listings = {}
+    with AuctionClient(url, timeout=600) as client:
+        client.login(emails[0], _PASSWORD)
+        for name in ["listing/pages", "listing/summary", "listing/ndjson"]:
+            if args.scenarios and name not in args.scenarios:
+                continue
+            listings[name] = measure_listing(client, emails[0], server, name)
+            print("%-20s %8d records  %10.1f KiB  %7.2fs  peak RSS %s MiB" % (
+                name, listings[name]['records'], listings[name]['bytes'] / 1024, listings[name]['seconds'],
+                listings[name]['rss_peak_mb']
+            ))
+
+    return {
+        "dataset": args.dataset,
+        "size": dataset.dict(),
+        "duration": args.duration,
+        "concurrency": args.concurrency,
+        "timestamp": now,
+        "commit": git_commit(),
+        "scenarios": results,
+        "listings": listings
+    }
+
+
+async def fanout(url: str, args) -> dict:
+    """ Bid on one auction at --rate bids per second and time the delivery of the events to every subscriber """
+    stamp = int(time.time() * 1000)
+    seller, bidders = "fanout-seller-%d@bench.test" % stamp, ["fanout-bidder%d-%d@bench.test" % (i, stamp) for i in (1, 2)]
+    with AuctionClient(url) as client:
+        for email in [seller] + bidders:
+            client.register(User(name="Fanout", surname="Bench", email=email, password=_PASSWORD))
+            client.login(email, _PASSWORD)
+        auction = client.add_auction(NewAuction(exp_time=1, exp_type="hours", item=Item(
+            title="Fanout item %d" % stamp, condition="New", description="The auction that everybody follows"
+        )), seller)
+        tokens = client.tokens
+
+    sent_at: dict[float, float] = {}
+    latencies: list[float] = []
+    subscribed = 0
+    everyone_in = asyncio.Event()
+    limits = httpx.Limits(max_connections=args.subscribers, max_keepalive_connections=args.subscribers)
+
+    async def subscriber(stream: AsyncAuctionClient, email: str):
+        nonlocal subscribed
+        async for event in stream.events(email, None if args.channel == "global" else auction):
+            if event.event == "subscribed":
+                subscribed += 1
+                if subscribed == args.subscribers:
+                    everyone_in.set()
+            elif event.event == "bid-accepted" and event.data['bid'] in sent_at:
+                latencies.append(time.perf_counter() - sent_at[event.data['bid']])
+
+    async with AsyncAuctionClient(url, tokens=tokens, limits=limits, timeout=None) as stream, \
+            AsyncAuctionClient(url, tokens=tokens, timeout=30) as bidding:
+        listeners = [asyncio.create_task(subscriber(stream, bidders[i % 2])) for i in range(args.subscribers)]
+        await asyncio.wait_for(everyone_in.wait(), 300)
+        print("%d subscribers are listening, bidding..." % subscribed)
+
+        posts = []
+        for amount in range(1, args.bids + 1):
+            sent_at[amount] = time.perf_counter()
+            started = time.perf_counter()
+            await bidding.bid(auction, amount, bidders[amount % 2])
+            posts.append(time.perf_counter() - started)
+            await asyncio.sleep(max(0.0, 1 / args.rate - posts[-1]))
+
+        # Let the last events arrive
+        expected = args.subscribers * args.bids
+        deadline = time.perf_counter() + 30
+        while len(latencies) < expected and time.perf_counter() < deadline:
+            await asyncio.sleep(0.1)
+        for each in listeners:
+            each.cancel()
+        await asyncio.gather(*listeners, return_exceptions=True)
+
+    return {
+        "subscribers": args.subscribers,
+        "channel": args.channel,
+        "bids": args.bids,
+        "delivered": len(latencies),
+        "delivery_ratio": round(len(latencies) / expected, 4),
+        "delivery": summary(latencies),
+        "bid_post": summary(posts),
+        "timestamp": stamp // 1000,
+        "commit": git_commit()
+    }
+
+
+async def scaling(db_uri: str, args) -> dict:
+    """ The scenarios against a cluster of each number of --workers, the throughput should grow with them """
+    runs = {}
+    for count in args.workers:
+        server = Server(db_uri, CLUSTER_WORKERS=str(count)).start()
+        try:
+            with AuctionClient(server.url) as client:
+                wait_for(lambda: client.health().count == count, 60, "The cluster of %d workers" % count)
+            print("%d workers:" % count)
+            runs[str(count)] = await benchmark(server.url, db_uri, args, server)
+        finally:
+            server.stop()
+        args.seed = False
+
+    first = runs[str(args.workers[0])]['scenarios']
+    output = [["scenario"] + ["%d workers" % count for count in args.workers]]
+    for name, base in first.items():
+        row = [name]
+        for count in args.workers:
+            throughput = runs[str(count)]['scenarios'][name]['throughput']
+            row.append("%.1f req/s (x%.2f)" % (throughput, throughput / base['throughput'] if base['throughput'] else 0))
+        output.append(row)
+    print(tabulate(output, headers='firstrow', tablefmt="psql"))
+    return {"workers": args.workers, "runs": runs}
+
+
+def compare(baseline: dict, current: dict, threshold: float) -> int:
+    """ Print the scenarios side by side, return how many of them regressed """
+    output = [['Scenario', 'p95 before', 'p95 now', 'p95 change', 'req/s before', 'req/s now', 'req/s change', '']]
+    regressions = 0
+    for name, now in current['scenarios'].items():
+        before = baseline['scenarios'].get(name)
+        if before is None:
+            output.append([name, "-", now['p95'], "-", "-", now['throughput'], "-", "new"])
+            continue
+        latency = now['p95'] / before['p95'] - 1 if before['p95'] else 0.0
+        throughput = now['throughput'] / before['throughput'] - 1 if before['throughput'] else 0.0
+        regressed = latency > threshold or throughput < -threshold
+        regressions += regressed
+        output.append([
+            name, before['p95'], now['p95'], "%+.1f%%" % (latency * 100),
+            before['throughput'], now['throughput'], "%+.1f%%" % (throughput * 100),
+            "REGRESSION" if regressed else "ok"
+        ])
+    print(tabulate(output, headers='firstrow', tablefmt="psql"))
+
+    output = [['Listing', 'bytes before', 'bytes now', 'bytes change', 'peak RSS before', 'peak RSS now', 'RSS change', '']]
+    for name, now in current.get('listings', {}).items():
+        before = baseline.get('listings', {}).get(name)
+        if before is None:
+            output.append([name, "-", now['bytes'], "-", "-", now['rss_peak_mb'], "-", "new"])
+            continue
+        size = now['bytes'] / before['bytes'] - 1 if before['bytes'] else 0.0
+        memory = now['rss_peak_mb'] / before['rss_peak_mb'] - 1 if before['rss_peak_mb'] and now['rss_peak_mb'] else 0.0
+        regressed = size > threshold or memory > threshold
+        regressions += regressed
+        output.append([
+            name, before['bytes'], now['bytes'], "%+.1f%%" % (size * 100),
+            before['rss_peak_mb'], now['rss_peak_mb'], "%+.1f%%" % (memory * 100),
+            "REGRESSION" if regressed else "ok"
+        ])
+    if len(output) > 1:
+        print(tabulate(output, headers='firstrow', tablefmt="psql"))
+
+    # Where the time moved, for reading the regressions above
+    output = [['Scenario', 'stage', 'ms before', 'ms now']]
+    for name, now in current['scenarios'].items():
+        before = (baseline['scenarios'].get(name) or {}).get('breakdown') or {}
+        for stage, milliseconds in ((now.get('breakdown') or {}).get('stages_ms') or {}).items():
+            output.append([name, stage, before.get('stages_ms', {}).get(stage, "-"), milliseconds])
+    if len(output) > 1:
+        print(tabulate(output, headers='firstrow', tablefmt="psql"))
+    return regressions
+
+
+@contextlib.contextmanager
+def stack(args, serve: bool = True):
+    """ The server given with --url (and its --db), or a throwaway MongoDB and server (unless `serve` is false) """
+    if args.url:
+        yield args.url, args.db, None
+        return
+    mongo = Mongo().start()
+    server = None
+    try:
+        db_uri = mongo.uri + "auction_bench"
+        if not serve:
+            yield None, db_uri, None
+            return
+        server = Server(db_uri).start()
+        yield server.url, db_uri, server
+    finally:
+        if server is not None:
+            server.stop()
+        mongo.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Auction API endpoint benchmarks")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run = commands.add_parser("run", help="seed a dataset and benchmark the endpoints")
+    run.add_argument("--dataset", choices=list(DATASETS), default="1k")
+    run.add_argument("--duration", type=float, default=10, help="seconds per scenario")
+    run.add_argument("--concurrency", type=int, default=50, help="requests in flight")
+    run.add_argument("--scenarios", nargs="*", help="only these scenarios, e.g. auction/bid or listing/ndjson")
+    run.add_argument("--url", help="an already running server, e.g. http://127.0.0.1:8080/api/")
+    run.add_argument("--db", help="the database of that server, e.g. mongodb://127.0.0.1:27017/AuctionApp")
+    run.add_argument("--no-seed", dest="seed", action="store_false", help="the dataset is in the database already")
+    run.add_argument("--out", default="results.json")
+
+    diff = commands.add_parser("compare", help="compare results with a baseline")
+    diff.add_argument("baseline")
+    diff.add_argument("current")
+    diff.add_argument("--threshold", type=float, default=0.1, help="tolerated change, 0.1 is 10%%")
+
+    events = commands.add_parser("fanout", help="time the bid events delivered to many subscribers")
+    events.add_argument("--subscribers", type=int, default=1000)
+    events.add_argument("--bids", type=int, default=50)
+    events.add_argument("--rate", type=float, default=10, help="bids per second")
+    events.add_argument("--channel", choices=["auction", "global"], default="auction")
+    events.add_argument("--url", help="an already running server, e.g. http://127.0.0.1:8080/api/")
+    events.add_argument("--db", help=argparse.SUPPRESS)
+    events.add_argument("--out", default="fanout.json")
+
+    cores = commands.add_parser("scaling", help="throughput of the server in cluster mode with 1..N workers")
+    cores.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    cores.add_argument("--dataset", choices=list(DATASETS), default="1k")
+    cores.add_argument("--duration", type=float, default=10, help="seconds per scenario")
+    cores.add_argument("--concurrency", type=int, default=200, help="requests in flight")
+    cores.add_argument(
+        "--scenarios", nargs="*", default=["auth/login", "auction/bid", "auction/noexpired", "mix/read-heavy/no-cache"]
+    )
+    cores.add_argument("--out", default="scaling.json")
+    cores.set_defaults(url=None, db=None, seed=True)
+
+    args = parser.parse_args()
+    if args.command == "run" and args.url and not args.db:
+        parser.error("--url needs --db to seed and sample the dataset")
+
+    if args.command == "compare":
+        with open(args.baseline) as baseline, open(args.current) as current:
+            sys.exit(1 if compare(json.load(baseline), json.load(current), args.threshold) else 0)
+
+    if args.command == "fanout":
+        # Every subscriber holds a socket here and one in the server, which inherits the limit
+        _, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+    with stack(args, serve=args.command != "scaling") as (url, db_uri, server):
+        if args.command == "scaling":
+            results = asyncio.run(scaling(db_uri, args))
+        elif args.command == "fanout":
+            results = asyncio.run(fanout(url, args))
+            print("Delivered %d of %d events (%.2f%%) to %d subscribers, p50 %.2fms p95 %.2fms p99 %.2fms" % (
+                results['delivered'], args.subscribers * args.bids, results['delivery_ratio'] * 100,
+                args.subscribers, results['delivery']['p50'], results['delivery']['p95'], results['delivery']['p99']
+            ))
+        else:
+            results = asyncio.run(benchmark(url, db_uri, args, server))
+
+    with open(args.out, "w") as out:
+        json.dump(results, out, indent=2)
+    print("Results written to " + args.out)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,574 @@
+"""
+    Python client for the Auction API.
+
+    One client keeps one pooled keep-alive connection pool for every user it talks on behalf of, and caches
+    the auth-token of each logged user (keyed by email), so that requests do not pay for a new connection
+    or a token lookup. AuctionClient is blocking, AsyncAuctionClient has the same methods as coroutines.
+
+    The low level `get`/`post` return the raw httpx responses (the tests assert on status codes and messages),
+    everything else returns the pydantic models below.
+"""
+import asyncio
+import json
+import re
+from typing import AsyncIterator, Iterable, Iterator, Optional
+
+import httpx
+from fastapi.encoders import jsonable_encoder
+from pydantic import BaseModel, Field
+
+_URL = "http://127.0.0.1:8080/api/"
+
+
+class User(BaseModel):
+    name: str = "test"
+    surname: str = "test1"
+    email: str = "test2"
+    password: str = "test3"
+
+
+class Item(BaseModel):
+    title: str
+    condition: str
+    description: str
+
+
+class Bid(BaseModel):
+    user: str
+    bid: float
+    date: Optional[float] = None
+    seq: Optional[int] = None  # position in the auction, only in the bid history
+
+
+class Auction(BaseModel):
+    id: str = Field(alias="_id")
+    starting_price: float = 0
+    reg_date: int = 0
+    exp_date: int
+    last_bids: list[Bid] = []
+    highest_bid: float = 0
+    current_price: Optional[float] = None
+    highest_bidder: Optional[str] = None
+    bid_count: int = 0
+    closed: bool = False
+    winner_id: Optional[str] = None
+    final_price: Optional[float] = None
+    seller_id: str = ""
+    seller_name: str = ""
+    item: Item
+
+    class Config:
+        allow_population_by_field_name = True
+
+
+class NewAuction(BaseModel):
+    """ Body of the auction/add request """
+    starting_price: float = 0
+    exp_time: int
+    exp_type: str = "seconds"
+    item: Item
+
+
+class NewBid(BaseModel):
+    """ Body of the auction/bid request, one record of auction/bid/bulk """
+    item_id: str
+    bid: int
+
+
+class BulkError(BaseModel):
+    index: int  # of the record in the input
+    message: str
+
+
+class BulkAdded(BaseModel):
+    added: int
+    failed: int
+    auction_ids: list[Optional[str]]  # in the order of the input, None for the failed records
+    errors: list[BulkError]
+
+
+class BulkPlaced(BaseModel):
+    placed: int
+    rejected: int
+    errors: list[BulkError]
+
+
+class Metadata(BaseModel):
+    current_page: Optional[int]  # None when the page was selected by cursor
+    current_limit: int
+    total_records: Optional[int]  # None in the search, which does not count its matches
+    total_pages: Optional[int]
+    has_more: bool
+    next_cursor: Optional[str] = None
+
+
+class Page(BaseModel):
+    message: str
+    data: list[Auction]
+    metadata: Metadata
+
+
+class SummaryPage(BaseModel):
+    """ A page of auctions with only some of their fields (?fields=) """
+    message: str
+    data: list[dict]
+    metadata: Metadata
+
+
+class BidPage(BaseModel):
+    message: str
+    data: list[Bid]
+    metadata: Metadata
+
+
+class Event(BaseModel):
+    """ A server-sent event of an auction (bid-accepted, outbid or auction-closed) """
+    id: Optional[int] = None
+    event: str = "message"
+    data: dict = {}
+
+
+def _events(lines: Iterable[str]) -> Iterator[Event]:
+    """ Parse the lines of a text/event-stream, the comments (heartbeats) are skipped """
+    fields: dict[str, str] = {}
+    for line in lines:
+        line = line.rstrip("\r\n")
+        if line == "":
+            if "data" in fields:
+                yield Event(id=fields.get("id"), event=fields.get("event", "message"), data=json.loads(fields["data"]))
+            fields = {}
+        elif not line.startswith(":"):
+            name, _, value = line.partition(":")
+            fields[name] = value[1:] if value.startswith(" ") else value
+
+
+class WorkerHealth(BaseModel):
+    """ The health report of one server process (one worker of a cluster) """
+    pid: int
+    worker: int = 0
+    leader: bool = True
+    uptime: float = 0
+    in_flight: int = 0
+    served: int = 0
+    subscribers: int = 0
+    passwords: dict[str, int] = {}  # the password threads, busy and queued jobs
+    rss: int = 0
+    heap_used: int = 0
+    event_loop_lag: dict[str, float] = {}
+
+
+class Health(BaseModel):
+    worker: WorkerHealth  # the process that answered
+    workers: list[WorkerHealth]  # every worker of the cluster, as last reported to the primary
+    count: int
+
+
+class Metrics:
+    """ A scrape of /api/metrics, the samples of the Prometheus text format """
+
+    _sample = re.compile(r'^([a-zA-Z_:][a-zA-Z0-9_:]*)(?:\{(.*)\})?\s+(\S+)$')
+    _label = re.compile(r'([a-zA-Z_][a-zA-Z0-9_]*)="((?:[^"\\]|\\.)*)"')
+
+    def __init__(self, text: str):
+        self.samples: list[tuple[str, dict[str, str], float]] = []
+        self.types: dict[str, str] = {}  # metric name => counter, gauge, histogram or summary
+        for line in text.splitlines():
+            if line.startswith("# TYPE "):
+                name, kind = line[len("# TYPE "):].split(" ", 1)
+                self.types[name] = kind
+            match = self._sample.match(line)
+            if match is None or line.startswith("#"):
+                continue
+            labels = {
+                name: re.sub(r'\\(.)', lambda escaped: "\n" if escaped.group(1) == "n" else escaped.group(1), value)
+                for name, value in self._label.findall(match.group(2) or "")
+            }
+            self.samples.append((match.group(1), labels, float(match.group(3))))
+
+    def sum(self, name: str, exclude: Optional[dict[str, str]] = None, **labels: str) -> float:
+        """ The sum of the samples of a metric with these labels, leaving out the ones whose labels start with `exclude` """
+        return sum(
+            value for each, each_labels, value in self.samples
+            if each == name and all(each_labels.get(key) == wanted for key, wanted in labels.items())
+            and not any(each_labels.get(key, "").startswith(prefix) for key, prefix in (exclude or {}).items())
+        )
+
+    def labels(self, name: str, label: str) -> set[str]:
+        """ Every value of a label of a metric """
+        return {each_labels[label] for each, each_labels, _ in self.samples if each == name and label in each_labels}
+
+
+class Details(BaseModel):
+    email: str
+    name: str
+    surname: str
+    registered: int
+
+
+class ApiError(Exception):
+    """ The API answered with an error status or an unexpected message """
+
+    def __init__(self, response: httpx.Response):
+        self.status_code = response.status_code
+        try:
+            self.message = response.json().get("message", response.text)
+        except ValueError:
+            self.message = response.text
+        super().__init__("%d: %s" % (self.status_code, self.message))
+
+
+def _checked(response: httpx.Response, expected: Optional[str] = None) -> dict:
+    """ Return the JSON body of a successful response, raise ApiError otherwise """
+    if response.status_code >= 400:
+        raise ApiError(response)
+    body = response.json()
+    if expected is not None and body.get("message") != expected:
+        raise ApiError(response)
+    return body
+
+
+class _BaseClient:
+    """ Request building shared by the sync and async clients """
+
+    def __init__(self, url: str = _URL, tokens: Optional[dict[str, str]] = None):
+        self.url = url
+        # Tokens of the logged users keyed by email, can be shared between clients
+        self.tokens: dict[str, str] = {} if tokens is None else tokens
+
+    def headers(self, user: Optional[str] = None) -> dict:
+        headers = {"accept": "application/json"}
+        if user is not None:
+            headers["auth-token"] = self.tokens[user]
+        return headers
+
+    @staticmethod
+    def page_params(page: int, limit: int, cursor: Optional[str] = None) -> dict:
+        """ Pages are selected by number, or by the next_cursor of the previous page for deep pages """
+        return {"limit": limit, "cursor": cursor} if cursor is not None else {"page": page, "limit": limit}
+
+    @staticmethod
+    def export_params(fields: Optional[str] = None) -> dict:
+        return {"format": "ndjson"} if fields is None else {"format": "ndjson", "fields": fields}
+
+    def ndjson_headers(self, user: str) -> dict:
+        return {**self.headers(user), "content-type": "application/x-ndjson"}
+
+    @staticmethod
+    def ndjson(records: Iterable) -> Iterator[bytes]:
+        """ The records as NDJSON lines, streamed to the bulk endpoints as they are produced """
+        for each in records:
+            yield (json.dumps(jsonable_encoder(each)) + "\n").encode()
+
+
+class AuctionClient(_BaseClient):
+    """ Blocking client, one connection pool for all users """
+
+    def __init__(self, url: str = _URL, tokens: Optional[dict[str, str]] = None, **options):
+        super().__init__(url, tokens)
+        self.http = httpx.Client(**options)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.http.close()
+
+    def get(self, endpoint: str, user: Optional[str] = None, params: Optional[dict] = None) -> httpx.Response:
+        return self.http.get(self.url + endpoint, params=params, headers=self.headers(user))
+
+    def post(self, endpoint: str, body=None, user: Optional[str] = None) -> httpx.Response:
+        return self.http.post(
+            self.url + endpoint, json=None if body is None else jsonable_encoder(body), headers=self.headers(user)
+        )
+
+    def register(self, user: User) -> str:
+        return _checked(self.post("auth/register", user))["message"]
+
+    def login(self, email: str, password: str) -> str:
+        """ Log the user in and cache the token """
+        body = _checked(self.post("auth/login", {"email": email, "password": password}))
+        self.tokens[email] = body["auth-token"]
+        return self.tokens[email]
+
+    def login_many(self, users: Iterable[User]) -> dict[str, str]:
+        return {each_user.email: self.login(each_user.email, each_user.password) for each_user in users}
+
+    def details(self, user: str) -> Details:
+        return Details(**_checked(self.get("user/details", user), "Success")["user"])
+
+    def health(self) -> Health:
+        return Health(**_checked(self.get("health"), "Success")["data"])
+
+    def metrics(self) -> Metrics:
+        response = self.get("metrics")
+        if response.status_code >= 400:
+            raise ApiError(response)
+        return Metrics(response.text)
+
+    def add_auction(self, auction: NewAuction, user: str) -> str:
+        """ Post an auction for sale and return its id """
+        return _checked(self.post("auction/add", auction, user), "The new Item has been added to the auction")["auction_id"]
+
+    def add_many(self, auctions: Iterable[NewAuction], user: str) -> list[str]:
+        return [self.add_auction(each_auction, user) for each_auction in auctions]
+
+    def bid(self, item_id: str, bid: int, user: str) -> str:
+        """ Place a bid and return the API message (rejected bids are not errors) """
+        return _checked(self.post("auction/bid", {"item_id": item_id, "bid": bid}, user))["message"]
+
+    def add_bulk(self, auctions: Iterable[NewAuction], user: str) -> BulkAdded:
+        """ Add any number of auctions of the user with one streamed request """
+        response = self.http.post(
+            self.url + "auction/add/bulk", content=self.ndjson(auctions), headers=self.ndjson_headers(user), timeout=None
+        )
+        return BulkAdded(**_checked(response, "Success"))
+
+    def bid_bulk(self, bids: Iterable[NewBid], user: str) -> BulkPlaced:
+        """ Place any number of bids of the user with one streamed request, as if one by one in order """
+        response = self.http.post(
+            self.url + "auction/bid/bulk", content=self.ndjson(bids), headers=self.ndjson_headers(user), timeout=None
+        )
+        return BulkPlaced(**_checked(response, "Success"))
+
+    def auctions(
+            self, auction_type: str, user: str, page: int = 1, limit: int = 10, cursor: Optional[str] = None
+    ) -> Page:
+        response = self.get("auction/" + auction_type, user, self.page_params(page, limit, cursor))
+        return Page(**_checked(response, "Success"))
+
+    def history(
+            self, history_type: str, user: str, page: int = 1, limit: int = 10, cursor: Optional[str] = None
+    ) -> Page:
+        response = self.get("user/history/" + history_type, user, self.page_params(page, limit, cursor))
+        return Page(**_checked(response, "Success"))
+
+    def search(self, user: str, limit: int = 10, cursor: Optional[str] = None, **filters) -> Page:
+        """ A page of auction/search, the filters are q, condition, min_price, max_price, seller_id and sort """
+        response = self.get("auction/search", user, {**filters, **self.page_params(1, limit, cursor)})
+        return Page(**_checked(response, "Success"))
+
+    def all_pages(self, auction_type: str, user: str, limit: int = 100) -> list[Auction]:
+        """ Walk every page of auction/:type following the cursors, so deep pages cost the same as the first """
+        auctions, cursor = [], None
+        while True:
+            result = self.auctions(auction_type, user, limit=limit, cursor=cursor)
+            auctions.extend(result.data)
+            if not result.metadata.has_more:
+                return auctions
+            cursor = result.metadata.next_cursor
+
+    def summaries(
+            self, auction_type: str, user: str, fields: str = "summary", page: int = 1, limit: int = 10,
+            cursor: Optional[str] = None
+    ) -> SummaryPage:
+        """ A page of auction/:type with only the given fields (a comma separated list or "summary") """
+        params = {**self.page_params(page, limit, cursor), "fields": fields}
+        return SummaryPage(**_checked(self.get("auction/" + auction_type, user, params), "Success"))
+
+    def export(self, auction_type: str, user: str, fields: Optional[str] = None) -> Iterator[dict]:
+        """ Stream every auction of auction/:type as NDJSON, one record at a time """
+        with self.http.stream(
+                "GET", self.url + "auction/" + auction_type, params=self.export_params(fields), headers=self.headers(user)
+        ) as response:
+            if response.status_code >= 400:
+                response.read()
+                raise ApiError(response)
+            for line in response.iter_lines():
+                if line:
+                    yield json.loads(line)
+
+    def events(self, user: str, item_id: Optional[str] = None) -> Iterator[Event]:
+        """ Follow one auction, or every auction without an id, until the caller stops iterating """
+        endpoint = "events" if item_id is None else "auction/%s/events" % item_id
+        with self.http.stream(
+                "GET", self.url + endpoint, headers={**self.headers(user), "accept": "text/event-stream"}, timeout=None
+        ) as response:
+            if response.status_code >= 400:
+                response.read()
+                raise ApiError(response)
+            yield from _events(response.iter_lines())
+
+    def bids(
+            self, item_id: str, user: str, page: int = 1, limit: int = 10, cursor: Optional[str] = None
+    ) -> BidPage:
+        """ One page of the bid history of an auction, newest first """
+        response = self.get("auction/%s/bids" % item_id, user, self.page_params(page, limit, cursor))
+        return BidPage(**_checked(response, "Success"))
+
+    def all_bids(self, item_id: str, user: str, limit: int = 1000) -> list[Bid]:
+        """ The whole bid history of an auction, oldest first """
+        bids, cursor = [], None
+        while True:
+            result = self.bids(item_id, user, limit=limit, cursor=cursor)
+            bids.extend(result.data)
+            if not result.metadata.has_more:
+                return bids[::-1]
+            cursor = result.metadata.next_cursor
+
+
+class AsyncAuctionClient(_BaseClient):
+    """ Asynchronous client, one connection pool for all users. Batch helpers run with `concurrency` requests at once """
+
+    def __init__(self, url: str = _URL, tokens: Optional[dict[str, str]] = None, concurrency: int = 50, **options):
+        super().__init__(url, tokens)
+        self.http = httpx.AsyncClient(**options)
+        self.concurrency = concurrency
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+    async def close(self):
+        await self.http.aclose()
+
+    async def gather(self, coroutines: Iterable) -> list:
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def limited(coroutine):
+            async with semaphore:
+                return await coroutine
+
+        return await asyncio.gather(*(limited(each) for each in coroutines))
+
+    async def get(self, endpoint: str, user: Optional[str] = None, params: Optional[dict] = None) -> httpx.Response:
+        return await self.http.get(self.url + endpoint, params=params, headers=self.headers(user))
+
+    async def post(self, endpoint: str, body=None, user: Optional[str] = None) -> httpx.Response:
+        return await self.http.post(
+            self.url + endpoint, json=None if body is None else jsonable_encoder(body), headers=self.headers(user)
+        )
+
+    async def register(self, user: User) -> str:
+        return _checked(await self.post("auth/register", user))["message"]
+
+    async def login(self, email: str, password: str) -> str:
+        body = _checked(await self.post("auth/login", {"email": email, "password": password}))
+        self.tokens[email] = body["auth-token"]
+        return self.tokens[email]
+
+    async def login_many(self, users: Iterable[User]) -> dict[str, str]:
+        users = list(users)
+        tokens = await self.gather(self.login(each_user.email, each_user.password) for each_user in users)
+        return dict(zip([each_user.email for each_user in users], tokens))
+
+    async def details(self, user: str) -> Details:
+        return Details(**_checked(await self.get("user/details", user), "Success")["user"])
+
+    async def health(self) -> Health:
+        return Health(**_checked(await self.get("health"), "Success")["data"])
+
+    async def metrics(self) -> Metrics:
+        response = await self.get("metrics")
+        if response.status_code >= 400:
+            raise ApiError(response)
+        return Metrics(response.text)
+
+    async def add_auction(self, auction: NewAuction, user: str) -> str:
+        response = await self.post("auction/add", auction, user)
+        return _checked(response, "The new Item has been added to the auction")["auction_id"]
+
+    async def add_many(self, auctions: Iterable[NewAuction], user: str) -> list[str]:
+        return await self.gather(self.add_auction(each_auction, user) for each_auction in auctions)
+
+    async def bid(self, item_id: str, bid: int, user: str) -> str:
+        return _checked(await self.post("auction/bid", {"item_id": item_id, "bid": bid}, user))["message"]
+
+    async def _stream(self, records: Iterable) -> AsyncIterator[bytes]:
+        for line in self.ndjson(records):
+            yield line
+
+    async def add_bulk(self, auctions: Iterable[NewAuction], user: str) -> BulkAdded:
+        response = await self.http.post(
+            self.url + "auction/add/bulk", content=self._stream(auctions), headers=self.ndjson_headers(user), timeout=None
+        )
+        return BulkAdded(**_checked(response, "Success"))
+
+    async def bid_bulk(self, bids: Iterable[NewBid], user: str) -> BulkPlaced:
+        response = await self.http.post(
+            self.url + "auction/bid/bulk", content=self._stream(bids), headers=self.ndjson_headers(user), timeout=None
+        )
+        return BulkPlaced(**_checked(response, "Success"))
+
+    async def auctions(
+            self, auction_type: str, user: str, page: int = 1, limit: int = 10, cursor: Optional[str] = None
+    ) -> Page:
+        response = await self.get("auction/" + auction_type, user, self.page_params(page, limit, cursor))
+        return Page(**_checked(response, "Success"))
+
+    async def history(
+            self, history_type: str, user: str, page: int = 1, limit: int = 10, cursor: Optional[str] = None
+    ) -> Page:
+        response = await self.get("user/history/" + history_type, user, self.page_params(page, limit, cursor))
+        return Page(**_checked(response, "Success"))
+
+    async def search(self, user: str, limit: int = 10, cursor: Optional[str] = None, **filters) -> Page:
+        """ A page of auction/search, the filters are q, condition, min_price, max_price, seller_id and sort """
+        response = await self.get("auction/search", user, {**filters, **self.page_params(1, limit, cursor)})
+        return Page(**_checked(response, "Success"))
+
+    async def all_pages(self, auction_type: str, user: str, limit: int = 100) -> list[Auction]:
+        """ Walk every page of auction/:type following the cursors, so deep pages cost the same as the first """
+        auctions, cursor = [], None
+        while True:
+            result = await self.auctions(auction_type, user, limit=limit, cursor=cursor)
+            auctions.extend(result.data)
+            if not result.metadata.has_more:
+                return auctions
+            cursor = result.metadata.next_cursor
+
+    async def summaries(
+            self, auction_type: str, user: str, fields: str = "summary", page: int = 1, limit: int = 10,
+            cursor: Optional[str] = None
+    ) -> SummaryPage:
+        params = {**self.page_params(page, limit, cursor), "fields": fields}
+        return SummaryPage(**_checked(await self.get("auction/" + auction_type, user, params), "Success"))
+
+    async def export(self, auction_type: str, user: str, fields: Optional[str] = None) -> AsyncIterator[dict]:
+        """ Stream every auction of auction/:type as NDJSON, one record at a time """
+        async with self.http.stream(
+                "GET", self.url + "auction/" + auction_type, params=self.export_params(fields), headers=self.headers(user)
+        ) as response:
+            if response.status_code >= 400:
+                await response.aread()
+                raise ApiError(response)
+            async for line in response.aiter_lines():
+                if line:
+                    yield json.loads(line)
+
+    async def events(self, user: str, item_id: Optional[str] = None) -> AsyncIterator[Event]:
+        """ Follow one auction, or every auction without an id, until the caller stops iterating """
+        endpoint = "events" if item_id is None else "auction/%s/events" % item_id
+        async with self.http.stream(
+                "GET", self.url + endpoint, headers={**self.headers(user), "accept": "text/event-stream"}, timeout=None
+        ) as response:
+            if response.status_code >= 400:
+                await response.aread()
+                raise ApiError(response)
+            lines = []
+            async for line in response.aiter_lines():
+                lines.append(line)
+                if line.rstrip("\r\n") == "":
+                    for each in _events(lines):
+                        yield each
+                    lines = []
+
+    async def bids(
+            self, item_id: str, user: str, page: int = 1, limit: int = 10, cursor: Optional[str] = None
+    ) -> BidPage:
+        response = await self.get("auction/%s/bids" % item_id, user, self.page_params(page, limit, cursor))
+        return BidPage(**_checked(response, "Success"))
+
+    async def all_bids(self, item_id: str, user: str, limit: int = 1000) -> list[Bid]:
+        """ The whole bid history of an auction, oldest first """
+        bids, cursor = [], None
+        while True:
+            result = await self.bids(item_id, user, limit=limit, cursor=cursor)
+            bids.extend(result.data)
+            if not result.metadata.has_more:
+                return bids[::-1]
+            cursor = result.metadata.next_cursor
@@ -0,0 +1,40 @@
+"""
+    Every test run is hermetic: it gets its own MongoDB and every pytest-xdist worker gets its own Express
+    app on a free port, connected to its own database (auction_<worker>). The tests find them through the
+    AUCTION_URL and AUCTION_DB environment variables, which are set here before testing.py is imported.
+
+    To run against servers that are already up, set AUCTION_MONGO (a MongoDB uri ending with "/") or
+    AUCTION_URL and AUCTION_DB yourself.
+"""
+import os
+
+import pymongo
+
+from harness import Mongo, Server
+
+
+def pytest_configure(config):
+    worker = getattr(config, "workerinput", {}).get("workerid")
+
+    # The controller (or a run without xdist) owns MongoDB, the workers inherit its uri
+    if worker is None and "AUCTION_MONGO" not in os.environ and "AUCTION_URL" not in os.environ:
+        config.auction_mongo = Mongo().start()
+        os.environ["AUCTION_MONGO"] = config.auction_mongo.uri
+    if worker is None and getattr(config.option, "numprocesses", None):
+        return
+
+    if "AUCTION_URL" in os.environ:
+        return
+    name = "auction_" + (worker or "main")
+    db = os.environ["AUCTION_MONGO"] + name
+    pymongo.MongoClient(db).drop_database(name)
+    config.auction_server = Server(db).start()
+    os.environ["AUCTION_URL"] = config.auction_server.url
+    os.environ["AUCTION_DB"] = db
+
+
+def pytest_unconfigure(config):
+    if hasattr(config, "auction_server"):
+        config.auction_server.stop()
+    if hasattr(config, "auction_mongo"):
+        config.auction_mongo.stop()
@@ -0,0 +1,129 @@
+"""
+    Starts what the tests run against: a throwaway MongoDB and the Express app on a free port.
+
+    MongoDB is a local `mongod` in a temporary directory when it is installed, otherwise the in-memory
+    stand-in of mongodb-memory-server (tests/mongo_memory.js, `npm install --no-save mongodb-memory-server@8`
+    first, it is not in the lockfile). Either way it is a single member replica set,
+    so that the verifier can follow the writes with a change stream. The app is started with the test clock
+    enabled and its output goes to a log file next to the database, so a failed start can be read.
+"""
+import os
+import shutil
+import socket
+import subprocess
+import tempfile
+import time
+from typing import Optional
+
+import httpx
+import pymongo
+from pymongo.errors import OperationFailure
+
+_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def wait_for(ready, timeout: float, what: str):
+    """ Poll `ready` until it returns true, raise if it takes longer than `timeout` seconds """
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            if ready():
+                return
+        except (OSError, httpx.HTTPError):
+            pass
+        time.sleep(0.1)
+    raise TimeoutError("%s did not start within %ds" % (what, timeout))
+
+
+def _port_open(port: int) -> bool:
+    with socket.create_connection(("127.0.0.1", port), timeout=1):
+        return True
+
+
+class Mongo:
+    """ A MongoDB server of its own, the databases are named by the caller """
+
+    replica_set = "auction"
+
+    def __init__(self):
+        self.directory = tempfile.mkdtemp(prefix="auction-mongo-")
+        self.process: Optional[subprocess.Popen] = None
+        self.uri = ""
+
+    def start(self) -> "Mongo":
+        port = free_port()
+        log = open(os.path.join(self.directory, "mongod.log"), "w")
+        if shutil.which("mongod"):
+            command = [
+                "mongod", "--port", str(port), "--bind_ip", "127.0.0.1", "--dbpath", self.directory,
+                "--replSet", self.replica_set
+            ]
+        else:
+            command = ["node", os.path.join(_ROOT, "tests", "mongo_memory.js"), str(port), self.replica_set]
+        self.process = subprocess.Popen(command, stdout=log, stderr=subprocess.STDOUT)
+        wait_for(lambda: _port_open(port), 120, "MongoDB")
+        self._initiate(port)
+        self.uri = "mongodb://127.0.0.1:%d/" % port
+        return self
+
+    def _initiate(self, port: int):
+        """ Make the server the primary of its replica set, mongodb-memory-server has done it already """
+        with pymongo.MongoClient("127.0.0.1", port, directConnection=True) as admin:
+            try:
+                admin.admin.command("replSetInitiate", {
+                    "_id": self.replica_set, "members": [{"_id": 0, "host": "127.0.0.1:%d" % port}]
+                })
+            except OperationFailure as error:
+                if error.code != 23:  # AlreadyInitialized
+                    raise
+            wait_for(lambda: admin.admin.command("hello").get("isWritablePrimary"), 60, "The MongoDB primary")
+
+    def stop(self):
+        if self.process is not None:
+            self.process.terminate()
+            self.process.wait(30)
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+class Server:
+    """ The Express app on a free port, connected to the given database and with the test clock enabled """
+
+    def __init__(self, db: str, **env: str):
+        self.db = db
+        self.env = env
+        self.process: Optional[subprocess.Popen] = None
+        self.log = tempfile.NamedTemporaryFile("w", prefix="auction-server-", suffix=".log", delete=False)
+        self.url = ""
+
+    def start(self) -> "Server":
+        port = free_port()
+        env = {**os.environ, "DB": self.db, "SERVER_PORT": str(port), "TEST_CLOCK": "true", **self.env}
+        self.process = subprocess.Popen(
+            ["node", "app.js"], cwd=_ROOT, env=env, stdout=self.log, stderr=subprocess.STDOUT
+        )
+        self.url = "http://127.0.0.1:%d/api/" % port
+        wait_for(lambda: httpx.get(self.url + "test/clock").status_code == 200, 60, "The server (%s)" % self.log.name)
+        return self
+
+    def rss(self) -> Optional[int]:
+        """ Resident memory of the server process in bytes, None where /proc is not available """
+        try:
+            with open("/proc/%d/status" % self.process.pid) as status:
+                for line in status:
+                    if line.startswith("VmRSS:"):
+                        return int(line.split()[1]) * 1024
+        except OSError:
+            pass
+        return None
+
+    def stop(self):
+        if self.process is not None:
+            self.process.terminate()
+            self.process.wait(30)
+        self.log.close()
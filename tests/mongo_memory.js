@@ -0,0 +1,22 @@
+// Test only: an in-memory MongoDB replica set of one member for the machines without mongod,
+// on the port and with the replica set name given as the arguments. mongodb-memory-server is
+// not a dependency of the app (npm ci installs what the lockfile has), it is installed on demand.
+let MongoMemoryReplSet
+try {
+    ({ MongoMemoryReplSet } = require('mongodb-memory-server'))
+} catch (error) {
+    console.log("Install mongod, or the in-memory stand-in: npm install --no-save mongodb-memory-server@8")
+    process.exit(1)
+}
+
+MongoMemoryReplSet.create({
+    replSet: { count: 1, name: process.argv[3] },
+    instanceOpts: [{ port: parseInt(process.argv[2]), ip: '127.0.0.1' }]
+}).then(async server => {
+    await server.waitUntilRunning()
+    console.log("MongoDB is running at " + server.getUri())
+    process.on('SIGTERM', async () => {
+        await server.stop()
+        process.exit(0)
+    })
+})
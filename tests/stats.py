@@ -0,0 +1,32 @@
+"""
+    Latency statistics shared by the load generator, the tests and the benchmarks.
+"""
+import math
+import re
+
+# Money amounts and numbers inside the API messages, e.g. "Your bid of £5.00 was placed successfully"
+_AMOUNTS = re.compile(r"[£$€]?\d[\d,]*(\.\d+)?")
+
+
+def message_type(message) -> str:
+    """ Collapse the amounts in an API message, so that all responses of the same kind share one bucket """
+    return _AMOUNTS.sub("#", str(message))
+
+
+def percentile(samples: list[float], p: float) -> float:
+    """ Nearest-rank percentile of an already sorted list of samples """
+    if not samples:
+        return 0.0
+    return samples[min(len(samples) - 1, max(0, math.ceil(p / 100 * len(samples)) - 1))]
+
+
+def summary(samples: list[float]) -> dict[str, float]:
+    """ Count, mean and the usual percentiles of latencies in seconds, reported in milliseconds """
+    samples = sorted(samples)
+    return {
+        "count": len(samples),
+        "mean": round(sum(samples) / len(samples) * 1000, 3) if samples else 0.0,
+        "p50": round(percentile(samples, 50) * 1000, 3),
+        "p95": round(percentile(samples, 95) * 1000, 3),
+        "p99": round(percentile(samples, 99) * 1000, 3),
+    }
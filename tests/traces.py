@@ -0,0 +1,487 @@
+"""
+    Workload traces of the Auction API: generate them, replay them and compare the replays.
+
+        python traces.py generate --users 200 --auctions 1000 --duration 600 --out synthetic.jsonl
+        python traces.py replay synthetic.jsonl --speed 10 --out replayed.jsonl
+        python traces.py replay recorded.jsonl.1 recorded.jsonl.2 --url http://127.0.0.1:8080/api/ --speed max
+        python traces.py summary replayed.jsonl [other.jsonl]
+
+    A trace has one request per JSON line: t (seconds), method, path, route, user, body, status, latency_ms and
+    response. The server records the requests of its clients as a trace with TRACE_FILE=trace.jsonl (see
+    trace.js), every line with the latency and the response it got.
+
+    `generate` writes a synthetic trace from a model of an auction site, the same one for the same --seed: the
+    sellers list --auctions that end over --duration seconds, the bids follow a Zipf curve over the auctions (a
+    few hot items get most of them) and a --snipe share of them come in bursts in the last --snipe-window seconds
+    of the auctions, while the users browse the listings, the search and the bids of the hot items at --reads
+    requests per second.
+
+    `replay` sends the requests of one or more traces (the files of a cluster are merged by time) to a server,
+    or to a throwaway MongoDB and server (see harness.py), at their pace (--speed 1), faster (--speed 10) or as
+    fast as --concurrency requests in flight allow (--speed max). The users and the auctions of the trace are
+    stood in for: every user of the trace gets an account of the replay, the auctions that the trace adds are
+    mapped to the ones the replay adds, and the ones it only refers to are listed beforehand. The lifetimes of
+    the auctions added are divided by the speed, so the bids near the end stay near it. The event streams and
+    the requests without a recorded body (an NDJSON stream) are left out. The replayed requests are written as
+    a trace of their own, with their latency and response, and the ones that got another answer than in the
+    trace (another status or kind of message) are counted.
+
+    `summary` prints the requests, error rate and latency percentiles per route of a trace, and with a second
+    trace the change of each, e.g. to compare the replays of the same workload before and after a change.
+"""
+import argparse
+import asyncio
+import base64
+import contextlib
+import json
+import math
+import random
+import re
+import time
+from typing import Any, Iterable, Optional
+from urllib.parse import parse_qsl, urlencode, urlsplit
+
+import httpx
+from pydantic import BaseModel
+from tabulate import tabulate
+
+from client import AsyncAuctionClient, Item, NewAuction, User
+from harness import Mongo, Server
+from stats import message_type, summary
+
+# What the server records in place of a password (trace.js)
+_REDACTED = "********"
+
+# The accounts of the replay that stand in for the users of the trace
+_PASSWORD = "replay123"
+
+_OBJECT_ID = re.compile(r"^[0-9a-f]{24}$")
+
+# Responses bigger than this are not kept in the replayed trace, like TRACE_RESPONSE_BYTES on the server
+_RESPONSE_BYTES = 4096
+
+_UNITS = [("seconds", 1), ("minutes", 60), ("hours", 3600), ("days", 86400)]
+
+_NOUNS = [
+    "lamp", "chair", "desk", "clock", "vase", "mirror", "guitar", "camera", "bicycle", "watch",
+    "painting", "rug", "teapot", "radio", "typewriter", "globe", "bookcase", "sofa", "kettle", "violin"
+]
+_ADJECTIVES = ["Vintage", "Antique", "Modern", "Brass", "Oak", "Handmade", "Rare", "Classic", "Retro", "Small"]
+
+
+class Traced(BaseModel):
+    """ One request of a trace """
+    t: float
+    method: str
+    path: str
+    route: Optional[str] = None
+    user: Optional[str] = None
+    body: Any = None
+    status: Optional[int] = None
+    latency_ms: Optional[float] = None
+    response: Any = None
+
+
+class Model(BaseModel):
+    """ The parameters of a synthetic trace """
+    users: int = 200
+    auctions: int = 1000
+    duration: float = 600  # seconds
+    bids: int = 20000
+    skew: float = 1.1  # of the Zipf curve of the bids over the auctions
+    snipe: float = 0.4  # the share of the bids in the burst before the end of their auction
+    snipe_window: float = 30  # seconds
+    reads: float = 50  # browsing requests per second
+    seed: int = 1
+
+
+def read(paths: Iterable[str]) -> list[Traced]:
+    """ The requests of the traces, merged by time """
+    lines = []
+    for path in paths:
+        with open(path) as trace:
+            lines.extend(Traced.parse_raw(line) for line in trace if line.strip())
+    return sorted(lines, key=lambda line: line.t)
+
+
+def write(lines: Iterable[Traced], path: str) -> None:
+    with open(path, "w") as trace:
+        for line in lines:
+            trace.write(line.json() + "\n")
+
+
+def lifetime(seconds: float) -> tuple[float, str]:
+    """ exp_time and exp_type of an auction that lasts `seconds`, in the first unit that it fits 365 of """
+    for unit, length in _UNITS:
+        if seconds <= 365 * length or unit == "days":
+            return round(seconds / length, 3), unit
+    raise AssertionError("unreachable")
+
+
+def seconds_of(body: dict) -> float:
+    return float(body["exp_time"]) * dict(_UNITS).get(body.get("exp_type", "seconds"), 1)
+
+
+def generate(model: Model) -> list[Traced]:
+    """
+        A synthetic trace. The auctions are listed in the first fifth of the trace and end over the rest of it,
+        the ids are made up (24 hex digits like the real ones) and the replay maps them to its own.
+    """
+    rng = random.Random(model.seed)
+    users = ["ffff%020x" % i for i in range(model.users)]
+    auctions = ["aaaa%020x" % i for i in range(model.auctions)]
+    lines = []
+
+    # Everybody logs in once, early on
+    for each in users:
+        lines.append(Traced(
+            t=rng.uniform(0, model.duration * 0.05), method="POST", path="/api/auth/login", route="/api/auth/login",
+            user=each, body={"email": each + "@trace.test", "password": _REDACTED}
+        ))
+
+    listed, ends, sellers, prices = [], [], [], []
+    for i, auction_id in enumerate(auctions):
+        listed.append(rng.uniform(0, model.duration * 0.2))
+        ends.append(rng.uniform(max(listed[i] + 60, model.duration * 0.3), max(listed[i] + 60, model.duration)))
+        sellers.append(rng.choice(users))
+        prices.append(rng.choice([0, 1, 5, 10]))
+        exp_time, exp_type = lifetime(ends[i] - listed[i])
+        lines.append(Traced(
+            t=listed[i], method="POST", path="/api/auction/add", route="/api/auction/add", user=sellers[i],
+            body={
+                "starting_price": prices[i], "exp_time": exp_time, "exp_type": exp_type,
+                "item": {
+                    "title": "%s %s %d" % (rng.choice(_ADJECTIVES), rng.choice(_NOUNS), i),
+                    "condition": rng.choice(["New", "Used"]),
+                    "description": "An item of the synthetic trace"
+                }
+            },
+            response={"message": "The new Item has been added to the auction", "auction_id": auction_id}
+        ))
+
+    # A few hot items get most of the bids, many of them in the last seconds
+    ranks = list(range(1, model.auctions + 1))
+    rng.shuffle(ranks)
+    popularity = [1 / rank ** model.skew for rank in ranks]
+    counts = [0] * model.auctions
+    for i in rng.choices(range(model.auctions), weights=popularity, k=model.bids if model.users > 1 else 0):
+        counts[i] += 1
+    for i, count in enumerate(counts):
+        window = min(model.snipe_window, ends[i] - listed[i])
+        times = sorted(
+            max(ends[i] - window, ends[i] - rng.expovariate(3 / window)) if rng.random() < model.snipe and window > 0
+            else rng.uniform(listed[i], ends[i] - window)
+            for _ in range(count)
+        )
+        price = prices[i]
+        for t in times:
+            price += rng.randint(1, 10)
+            bidder = rng.choice(users)
+            while bidder == sellers[i]:
+                bidder = rng.choice(users)
+            lines.append(Traced(
+                t=min(t, ends[i] - 0.5), method="POST", path="/api/auction/bid", route="/api/auction/bid",
+                user=bidder, body={"item_id": auctions[i], "bid": price}
+            ))
+
+    # Browsing, the hot items are looked at more
+    t = rng.expovariate(model.reads) if model.reads > 0 else model.duration
+    while t < model.duration:
+        kind = rng.choices(["listing", "bids", "search", "history"], weights=[35, 25, 25, 15])[0]
+        i = rng.choices(range(model.auctions), weights=popularity)[0]
+        if kind == "bids" and listed[i] < t:
+            path, route = "/api/auction/%s/bids?limit=10" % auctions[i], "/api/auction/:id/bids"
+        elif kind == "search":
+            query = urlencode({"q": rng.choice(_NOUNS), "sort": rng.choice(["ending", "highest_bid", "newest"])})
+            path, route = "/api/auction/search?" + query, "/api/auction/search"
+        elif kind == "history":
+            path, route = "/api/user/history/%s?page=1" % rng.choice(["won", "lost", "sold"]), "/api/user/history/:type"
+        else:
+            path, route = "/api/auction/noexpired?page=%d&limit=10" % rng.randint(1, 3), "/api/auction/:type"
+        lines.append(Traced(t=t, method="GET", path=path, route=route, user=rng.choice(users)))
+        t += rng.expovariate(model.reads)
+
+    return sorted(lines, key=lambda line: line.t)
+
+
+def token_id(token: str) -> str:
+    """ The user id in an auth-token, read without the secret """
+    payload = token.split(".")[1]
+    return json.loads(base64.urlsafe_b64decode(payload + "=" * (-len(payload) % 4)))["_id"]
+
+
+class Standins:
+    """ The users and auctions of the replay that stand in for the ones of a trace """
+
+    def __init__(self, lines: list[Traced]):
+        self.emails: dict[str, str] = {}  # user of the trace => email of the replay account
+        self.ids: dict[str, str] = {}  # user or auction id of the trace => the one of the replay
+        # auction id of the trace => the one of the replay, once the request that adds it is answered
+        self.added: dict[str, asyncio.Future] = {}
+        self.registered = 0
+        self.users, self.referred = set(), set()
+        for line in lines:
+            if line.user is not None:
+                self.users.add(line.user)
+            for key, value in parse_qsl(urlsplit(line.path).query):
+                if key == "seller_id":
+                    self.users.add(value)
+            segments = urlsplit(line.path).path.split("/")
+            if segments[1:3] == ["api", "auction"]:
+                self.referred.update(each for each in segments[3:] if _OBJECT_ID.match(each))
+            for body in line.body if isinstance(line.body, list) else [line.body]:
+                if isinstance(body, dict) and isinstance(body.get("item_id"), str):
+                    self.referred.add(body["item_id"])
+            for auction_id in added_ids(line):
+                if auction_id is not None:
+                    self.added[auction_id] = None
+        self.referred -= set(self.added)
+
+    async def prepare(self, client: AsyncAuctionClient, lasts: float) -> None:
+        """ Log in an account for every user and list the auctions that the trace refers to, for `lasts` seconds """
+        accounts = {each: User(
+            name="Replay", surname="User", email="replay-%s@trace.test" % each, password=_PASSWORD
+        ) for each in sorted(self.users)}
+        seller = User(name="Replay", surname="Seller", email="replay-seller@trace.test", password=_PASSWORD)
+        await client.gather(client.post("auth/register", each) for each in [seller, *accounts.values()])
+        tokens = await client.login_many([seller, *accounts.values()])
+        for each, account in accounts.items():
+            self.emails[each] = account.email
+            self.ids[each] = token_id(tokens[account.email])
+        loop = asyncio.get_running_loop()
+        self.added = {each: loop.create_future() for each in self.added}
+
+        referred = sorted(self.referred)
+        if not referred:
+            return
+        days = math.ceil((lasts + 3600) / 86400)
+        listed = await client.add_bulk((NewAuction(exp_time=days, exp_type="days", item=Item(
+            title="Replay stand-in for %s (%d)" % (each, time.time()), condition="New",
+            description="An auction the trace refers to"
+        )) for each in referred), seller.email)
+        self.ids.update({each: new_id for each, new_id in zip(referred, listed.auction_ids) if new_id is not None})
+
+    async def mapped(self, value: Any) -> Any:
+        """ The value with the ids of the trace replaced by those of the replay """
+        if isinstance(value, dict):
+            return {key: await self.mapped(each) for key, each in value.items()}
+        if isinstance(value, list):
+            return [await self.mapped(each) for each in value]
+        if isinstance(value, str) and value in self.added:
+            return await self.added[value] or value
+        if isinstance(value, str):
+            return self.ids.get(value, value)
+        return value
+
+    async def path(self, path: str) -> str:
+        parts = urlsplit(path)
+        segments = [await self.mapped(each) for each in parts.path.split("/")]
+        query = [(key, await self.mapped(value)) for key, value in parse_qsl(parts.query)]
+        return "/".join(segments) + ("?" + urlencode(query) if query else "")
+
+    def answered(self, line: Traced, response: Optional[dict]) -> None:
+        """ Map the auctions that a request of the trace has added to the ones that the replay added """
+        new_ids = added_ids(Traced(t=0, method=line.method, path=line.path, response=response)) if response else []
+        for i, auction_id in enumerate(added_ids(line)):
+            if auction_id is not None and not self.added[auction_id].done():
+                self.added[auction_id].set_result(new_ids[i] if i < len(new_ids) else None)
+
+
+def added_ids(line: Traced) -> list[Optional[str]]:
+    """ The ids of the auctions that the request added, by its response """
+    if line.method != "POST" or not isinstance(line.response, dict):
+        return []
+    path = urlsplit(line.path).path
+    if path == "/api/auction/add":
+        return [line.response.get("auction_id")] if line.response.get("auction_id") else []
+    if path == "/api/auction/add/bulk":
+        return line.response.get("auction_ids") or []
+    return []
+
+
+def replayable(line: Traced) -> bool:
+    path = urlsplit(line.path).path
+    return not path.endswith("/events") and not (line.method == "POST" and line.body is None)
+
+
+async def replay(url: str, lines: list[Traced], speed: Optional[float], concurrency: int) -> list[Traced]:
+    """
+        Send the requests of the trace at `speed` times their pace (None as fast as possible), with at most
+        `concurrency` of them in flight, and return the replayable ones (see replayable) as they were sent,
+        in the same order
+    """
+    lines = [each for each in lines if replayable(each)]
+    if not lines:
+        return []
+    start = lines[0].t
+    span = (lines[-1].t - start) / (speed or 1)
+    root = re.sub(r"/api/?$", "", url.rstrip("/"))
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with AsyncAuctionClient(url, concurrency=concurrency, limits=limits, timeout=60) as replayer:
+        standins = Standins(lines)
+        await standins.prepare(replayer, span)
+        semaphore = asyncio.Semaphore(concurrency)
+        replayed: list[Traced] = [None] * len(lines)
+
+        async def send(i: int, line: Traced) -> None:
+            response = None
+            try:
+                path, body = urlsplit(line.path).path, await standins.mapped(line.body)
+                if path == "/api/auth/login" and line.user in standins.emails:
+                    body = {"email": standins.emails[line.user], "password": _PASSWORD}
+                elif path == "/api/auth/register":
+                    standins.registered += 1
+                    body = {**body, "email": "replay-new-%d-%d@trace.test" % (time.time(), standins.registered)}
+                elif path == "/api/auction/add" and speed and isinstance(body, dict) and "exp_time" in body:
+                    body["exp_time"], body["exp_type"] = lifetime(seconds_of(body) / speed)
+                sent = await standins.path(line.path)
+                headers = replayer.headers(standins.emails[line.user]) if line.user in standins.emails else {}
+                sent_at, started = time.time(), time.perf_counter()
+                status = None
+                try:
+                    r = await replayer.http.request(line.method, root + sent, json=body, headers=headers)
+                    status = r.status_code
+                    if len(r.content) <= _RESPONSE_BYTES and "json" in r.headers.get("content-type", ""):
+                        response = r.json()
+                except (httpx.HTTPError, ValueError):
+                    pass
+                latency = time.perf_counter() - started
+                # As the server would have recorded it
+                if isinstance(body, dict) and "password" in body:
+                    body = {**body, "password": _REDACTED}
+                replayed[i] = Traced(
+                    t=sent_at, method=line.method, path=sent, route=line.route,
+                    user=standins.ids.get(line.user, line.user), body=body, status=status,
+                    latency_ms=round(latency * 1000, 3), response=response
+                )
+            except Exception:
+                pass  # it could not even be sent, it is recorded below without a status
+            finally:
+                if replayed[i] is None:
+                    replayed[i] = Traced(t=time.time(), method=line.method, path=line.path, route=line.route, user=line.user)
+                # The requests waiting for its auctions go on, with the original ids if it failed
+                standins.answered(line, response)
+                semaphore.release()
+
+        loop = asyncio.get_running_loop()
+        began = loop.time()
+        tasks = []
+        for i, line in enumerate(lines):
+            if speed:
+                delay = began + (line.t - start) / speed - loop.time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            await semaphore.acquire()
+            tasks.append(asyncio.create_task(send(i, line)))
+        await asyncio.gather(*tasks)
+    return replayed
+
+
+def mismatches(recorded: list[Traced], replayed: list[Traced]) -> int:
+    """
+        The requests that got another status or kind of message in the replay than in the trace (when both
+        responses were kept), the replayed ones in the order of the replayable requests of the trace
+    """
+    def differs(original: Traced, line: Traced) -> bool:
+        if original.status != line.status:
+            return True
+        messages = [each.response.get("message") if isinstance(each.response, dict) else None for each in (original, line)]
+        return None not in messages and message_type(messages[0]) != message_type(messages[1])
+
+    recorded = [each for each in recorded if replayable(each)]
+    return sum(
+        original.status is not None and differs(original, line) for original, line in zip(recorded, replayed)
+    )
+
+
+def routes(lines: list[Traced]) -> dict[str, dict]:
+    """ Requests, error rate and latency percentiles per route """
+    grouped: dict[str, list[Traced]] = {}
+    for line in lines:
+        grouped.setdefault("%s %s" % (line.method, line.route or urlsplit(line.path).path), []).append(line)
+    return {
+        route: {
+            **summary([(each.latency_ms or 0) / 1000 for each in group]),
+            "error_rate": round(sum(each.status is None or each.status >= 400 for each in group) / len(group), 4)
+        } for route, group in sorted(grouped.items())
+    }
+
+
+def print_summary(lines: list[Traced], other: Optional[list[Traced]] = None) -> None:
+    first = routes(lines)
+    if other is None:
+        output = [["Route", "requests", "errors", "p50 ms", "p95 ms", "p99 ms"]]
+        for route, each in first.items():
+            output.append([route, each['count'], "%.2f%%" % (each['error_rate'] * 100), each['p50'], each['p95'], each['p99']])
+    else:
+        second = routes(other)
+        output = [["Route", "requests", "p95 before", "p95 now", "p95 change", "errors before", "errors now"]]
+        for route in sorted(set(first) | set(second)):
+            before, now = first.get(route), second.get(route)
+            change = "%+.1f%%" % ((now['p95'] / before['p95'] - 1) * 100) if before and now and before['p95'] else "-"
+            output.append([
+                route, (now or before)['count'], before['p95'] if before else "-", now['p95'] if now else "-", change,
+                "%.2f%%" % (before['error_rate'] * 100) if before else "-",
+                "%.2f%%" % (now['error_rate'] * 100) if now else "-"
+            ])
+    print(tabulate(output, headers='firstrow', tablefmt="psql"))
+
+
+@contextlib.contextmanager
+def server(url: Optional[str]):
+    """ The server at `url`, or a throwaway MongoDB and server """
+    if url:
+        yield url
+        return
+    mongo = Mongo().start()
+    try:
+        app = Server(mongo.uri + "auction_replay").start()
+        try:
+            yield app.url
+        finally:
+            app.stop()
+    finally:
+        mongo.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Record, generate and replay workload traces of the Auction API")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    synthetic = commands.add_parser("generate", help="write a synthetic trace")
+    for name, field in Model.__fields__.items():
+        synthetic.add_argument("--" + name.replace("_", "-"), dest=name, type=field.type_, default=field.default)
+    synthetic.add_argument("--out", default="trace.jsonl")
+
+    again = commands.add_parser("replay", help="replay traces against a server")
+    again.add_argument("traces", nargs="+")
+    again.add_argument("--speed", default="1", help="1 for the pace of the trace, 10 for ten times faster, or max")
+    again.add_argument("--concurrency", type=int, default=100, help="requests in flight at most")
+    again.add_argument("--url", help="an already running server, e.g. http://127.0.0.1:8080/api/")
+    again.add_argument("--out", default="replayed.jsonl")
+
+    report = commands.add_parser("summary", help="latency per route of a trace, or of two of them side by side")
+    report.add_argument("trace")
+    report.add_argument("other", nargs="?")
+
+    args = parser.parse_args()
+    if args.command == "generate":
+        lines = generate(Model(**{name: getattr(args, name) for name in Model.__fields__}))
+        write(lines, args.out)
+        print("%d requests written to %s" % (len(lines), args.out))
+    elif args.command == "replay":
+        speed = None if args.speed == "max" else float(args.speed)
+        recorded = read(args.traces)
+        with server(args.url) as url:
+            replayed = asyncio.run(replay(url, recorded, speed, args.concurrency))
+        write(replayed, args.out)
+        print_summary(replayed)
+        print("%d requests replayed, %d answered otherwise than in the trace, written to %s" % (
+            len(replayed), mismatches(recorded, replayed), args.out
+        ))
+    else:
+        print_summary(read([args.trace]), read([args.other]) if args.other else None)
+
+
+if __name__ == '__main__':
+    main()
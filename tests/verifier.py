@@ -0,0 +1,148 @@
+"""
+    Offline checks of the auction invariants over everything that happened during a run.
+
+    A Recorder follows the bids placed while the load runs, instead of querying the database after every bid.
+    It reads a MongoDB change stream of the bids collection when the server is a replica set (the test harness
+    starts one), otherwise it diffs the bid counts of the auctions at the start with the ones at the end.
+    Afterwards `verify` checks in bulk that:
+        - every accepted bid is stored, the bids of an auction take the positions (seq) 1, 2, 3... without gaps,
+        - the bids of every auction are strictly increasing,
+        - no bid was placed from the exp_date on (an auction ends at its exp_date),
+        - nobody bid for their own item,
+        - the auction summary (highest bid and bidder, bid count) matches the last bid,
+        - the settled winner and final price (in the database and, if given, from the API) match the last bid.
+"""
+import threading
+from typing import Optional
+
+from bson import ObjectId
+from pydantic import BaseModel
+from pymongo.errors import OperationFailure
+
+
+class RecordedBid(BaseModel):
+    user: str
+    bid: float
+    date: Optional[float] = None
+    seq: int
+
+
+class Violation(BaseModel):
+    auction: str
+    rule: str
+    detail: str
+
+    def __str__(self) -> str:
+        return "%s: %s (%s)" % (self.auction, self.rule, self.detail)
+
+
+class Recorder:
+    """ Records the bids stored in the database between start() and stop() """
+
+    def __init__(self, db):
+        self.auctions = db['auctions']
+        self.collection = db['bids']
+        self.bids: dict[str, list[RecordedBid]] = {}
+        self.mode = ""
+        self._stream = None
+        self._thread: Optional[threading.Thread] = None
+        self._stopped = threading.Event()
+        self._snapshot: dict[str, int] = {}
+
+    def __enter__(self) -> "Recorder":
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def _bid_counts(self) -> dict[str, int]:
+        return {str(each['_id']): each.get('bid_count', 0) for each in self.auctions.find({}, {"bid_count": 1})}
+
+    def _record(self, bid: dict):
+        self.bids.setdefault(str(bid['auction_id']), []).append(RecordedBid(**bid))
+
+    def start(self) -> "Recorder":
+        try:
+            self._stream = self.collection.watch([{"$match": {"operationType": "insert"}}], max_await_time_ms=100)
+            self.mode = "change stream"
+            self._thread = threading.Thread(target=self._follow, daemon=True)
+            self._thread.start()
+        except OperationFailure:
+            # Not a replica set, remember how many bids each auction has and diff at the end
+            self.mode = "snapshot"
+            self._snapshot = self._bid_counts()
+        return self
+
+    def _follow(self):
+        while True:
+            # An empty answer to a read that started after stop() means that every acknowledged write was seen
+            stopping = self._stopped.is_set()
+            change = self._stream.try_next()
+            if change is None:
+                if stopping:
+                    return
+                continue
+            self._record(change['fullDocument'])
+
+    def stop(self) -> "Recorder":
+        if self.mode == "change stream":
+            self._stopped.set()
+            self._thread.join()
+            self._stream.close()
+        elif self.mode == "snapshot":
+            changed = [
+                ObjectId(each_id) for each_id, count in self._bid_counts().items()
+                if count > self._snapshot.get(each_id, 0)
+            ]
+            for each_bid in self.collection.find({"auction_id": {"$in": changed}}):
+                if each_bid['seq'] > self._snapshot.get(str(each_bid['auction_id']), 0):
+                    self._record(each_bid)
+        return self
+
+
+def verify(recorder: Recorder, api_winners: Optional[dict[str, Optional[str]]] = None) -> list[Violation]:
+    """
+        Check the invariants of every auction that received bids during the recording.
+        `api_winners` maps auction ids to the winner_id that the API returns for them.
+    """
+    violations = []
+
+    def violation(auction_id: str, rule: str, detail: str):
+        violations.append(Violation(auction=auction_id, rule=rule, detail=detail))
+
+    auctions = {
+        str(each['_id']): each for each in recorder.auctions.find(
+            {"_id": {"$in": [ObjectId(each_id) for each_id in recorder.bids]}}, {"last_bids": 0}
+        )
+    }
+    for auction_id, bids in recorder.bids.items():
+        auction = auctions.get(auction_id)
+        if auction is None:
+            violation(auction_id, "exists", "the auction is gone")
+            continue
+        bids = sorted(bids, key=lambda each_bid: each_bid.seq)
+
+        for previous, each_bid in zip(bids, bids[1:]):
+            if each_bid.seq != previous.seq + 1:
+                violation(auction_id, "no lost bids", "seq %d after %d" % (each_bid.seq, previous.seq))
+            if each_bid.bid <= previous.bid:
+                violation(auction_id, "increasing", "%s after %s" % (each_bid.bid, previous.bid))
+        for each_bid in bids:
+            if each_bid.date is not None and int(each_bid.date) >= auction['exp_date']:
+                violation(auction_id, "before expiry", "bid at %s, expired at %s" % (each_bid.date, auction['exp_date']))
+            if each_bid.user == auction['seller_id']:
+                violation(auction_id, "no self-bids", each_bid.user)
+
+        last = bids[-1]
+        if (last.seq, last.bid, last.user) != (auction['bid_count'], auction['highest_bid'], auction['highest_bidder']):
+            violation(auction_id, "summary", "%d bids, highest %s by %s, the last bid is #%d of %s by %s" % (
+                auction['bid_count'], auction['highest_bid'], auction['highest_bidder'], last.seq, last.bid, last.user
+            ))
+        if auction.get('closed'):
+            if auction.get('winner_id') != last.user or auction.get('final_price') != last.bid:
+                violation(auction_id, "settled winner", "%s for %s, the last bid is %s by %s" % (
+                    auction.get('winner_id'), auction.get('final_price'), last.bid, last.user
+                ))
+            if api_winners is not None and api_winners.get(auction_id) != last.user:
+                violation(auction_id, "API winner", "%s, the last bid is by %s" % (api_winners.get(auction_id), last.user))
+    return violations
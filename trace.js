@@ -0,0 +1,123 @@
+const fs = require('fs')
+const jsonwebtoken = require('jsonwebtoken')
+const bus = require('./bus')
+
+/*
+Capture of the request traces that tests/traces.py replays. With TRACE_FILE set
+every request to the auction, user and auth routes is appended to that file as
+one JSON line when its response has been sent:
+
+    t           when the request arrived, seconds since the epoch
+    method, path (with the query string) and route (the Express pattern)
+    user        the id of the logged user, or of the user who has just logged in
+    body        the JSON body, null for the rest (an NDJSON stream is not kept)
+    status, latency_ms
+    response    the JSON response, null past TRACE_RESPONSE_BYTES, which is
+                plenty for the messages and the new ids but not for the pages
+                of the listings
+
+The passwords and the auth-tokens are left out of the bodies and responses.
+
+The lines go through a write stream, a slow disk never holds a response. In a
+cluster every worker writes a file of its own, named after the worker
+(trace.jsonl.1, trace.jsonl.2, ...), and the replay merges them by time.
+*/
+
+const FILE = process.env.TRACE_FILE
+const RESPONSE_BYTES = parseInt(process.env.TRACE_RESPONSE_BYTES || 4096)
+const ROUTES = /^\/api\/(auction|user|auth)\//
+
+// What the trace keeps in place of a password or a token
+const REDACTED = "********"
+const SECRETS = ["password", "auth-token"]
+
+let output = null
+
+function stream() {
+    if (output === null) {
+        output = fs.createWriteStream(bus.clustered ? FILE + "." + bus.id : FILE, { flags: 'a' })
+        output.on('error', error => console.log("Trace: " + error.message))
+    }
+    return output
+}
+
+function redacted(body) {
+    if (body === null || typeof body !== 'object' || Array.isArray(body)) {
+        return body
+    }
+    const copy = { ...body }
+    for (const key of SECRETS) {
+        if (copy[key] !== undefined) {
+            copy[key] = REDACTED
+        }
+    }
+    return copy
+}
+
+// The user behind the request, the login route only has it in the token it answers with
+function user_of(req, res) {
+    if (req.user) {
+        return req.user._id
+    }
+    const token = res.get('auth-token')
+    const decoded = token ? jsonwebtoken.decode(token) : null
+    return decoded ? decoded._id : null
+}
+
+// Express middleware that writes the trace of every request it sees, mounted after the body parser
+function capture(req, res, next) {
+    if (!ROUTES.test(req.path)) {
+        return next()
+    }
+    const arrived = Date.now() / 1000
+    const started = process.hrtime.bigint()
+    const chunks = []
+    let bytes = 0
+    const write = res.write, end = res.end
+    const keep = chunk => {
+        if (chunk !== undefined && typeof chunk !== 'function' && bytes <= RESPONSE_BYTES) {
+            const buffer = Buffer.from(chunk)
+            bytes += buffer.length
+            chunks.push(buffer)
+        }
+    }
+    res.write = function (chunk, ...args) {
+        keep(chunk)
+        return write.call(this, chunk, ...args)
+    }
+    res.end = function (chunk, ...args) {
+        keep(chunk)
+        return end.call(this, chunk, ...args)
+    }
+    res.once('finish', () => {
+        let response = null
+        if (bytes <= RESPONSE_BYTES && /json/.test(res.get('Content-Type') || "")) {
+            try {
+                response = redacted(JSON.parse(Buffer.concat(chunks).toString()))
+            } catch {
+                response = null
+            }
+        }
+        stream().write(JSON.stringify({
+            t: arrived,
+            method: req.method,
+            path: req.originalUrl,
+            route: req.route ? req.baseUrl + req.route.path : null,
+            user: user_of(req, res),
+            body: req.is('json') ? redacted(req.body) : null,
+            status: res.statusCode,
+            latency_ms: Number(process.hrtime.bigint() - started) / 1e6,
+            response: response
+        }) + "\n")
+    })
+    next()
+}
+
+// Write the lines that are still buffered, on shutdown
+function close() {
+    return new Promise(resolve => output === null ? resolve() : output.end(resolve))
+}
+
+module.exports.enabled = Boolean(FILE)
+module.exports.capture = capture
+module.exports.close = close
@@ -1,4 +1,5 @@
 const joi = require('@hapi/joi')
+const { timed } = require('./metrics')
 
 // Validate post data on register request
 const registerValidation = data => {
@@ -50,17 +51,43 @@ const postAuctionValidation = data => {
 }
 
 
+//The parameters of every paginated listing
+const pagiKeys = {
+    page: joi.number().integer().min(1),
+    // An export (NDJSON) is streamed, so it has no upper limit
+    limit: joi.number().integer().min(1).when('format', {
+        is: 'ndjson', otherwise: joi.number().max(1000)
+    }),
+    cursor: joi.string(), // next_cursor from the previous page metadata, takes over the page
+    fields: joi.string().regex(/^[a-z_]+(\.[a-z_]+)*(,[a-z_]+(\.[a-z_]+)*)*$/), // "summary" or e.g. "exp_date,item.title"
+    format: joi.string().valid("json", "ndjson")
+}
+
 //Pagination validaiton
 const pagiValidation = data => {
 
     const pagiSchema = joi.object({
-        page: joi.number().integer().min(1),
-        limit: joi.number().integer(),
+        ...pagiKeys,
         history_type: joi.string().optional()
     })
     return pagiSchema.validate(data)
 }
 
+//Validate the auction search, every filter is optional and they all apply together
+const searchValidation = data => {
+
+    const searchSchema = joi.object({
+        ...pagiKeys,
+        q: joi.string().min(1).max(256), // words of the item title or description
+        condition: joi.string().valid('Used', 'New'),
+        min_price: joi.number().min(0), // on the current price, the highest bid or else the starting price
+        max_price: joi.number().min(0),
+        seller_id: joi.string().hex().length(24),
+        sort: joi.string().valid("ending", "highest_bid", "newest")
+    })
+    return searchSchema.validate(data)
+}
+
 // Validate post data on adding auction bid request
 const bidItemValidation = data => {
 
@@ -76,9 +103,19 @@ const bidItemValidation = data => {
     return bidSchema.validate(data)
 }
 
-module.exports.pagiValidation = pagiValidation
-module.exports.historyValidation = historyValidation
-module.exports.bidItemValidation = bidItemValidation
-module.exports.postAuctionValidation = postAuctionValidation
-module.exports.registerValidation = registerValidation
-module.exports.loginValidation = loginValidation
\ No newline at end of file
+// Validate the test clock request, the clock only moves forward
+const clockValidation = data => {
+    const clockSchema = joi.object({
+        seconds: joi.number().min(0).required()
+    })
+    return clockSchema.validate(data)
+}
+
+module.exports.clockValidation = timed('validate', clockValidation)
+module.exports.pagiValidation = timed('validate', pagiValidation)
+module.exports.searchValidation = timed('validate', searchValidation)
+module.exports.historyValidation = timed('validate', historyValidation)
+module.exports.bidItemValidation = timed('validate', bidItemValidation)
+module.exports.postAuctionValidation = timed('validate', postAuctionValidation)
+module.exports.registerValidation = timed('validate', registerValidation)
+module.exports.loginValidation = timed('validate', loginValidation)
\ No newline at end of file